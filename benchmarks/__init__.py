@@ -0,0 +1 @@
+"""Parser and model micro-benchmarks, run with python -m benchmarks.run."""
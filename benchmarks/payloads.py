@@ -0,0 +1,241 @@
+"""
+Synthetic /sync payloads for the benchmarks.
+
+The payloads are generated from a seed, so every run (and every commit)
+parses exactly the same data.
+"""
+from typing import Dict, List
+import random
+
+SERVER = "bench.example.org"
+
+WORDS = [
+    "matrix", "sync", "room", "event", "state", "hello", "world", "ping",
+    "pong", "bot", "message", "timeline", "encrypted", "device", "key"
+]
+
+
+def user_id(i: int) -> str:
+    """Get the user id of a synthetic user."""
+    return f"@user{i}:{SERVER}"
+
+
+def room_id(i: int) -> str:
+    """Get the room id of a synthetic room."""
+    return f"!room{i}:{SERVER}"
+
+
+def make_message(rng: random.Random, i: int, sender: str) -> dict:
+    """
+    Make a m.room.message timeline event.
+
+    :param rng: The random source.
+    :param i: The index of the event, used for its id and timestamp.
+    :param sender: The sender.
+    :return: The event.
+    """
+    body = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 30)))
+    content = {"msgtype": "m.text", "body": body}
+    if rng.random() < 0.2:
+        content["format"] = "org.matrix.custom.html"
+        content["formatted_body"] = f"<p>{body}</p>"
+    return {
+        "event_id": f"$event{i}",
+        "type": "m.room.message",
+        "sender": sender,
+        "origin_server_ts": 1600000000000 + i,
+        "content": content,
+        "unsigned": {"age": rng.randint(0, 100000)}
+    }
+
+
+def make_encrypted(rng: random.Random, i: int, sender: str) -> dict:
+    """
+    Make a m.room.encrypted timeline event, the ciphertext is random base64-like text.
+
+    :param rng: The random source.
+    :param i: The index of the event, used for its id and timestamp.
+    :param sender: The sender.
+    :return: The event.
+    """
+    alphabet = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+    return {
+        "event_id": f"$event{i}",
+        "type": "m.room.encrypted",
+        "sender": sender,
+        "origin_server_ts": 1600000000000 + i,
+        "content": {
+            "algorithm": "m.megolm.v1.aes-sha2",
+            "sender_key": "".join(rng.choice(alphabet) for _ in range(43)),
+            "session_id": "".join(rng.choice(alphabet) for _ in range(43)),
+            "device_id": "BENCHDEVICE",
+            "ciphertext": "".join(rng.choice(alphabet) for _ in range(rng.randint(200, 800)))
+        },
+        "unsigned": {"age": rng.randint(0, 100000)}
+    }
+
+
+def make_member(i: int, room: str, membership: str = "join") -> dict:
+    """
+    Make a m.room.member state event.
+
+    :param i: The index of the user.
+    :param room: The room id, used for the event id.
+    :param membership: The membership.
+    :return: The event.
+    """
+    return {
+        "event_id": f"$member{i}{room}",
+        "type": "m.room.member",
+        "sender": user_id(i),
+        "state_key": user_id(i),
+        "origin_server_ts": 1600000000000 + i,
+        "content": {"membership": membership, "displayname": f"User {i}"}
+    }
+
+
+def make_state(room: str, size: int, encrypted: bool = False) -> List[dict]:
+    """
+    Make the state events of a room: create, power levels, members and the encryption event.
+
+    :param room: The room id.
+    :param size: How many state events, most of them members.
+    :param encrypted: Add a m.room.encryption event.
+    :return: The events.
+    """
+    events = [{
+        "event_id": f"$create{room}",
+        "type": "m.room.create",
+        "sender": user_id(0),
+        "state_key": "",
+        "origin_server_ts": 1600000000000,
+        "content": {"creator": user_id(0), "room_version": "6"}
+    }, {
+        "event_id": f"$power{room}",
+        "type": "m.room.power_levels",
+        "sender": user_id(0),
+        "state_key": "",
+        "origin_server_ts": 1600000000000,
+        "content": {"users": {user_id(0): 100}, "users_default": 0}
+    }]
+    if encrypted:
+        events.append({
+            "event_id": f"$encryption{room}",
+            "type": "m.room.encryption",
+            "sender": user_id(0),
+            "state_key": "",
+            "origin_server_ts": 1600000000000,
+            "content": {"algorithm": "m.megolm.v1.aes-sha2"}
+        })
+    events += [make_member(i, room) for i in range(max(size - len(events), 0))]
+    return events
+
+
+def make_room(rng: random.Random, room: str, events: int, state_size: int,
+              encrypted_ratio: float = 0.0) -> dict:
+    """
+    Make the sync data of a joined room.
+
+    :param rng: The random source.
+    :param room: The room id.
+    :param events: How many timeline events.
+    :param state_size: How many state events.
+    :param encrypted_ratio: Which part of the timeline is encrypted, a room with encrypted events has a m.room.encryption event.
+    :return: The room.
+    """
+    members = max(state_size - 2, 1)
+    timeline = []
+    for i in range(events):
+        sender = user_id(rng.randrange(members))
+        make = make_encrypted if rng.random() < encrypted_ratio else make_message
+        timeline.append(make(rng, i, sender))
+    return {
+        "timeline": {"events": timeline, "limited": False, "prev_batch": "p1"},
+        "state": {"events": make_state(room, state_size, encrypted_ratio > 0)},
+        "account_data": {"events": []},
+        "ephemeral": {"events": []},
+        "unread_notifications": {"highlight_count": 0, "notification_count": rng.randint(0, events)},
+        "summary": {"m.joined_member_count": members}
+    }
+
+
+def make_invite(room: str, state_size: int) -> dict:
+    """
+    Make the sync data of an invite.
+
+    :param room: The room id.
+    :param state_size: How many stripped state events, the last is our invite.
+    :return: The invite.
+    """
+    events = [{
+        "type": "m.room.name",
+        "sender": user_id(1),
+        "state_key": "",
+        "content": {"name": f"Room {room}"}
+    }]
+    events += [{
+        "type": "m.room.member",
+        "sender": user_id(i),
+        "state_key": user_id(i),
+        "content": {"membership": "join"}
+    } for i in range(max(state_size - 2, 0))]
+    events.append({
+        "type": "m.room.member",
+        "sender": user_id(1),
+        "state_key": "@bench:" + SERVER,
+        "content": {"membership": "invite"}
+    })
+    return {"invite_state": {"events": events}}
+
+
+def make_sync(rooms: int = 10,
+              events: int = 50,
+              state_size: int = 20,
+              encrypted_ratio: float = 0.0,
+              invites: int = 0,
+              invite_state: int = 5,
+              seed: int = 0) -> dict:
+    """
+    Make a /sync response.
+
+    :param rooms: How many joined rooms.
+    :param events: How many timeline events per room.
+    :param state_size: How many state events per room.
+    :param encrypted_ratio: Which part of the timeline events is encrypted.
+    :param invites: How many invites.
+    :param invite_state: How many stripped state events per invite.
+    :param seed: The random seed.
+    :return: The response.
+    """
+    rng = random.Random(seed)
+    return {
+        "next_batch": f"s{seed}_{rooms}_{events}",
+        "account_data": {"events": []},
+        "presence": {"events": []},
+        "to_device": {"events": []},
+        "device_lists": {"changed": [], "left": []},
+        "device_one_time_keys_count": {"signed_curve25519": 50},
+        "rooms": {
+            "join": {
+                room_id(i): make_room(rng, room_id(i), events, state_size, encrypted_ratio)
+                for i in range(rooms)
+            },
+            "invite": {
+                room_id(rooms + i): make_invite(room_id(rooms + i), invite_state)
+                for i in range(invites)
+            },
+            "leave": {}
+        }
+    }
+
+
+# name: make_sync arguments
+SCENARIOS: Dict[str, dict] = {
+    "small": dict(rooms=5, events=10, state_size=10),
+    "busy": dict(rooms=20, events=100, state_size=50),
+    "large_state": dict(rooms=10, events=20, state_size=1000),
+    "many_rooms": dict(rooms=500, events=5, state_size=10),
+    "encrypted": dict(rooms=20, events=100, state_size=50, encrypted_ratio=1.0),
+    "mixed": dict(rooms=20, events=100, state_size=50, encrypted_ratio=0.5),
+    "invites": dict(rooms=2, events=10, state_size=10, invites=500, invite_state=10),
+}
@@ -0,0 +1,231 @@
+"""
+Parser and model micro-benchmarks.
+
+Run from the repository root, no homeserver needed:
+
+    python -m benchmarks.run -o results.json
+    python -m benchmarks.run -o new.json --compare results.json
+
+Every benchmark is timed over a few repeats (best and median) and then
+run once more under tracemalloc for its peak memory. The results are
+written as JSON, so runs of different commits can be compared.
+"""
+from typing import Any, Callable, Dict, List, Tuple
+from time import perf_counter
+import subprocess
+import statistics
+import tracemalloc
+import argparse
+import platform
+import json
+import sys
+import gc
+
+from matrix import codec
+from matrix.e2ee import canonical_json
+from matrix.parsers import parse_event, parse_invite, parse_room, parse_state
+from matrix.store import RoomStore
+from .payloads import SCENARIOS, make_sync
+
+
+def _timeline(payload: dict) -> List[dict]:
+    """Get all timeline events of a payload."""
+    return [
+        event for room in payload["rooms"]["join"].values()
+        for event in room["timeline"]["events"]
+    ]
+
+
+def benchmarks(payload: dict) -> Dict[str, Tuple[int, Callable[[], Any]]]:
+    """
+    Build the benchmarks of a payload.
+
+    :param payload: The /sync response.
+    :return: The benchmarks, as name: (number of items, function).
+    """
+    rooms = payload["rooms"]["join"]
+    invites = payload["rooms"]["invite"]
+    events = _timeline(payload)
+    total = len(events) + len(invites)
+
+    found = {
+        "parse_state": (total, lambda: parse_state(payload)),
+        "parse_state_lazy": (total, lambda: parse_state(payload, lazy=True)),
+        "parse_room": (len(rooms), lambda: [
+            parse_room(room, room_id) for room_id, room in rooms.items()
+        ]),
+        "parse_event": (len(events), lambda: [parse_event(event) for event in events]),
+        "canonical_json": (len(events), lambda: [canonical_json(event) for event in events]),
+        "room_store_apply": (total, lambda: RoomStore().apply(payload, initial=True)),
+    }
+    if invites:
+        found["parse_invite"] = (len(invites), lambda: [
+            parse_invite(invite, room_id) for room_id, invite in invites.items()
+        ])
+    return found
+
+
+def _loops(func: Callable[[], Any], min_time: float) -> int:
+    """Find how often a function has to run for a timed run to take at least min_time, like timeit.autorange."""
+    loops = 1
+    while True:
+        start = perf_counter()
+        for _ in range(loops):
+            func()
+        if perf_counter() - start >= min_time:
+            return loops
+        loops *= 2
+
+
+def measure(func: Callable[[], Any], repeat: int,
+            min_time: float = 0.05) -> Dict[str, float]:
+    """
+    Time a function and measure its memory.
+
+    :param func: The function, its result is kept alive until the memory is measured.
+    :param repeat: How many timed runs.
+    :param min_time: How many seconds a timed run takes at least, fast functions run several times per run.
+    :return: The best and median time per call in seconds, the calls per timed run, the peak and retained memory in bytes and the retained memory blocks.
+    """
+    loops = _loops(func, min_time)  # also warms up
+    times = []
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = perf_counter()
+            for _ in range(loops):
+                func()
+            times.append((perf_counter() - start) / loops)
+    finally:
+        if enabled: gc.enable()
+
+    gc.collect()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    retained_blocks = sys.getallocatedblocks() - blocks
+    del result
+
+    return {
+        "best_s": min(times),
+        "median_s": statistics.median(times),
+        "loops": loops,
+        "peak_bytes": peak - before,
+        "retained_bytes": current - before,
+        "retained_blocks": retained_blocks
+    }
+
+
+def run(scenarios: List[str], names: List[str] = None,
+        repeat: int = 5, seed: int = 0, min_time: float = 0.05) -> List[dict]:
+    """
+    Run the benchmarks.
+
+    :param scenarios: The payload scenarios, see payloads.SCENARIOS.
+    :param names: Only run these benchmarks, all if not given.
+    :param repeat: How many timed runs per benchmark.
+    :param seed: The payload seed.
+    :param min_time: How many seconds a timed run takes at least.
+    :return: One result per scenario and benchmark.
+    """
+    results = []
+    for scenario in scenarios:
+        payload = make_sync(seed=seed, **SCENARIOS[scenario])
+        payload_bytes = len(codec.dumps(payload))
+        for name, (items, func) in benchmarks(payload).items():
+            if names and name not in names:
+                continue
+            result = {
+                "scenario": scenario,
+                "benchmark": name,
+                "items": items,
+                "payload_bytes": payload_bytes,
+                "repeat": repeat
+            }
+            result.update(measure(func, repeat, min_time))
+            result["items_per_s"] = items / result["best_s"] if result["best_s"] else None
+            results.append(result)
+            print(f"{scenario:12} {name:18} {result['items_per_s'] or 0:14,.0f} items/s "
+                  f"{result['peak_bytes'] / 1024:10,.0f} KiB peak", file=sys.stderr)
+    return results
+
+
+def _commit() -> str:
+    """Get the current commit, None outside a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(seed: int) -> dict:
+    """Describe the environment of a run."""
+    return {
+        "commit": _commit(),
+        "python": platform.python_version(),
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "codec": type(codec.codec).__name__,
+        "seed": seed
+    }
+
+
+def compare(old: dict, new: dict) -> None:
+    """
+    Print the change in throughput and peak memory between two result files.
+
+    :param old: The baseline results.
+    :param new: The new results.
+    """
+    baseline = {(r["scenario"], r["benchmark"]): r for r in old["results"]}
+    print(f"{'scenario':12} {'benchmark':18} {'items/s':>10} {'peak':>10}")
+    for r in new["results"]:
+        base = baseline.get((r["scenario"], r["benchmark"]))
+        if base is None or not base["items_per_s"] or not base["peak_bytes"]:
+            continue
+        speed = r["items_per_s"] / base["items_per_s"] - 1
+        peak = r["peak_bytes"] / base["peak_bytes"] - 1
+        print(f"{r['scenario']:12} {r['benchmark']:18} {speed:+10.1%} {peak:+10.1%}")
+
+
+def main(argv: List[str] = None) -> dict:
+    parser = argparse.ArgumentParser(description="Parser and model micro-benchmarks.")
+    parser.add_argument("-s", "--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="payload scenario to run, can be repeated (default: all)")
+    parser.add_argument("-b", "--benchmark", action="append",
+                        help="benchmark to run, can be repeated (default: all)")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="timed runs per benchmark")
+    parser.add_argument("--min-time", type=float, default=0.05,
+                        help="seconds a timed run takes at least, raise it for steadier numbers")
+    parser.add_argument("--seed", type=int, default=0, help="payload seed")
+    parser.add_argument("--codec", choices=sorted(codec.codecs), help="JSON codec to use")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="compare with the results in this JSON file")
+    args = parser.parse_args(argv)
+
+    if args.codec:
+        codec.set_codec(args.codec)
+    report = {
+        "meta": metadata(args.seed),
+        "results": run(args.scenario or list(SCENARIOS), args.benchmark,
+                       args.repeat, args.seed, args.min_time)
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    return report
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,29 @@
-from .classes import Authentication, Device_Keys_Response, Event, Room_Preset, State, User
-from .parsers import parse_event, parse_room_events, parse_state, parse_device_keys_response
-from .e2ee import Olm
+from .classes import Authentication, Device_Keys, Device_Keys_Response, Event, Room_Events_Page, Room_Preset, Sync_Delta, User
+from .parsers import parse_event, parse_room_events, parse_device_keys_response, dump_event, dump_invite, dump_room
+from .store import RoomStore
+from .storage import Storage
+from .pool import PooledAdapter
+from .ratelimit import RateLimiter
+from .outbound import SendQueue
+from .devices import Devices, DeviceStore
+from .media import CHUNK_SIZE, MediaCache, Progress, UploadStream, iter_file, parse_content_range, parse_mxc, write_chunks
+from . import codec
+from .e2ee import DeviceKeyVerifier, Olm, Outbound_Group_Session, canonical_json, check_one_time_key_signature
+from .crypto_store import CryptoStore
+from .decryption import Decryptor
+from .keys import OneTimeKeyMaintainer
+from .metrics import BYTE_BUCKETS, NULL_METRICS, Metrics, endpoint_template
 from .exceptions import *
-from typing import Any, Dict, List, Mapping
+from typing import Any, Callable, Dict, Iterator, List, Mapping, Tuple
+import os
+import logging
 import threading
 import requests
-from time import time, sleep
+from time import perf_counter, time, sleep
 from .constants import Constants
 
+logger = logging.getLogger(__name__)
+
 try:
     from urllib import quote
 except ImportError:
@@ -28,14 +44,57 @@ class Bot():
                  username: str,
                  password: str,
                  sync_delay: int = 2,
-                 device_id: str = "") -> None:
+                 device_id: str = "",
+                 incremental_sync: bool = True,
+                 sync_timeout: int = 30000,
+                 timeline_limit: int = 50,
+                 storage: Storage = None,
+                 pool_connections: int = 10,
+                 pool_maxsize: int = 10,
+                 pool_block: bool = False,
+                 keep_alive: bool = True,
+                 sync_filter: Any = None,
+                 lazy_events: bool = False,
+                 max_retries: int = 3,
+                 rate_limits: Mapping[str, float] = None,
+                 max_in_flight: int = 10,
+                 media_cache: MediaCache = None,
+                 crypto_store: CryptoStore = None,
+                 pickle_key: str = "",
+                 decrypt_workers: int = 4,
+                 verify_device_keys: bool = True,
+                 one_time_keys: int = None,
+                 metrics: Metrics = None,
+                 max_sync_backoff: float = 60) -> None:
         """
         Initialize the client.
 
         :param homeserver: The homeserver url.
         :param username: The username.
         :param password: The password.
-        :param sync_delay: The sync delay.
+        :param sync_delay: The sync delay, only used without incremental sync.
+        :param device_id: The device id.
+        :param incremental_sync: Long-poll /sync from the last next_batch token instead of polling full snapshots.
+        :param sync_timeout: How long the homeserver may hold a long-poll /sync, in milliseconds.
+        :param timeline_limit: How many timeline events to keep per room.
+        :param storage: Storage to persist the sync state in, so a restart resumes from the last sync token.
+        :param pool_connections: How many hosts to keep connection pools for.
+        :param pool_maxsize: How many connections to keep open per host.
+        :param pool_block: Wait for a free connection instead of opening more than pool_maxsize per host.
+        :param keep_alive: Reuse connections between requests.
+        :param sync_filter: Filter for /sync, a filter dict (see filters.make_sync_filter), a filter id or a JSON string.
+        :param lazy_events: Keep synced events as Lazy_Event objects that are only parsed when a field is read.
+        :param max_retries: How often to retry a request the homeserver rate limited.
+        :param rate_limits: Requests per second per endpoint class (send, join, invite, media, sync, other), classes without a rate adapt to the homeserver limits.
+        :param max_in_flight: How many queued sends (see enqueue_send) may run at the same time, keep it at most pool_maxsize.
+        :param media_cache: Cache downloaded media and thumbnails on disk, e.g. MediaCache("media").
+        :param crypto_store: Keep the Olm account and the encryption sessions in this store, e.g. SQLiteCryptoStore("keys.db").
+        :param pickle_key: The passphrase the crypto store pickles are encrypted with.
+        :param decrypt_workers: How many Megolm sessions to decrypt at the same time when a sync brings encrypted events.
+        :param verify_device_keys: Check the signatures of queried device keys and drop the devices whose signature is invalid.
+        :param one_time_keys: How many one time keys to keep on the homeserver, half of what the Olm account can hold by default.
+        :param metrics: Record request, sync and queue metrics in this registry, e.g. Metrics(). Disabled by default.
+        :param max_sync_backoff: The longest wait in seconds before retrying a sync that failed with a network or server error.
 
         """
         self.base = homeserver
@@ -44,18 +103,129 @@ class Bot():
         self.device_id = device_id
         self.auth = None
         self.use_auth_header = True
-        self.state = State(next_batch="")
+        self.state = RoomStore(timeline_limit=timeline_limit, lazy=lazy_events)
+        self.last_delta = Sync_Delta()
         self.set_as_online = True
         self.sync_delay = sync_delay
+        self.incremental_sync = incremental_sync
+        self.sync_timeout = sync_timeout
+        self.max_sync_backoff = max_sync_backoff
+        self.sync_failures = 0
         self.run = True
         self.txn_id = 0
+        self.storage = storage
+        self.resumed = False
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.pool_block = pool_block
+        self.keep_alive = keep_alive
+        self.session = self._create_session()
+        self.sync_listeners: List[Callable[[Sync_Delta], None]] = []
+        self.sync_filter = sync_filter
+        self.filter_ids: Dict[str, str] = {}
+        self.max_retries = max_retries
+        self.rate_limiter = RateLimiter(rate_limits)
+        self.max_in_flight = max_in_flight
+        self.send_queue = None
+        self.media_cache = media_cache
+        self.device_verifier = DeviceKeyVerifier() if verify_device_keys else None
+        self.devices = self._create_device_store()
 
         # self.mongo_db = MongoDB
-        self.olm = Olm()
+        self.crypto_store = crypto_store
+        self.olm = Olm(crypto_store, pickle_key)
+        self.key_maintainer = self._create_key_maintainer(one_time_keys)
+        self.metrics = metrics or NULL_METRICS
+        self._init_metrics()
+        self.decryptor = Decryptor(self.olm, decrypt_workers,
+                                   device_keys=self._known_devices)
 
     def stop(self) -> None:
         """Stop the sync thread."""
         self.run = False
+        if self.storage:
+            self.storage.set_value("txn_id", self.txn_id)
+            self.storage.commit()
+        if isinstance(self.send_queue, SendQueue):
+            self.send_queue.close()
+        self.olm.flush()
+        # the registry may be shared and outlive the bot
+        self._send_queue_depth.remove_function(**self._metric_labels)
+        self.decryptor.close()
+        self.key_maintainer.close()
+        if self.device_verifier:
+            self.device_verifier.close()
+        self.close_session()
+
+    def _create_session(self) -> requests.Session:
+        """Create the pooled HTTP session."""
+        session = requests.Session()
+        adapter = PooledAdapter(pool_connections=self.pool_connections,
+                                pool_maxsize=self.pool_maxsize,
+                                pool_block=self.pool_block)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        if not self.keep_alive:
+            session.headers["Connection"] = "close"
+        return session
+
+    def close_session(self) -> None:
+        """Close all pooled connections."""
+        self.session.close()
+
+    def connection_stats(self) -> Dict[str, int]:
+        """
+        Get connection statistics, to check that connections are reused.
+
+        :return: The number of requests, opened and reused connections.
+        """
+        return self.session.get_adapter(self.base).connection_stats()
+
+    def _init_metrics(self) -> None:
+        """Create the metrics the bot records."""
+        m = self.metrics
+        self._request_seconds = m.histogram(
+            "matrix_request_duration_seconds",
+            "Time until the homeserver answered a request.")
+        self._responses = m.counter(
+            "matrix_responses_total",
+            "Responses by endpoint and status code, error for requests that got no response.")
+        self._retries = m.counter(
+            "matrix_request_retries_total",
+            "Requests sent again after the homeserver rate limited them.")
+        self._response_bytes = m.histogram("matrix_response_bytes",
+                                           "Size of the response bodies.",
+                                           BYTE_BUCKETS)
+        self._sync_seconds = m.histogram(
+            "matrix_sync_duration_seconds",
+            "Time a sync took, including the long-poll.")
+        self._sync_processing_seconds = m.histogram(
+            "matrix_sync_processing_seconds",
+            "Time spent merging, decrypting and handing out a sync response.")
+        self._events_parsed = m.counter(
+            "matrix_events_parsed_total",
+            "Timeline events received through sync.")
+        self._send_queue_depth = m.gauge(
+            "matrix_send_queue_depth",
+            "Events queued with enqueue_send that weren't sent yet.")
+        self._metric_labels = {"bot": self.user}
+        self._send_queue_depth.set_function(
+            lambda: self.send_queue.stats()["queued"] if self.send_queue else 0,
+            **self._metric_labels)
+
+    def _record_response(self, method: str, endpoint: str, status: Any,
+                         start: float) -> None:
+        """Record the latency and status of a request attempt."""
+        if not self.metrics.enabled:
+            return
+        labels = {"method": method.upper(), "endpoint": endpoint_template(endpoint)}
+        self._request_seconds.observe(perf_counter() - start, **labels)
+        self._responses.inc(status=status, **labels)
+
+    def _record_bytes(self, endpoint: str, size: int) -> None:
+        """Record the size of a response body."""
+        if self.metrics.enabled:
+            self._response_bytes.observe(size, endpoint=endpoint_template(endpoint))
 
     def _make_request(self,
                       method: str,
@@ -65,7 +235,8 @@ class Bot():
                       skip_auth_check: bool = False,
                       API_path: str = "/_matrix/client/r0",
                       raw_data: Any = None,
-                      headers: Dict[str, str] = {}) -> dict:
+                      headers: Dict[str, str] = {},
+                      timeout: float = None) -> dict:
         """
         Make a request to the homeserver.
 
@@ -77,15 +248,141 @@ class Bot():
         :param API_path: API path
         :param raw_data: Raw data
         :param headers: HTTP Headers
+        :param timeout: Client side timeout in seconds
         :return: Response from the homeserver
         """
 
+        headers, params = self._prepare_request(method, params, headers,
+                                                skip_auth_check)
+        if headers is None:
+            return None
+
+        body = codec.dumps(data) if raw_data is None else raw_data
+        r = self._request(method, endpoint, body, params, headers, API_path,
+                          timeout)
+        self._record_bytes(endpoint, len(r.content))
+        return self._parse_response(r.content, r.status_code)
+
+    def _request(self,
+                 method: str,
+                 endpoint: str,
+                 body: Any,
+                 params: dict,
+                 headers: Dict[str, str],
+                 API_path: str,
+                 timeout: float = None,
+                 stream: bool = False) -> requests.Response:
+        """
+        Send a prepared request, retrying it when the homeserver rate limits it.
+
+        :param method: HTTP method
+        :param endpoint: Endpoint
+        :param body: The request body, bytes or a media.UploadStream
+        :param params: Parameters
+        :param headers: HTTP Headers
+        :param API_path: API path
+        :param timeout: Client side timeout in seconds
+        :param stream: Don't read the response body, the caller has to close the response.
+        :return: The successful response.
+        """
+        bucket = self.rate_limiter.bucket(endpoint, API_path)
+
+        for attempt in range(self.max_retries + 1):
+            delay = bucket.reserve()
+            if delay > 0: sleep(delay)
+
+            # requests only uses chunked transfer encoding for bodies without a length
+            data = iter(body) if isinstance(body, UploadStream) and body.chunked else body
+            start = perf_counter()
+            try:
+                r = self.session.request(method.upper(),
+                                         f"{self.base}{API_path}{endpoint}",
+                                         params=params,
+                                         data=data,
+                                         headers=headers,
+                                         timeout=timeout,
+                                         stream=stream)
+            except Exception:
+                self._record_response(method, endpoint, "error", start)
+                raise
+            self._record_response(method, endpoint, r.status_code, start)
+            if r.status_code >= 400:
+                try:
+                    self._parse_response(r.content, r.status_code)
+                except RateLimited as e:
+                    bucket.limited(self._retry_after(e, attempt))
+                    if attempt == self.max_retries or not self._can_resend(body):
+                        raise
+                    if self.metrics.enabled:
+                        self._retries.inc(endpoint=endpoint_template(endpoint))
+                    continue
+
+            bucket.succeeded()
+            return r
+
+    def _retry_after(self, error: RateLimited, attempt: int) -> float:
+        """Get how many seconds to wait after a rate limit."""
+        if error.retry_after_ms is not None:
+            return error.retry_after_ms / 1000
+        # no hint from the homeserver, back off exponentially
+        return 2**attempt
+
+    def _can_resend(self, body: Any) -> bool:
+        """Check if a request body can be sent again, rewinds upload streams that can."""
+        if isinstance(body, UploadStream):
+            return body.rewind()
+        return body is None or isinstance(body, (bytes, str))
+
+    def _parse_response(self, body: bytes, status_code: int) -> dict:
+        """
+        Decode a response body and raise on errors.
+
+        :param body: The raw response body.
+        :param status_code: The HTTP status code.
+        :return: The decoded response.
+        """
+        try:
+            res = codec.loads(body)
+        except Exception as e:
+            if status_code == 429:
+                raise RateLimited(f"Status code {status_code}")
+            if status_code >= 400:
+                raise MatrixError(f"Status code {status_code}",
+                                  status_code=status_code)
+            raise ParsingError(f"Error while parsing response: {e}")
+
+        if status_code >= 400:
+            if not isinstance(res, dict): res = {}
+            err = res.get('error', f"Status code {status_code}")
+            if status_code == 429 or res.get("errcode") == "M_LIMIT_EXCEEDED":
+                raise RateLimited(err,
+                                  status_code=status_code,
+                                  retry_after_ms=res.get("retry_after_ms"))
+            raise MatrixError(err, res.get("errcode"), status_code)
+            # print(f"[!] Error while making request to {endpoint}: {err}")
+            # return None
+
+        return res
+
+    def _prepare_request(self, method: str, params: dict,
+                         headers: Dict[str, str],
+                         skip_auth_check: bool) -> Tuple[dict, dict]:
+        """
+        Build the headers and parameters of a request.
+
+        :param method: HTTP method
+        :param params: Parameters
+        :param headers: Extra HTTP headers
+        :param skip_auth_check: Skip the auth check
+        :return: The headers and parameters, or (None, None) for invalid methods.
+        """
         method = method.upper()
         if method not in ["GET", "PUT", "DELETE", "POST"]:
             print(f"[!] Invalid method: {method}")
-            return None
+            return None, None
 
-        headers = {"Content-Type": "application/json"}
+        headers = {"Content-Type": "application/json", **headers}
+        params = dict(params)
 
         if not self.auth and not skip_auth_check:
             # print("[!] Not authenticated")
@@ -98,26 +395,20 @@ class Bot():
             else:
                 params["access_token"] = self.auth.access_token
 
-        r = requests.request(method,
-                             f"{self.base}{API_path}{endpoint}",
-                             params=params,
-                             json=data,
-                             data=raw_data,
-                             headers=headers)
-
-        try:
-            if not r.ok:
-                err = r.json().get('error', f"Status code {r.status_code}")
-                raise MatrixError(err)
-                # print(f"[!] Error while making request to {endpoint}: {err}")
-                # return None
-
-            return r.json()
-        except Exception as e:
-            raise ParsingError(f"Error while parsing response: {e}")
-            # print(f"[!] Error while parsing response: {e}")
-            # print(r.text)
-            # return None
+        return headers, params
+
+    def _set_auth(self, res: dict) -> Authentication:
+        """Keep the authentication data of a login or register response."""
+        self.auth = Authentication(access_token=res["access_token"],
+                                   user_id=res["user_id"],
+                                   device_id=res["device_id"],
+                                   home_server=res["home_server"])
+        self.olm.user_id = self.auth.user_id
+        self.olm.device_id = self.auth.device_id
+        if self.crypto_store is not None and not self.olm.active:
+            # the account has to be there to keep one time keys uploaded
+            self.olm.load_or_create()
+        return self.auth
 
     def login(self,
               start_syncing: bool = True,
@@ -139,11 +430,7 @@ class Bot():
 
         r = self._make_request("POST", "/login", data, skip_auth_check=True)
         if r:
-            self.auth = Authentication(access_token=r["access_token"],
-                                       user_id=r["user_id"],
-                                       device_id=r["device_id"],
-                                       home_server=r["home_server"])
-
+            self._set_auth(r)
             if start_syncing: self.start_sync()
             return self.auth
 
@@ -163,25 +450,111 @@ class Bot():
         }
         r = self._make_request("POST", "/register", data, skip_auth_check=True)
         if r:
-            self.auth = Authentication(access_token=r["access_token"],
-                                       user_id=r["user_id"],
-                                       device_id=r["device_id"],
-                                       home_server=r["home_server"])
-
+            self._set_auth(r)
             if start_syncing: self.start_sync()
             return self.auth
 
     def start_sync(self) -> None:
         """Start the sync thread."""
-        self.sync(set_as_new=True)
+        if not self.restore():
+            self.sync(set_as_new=True)
         threading.Thread(target=self.sync_thread).start()
 
+    def restore(self) -> bool:
+        """
+        Restore the sync state from the storage.
+
+        :return: Whether there was a sync state to resume from.
+        """
+        if not self.storage:
+            return False
+
+        next_batch = self.storage.get_value("next_batch")
+        if not next_batch:
+            return False
+
+        self.state.clear()
+        self.state.apply(
+            {
+                "next_batch": next_batch,
+                "rooms": self.storage.get_rooms()
+            },
+            initial=True)
+        self.txn_id = self.storage.get_value("txn_id", self.txn_id)
+        self.resumed = True
+        return True
+
+    def _save_sync(self, delta: Sync_Delta) -> None:
+        """Persist the changes of a sync in the storage."""
+        if delta.initial:
+            self.storage.clear_rooms()
+
+        # only what the sync changed is written, not the whole room
+        for room_id, events in delta.timeline.items():
+            room = self.state.rooms.get(room_id)
+            if room is None:
+                continue
+            dumped = [dump_event(event) for event in events]
+            self.storage.save_room_delta(
+                room_id, dump_room(room, events=False),
+                delta.state.get(room_id, []) + [event for event in dumped if "state_key" in event],
+                dumped, self.state.timeline_limit)
+        self.storage.save_rooms("invite", {
+            invite.room_id: dump_invite(invite)
+            for invite in delta.invites
+        })
+        self.storage.delete_rooms(delta.left_rooms)
+        self.storage.set_value("next_batch", delta.next_batch)
+        self.storage.set_value("txn_id", self.txn_id)
+        self.storage.commit()
+
     def sync_thread(self) -> None:
-        """Sync thread."""
+        """Sync thread, retries failed syncs until the bot is stopped."""
         while self.run:
-            sleep(self.sync_delay)
-            # self.sync(since=self.state.next_batch)
-            self.sync(set_as_new=True)
+            try:
+                if self.incremental_sync and self.state.next_batch:
+                    # the homeserver holds the request until something happens,
+                    # so there is no need to sleep between syncs
+                    self.sync(since=self.state.next_batch)
+                else:
+                    sleep(self.sync_delay)
+                    self.sync(set_as_new=True)
+            except Exception as e:
+                if not self.run:
+                    return
+                delay = self._sync_failed(e)
+                deadline = time() + delay
+                while self.run and time() < deadline:
+                    sleep(min(1, deadline - time()))
+            else:
+                self.sync_failures = 0
+
+    # network errors a sync is retried after, besides 5xx and 429 responses
+    _transport_errors: Tuple[type, ...] = (requests.RequestException, OSError, ParsingError)
+
+    def _sync_failed(self, error: Exception) -> float:
+        """
+        Decide what to do after a failed sync.
+
+        :param error: The error the sync raised.
+        :return: How many seconds to wait before retrying, growing exponentially up to max_sync_backoff.
+        :raises Exception: The error, if retrying can't help (e.g. M_UNKNOWN_TOKEN).
+        """
+        if isinstance(error, MatrixError):
+            retryable = error.status_code is None or error.status_code >= 500 \
+                or isinstance(error, RateLimited)
+        else:
+            retryable = isinstance(error, self._transport_errors)
+        if not retryable:
+            raise error
+
+        self.sync_failures += 1
+        delay = min(self.max_sync_backoff, 2**(self.sync_failures - 1))
+        if isinstance(error, RateLimited) and error.retry_after_ms:
+            delay = max(delay, error.retry_after_ms / 1000)
+        logger.warning("Sync of %s failed (%r), retrying in %.1f s", self.user,
+                       error, delay)
+        return delay
 
     # https://github.com/matrix-org/matrix-python-sdk/blob/887f5d55e16518a0a2bef4f2d6bff6ecf48d18c1/matrix_client/api.py#L1085
     def _make_txn_id(self):
@@ -211,6 +584,17 @@ class Bot():
         :param power_level_content_override: Override the default power levels.
         :return: Room ID
         """
+        data = self._create_room_data(alias, preset, topic, invite,
+                                      creation_content, initial_state,
+                                      visibility, power_level_content_override)
+        res = self._make_request("POST", "/createRoom", data)
+        return res.get("room_id")
+
+    def _create_room_data(self, alias: str, preset: str, topic: str,
+                          invite: List[str], creation_content: Dict,
+                          initial_state: List[Event], visibility: str,
+                          power_level_content_override: Dict) -> dict:
+        """Build the body of a /createRoom request."""
         data = {}
         if alias: data = {"room_alias_name": alias}
         if preset: data["preset"] = preset
@@ -221,9 +605,7 @@ class Bot():
         if visibility: data["visibility"] = visibility
         if power_level_content_override:
             data["power_level_content_override"] = power_level_content_override
-
-        res = self._make_request("POST", "/createRoom", data)
-        return res.get("room_id")
+        return data
 
     def create_space(self,
                      alias: str = "",
@@ -247,19 +629,9 @@ class Bot():
         :param power_level_content_override: Override the default power levels.
         :return: Room ID.
         """
-        data = {}
-        if preset: data["preset"] = preset
-        if alias: data["alias"] = topic
-        if topic: data["topic"] = topic
-        if invite: data["invite"] = invite
-        if creation_content: data["creation_content"] = creation_content
-        if initial_state: data["initial_state"] = initial_state
-        if visibility: data["visibility"] = visibility
-        if power_level_content_override:
-            data["power_level_content_override"] = power_level_content_override
-
-        res = self._make_request("PUT", "/createRoom", data)
-        return res.get("room_id")
+        return self.create_room(alias, preset, topic, invite,
+                                creation_content, initial_state, visibility,
+                                power_level_content_override)
 
     def invite_to_room(self, user_id: str, room_id: str) -> dict:
         """
@@ -291,6 +663,38 @@ class Bot():
         path = f"/rooms/{quote(room_id)}/send/{quote(event_type)}/{quote(str(txn_id))}"
         return self._make_request("PUT", path, content)
 
+    def _create_send_queue(self) -> SendQueue:
+        """Create the queue behind enqueue_send."""
+        return SendQueue(self.send_room_event, self.max_in_flight)
+
+    def enqueue_send(self, room_id: str, event_type: str, content: Dict):
+        """
+        Queue an event to be sent in the background.
+
+        Events of different rooms are sent concurrently over the pooled
+        connections, events of the same room in the order they were queued.
+        The transaction id is assigned right away, so a retried send can't
+        be duplicated by the homeserver.
+
+        :param room_id: The room id to send the event to.
+        :param event_type: The event type.
+        :param content: The event content.
+        :return: A future resolving to the sent Event, or raising the error if sending failed.
+        """
+        if self.send_queue is None:
+            self.send_queue = self._create_send_queue()
+        return self.send_queue.enqueue(room_id, event_type, content,
+                                       self._make_txn_id())
+
+    def flush_sends(self, timeout: float = None) -> None:
+        """
+        Wait until every queued event was sent or failed.
+
+        :param timeout: How many seconds to wait at most.
+        """
+        if self.send_queue is not None:
+            self.send_queue.flush(timeout)
+
     def send_message(self,
                      room_id: str,
                      message: str,
@@ -312,14 +716,20 @@ class Bot():
         :return: Event object
         """
 
+        data = self._message_content(message, msgtype, format, formatted_body,
+                                     url, info)
+        res = self.send_room_event(room_id, "m.room.message", data)
+        return Event(res["event_id"], timestamp=time())
+
+    def _message_content(self, message: str, msgtype: str, format: str,
+                         formatted_body: str, url: str, info: Dict) -> dict:
+        """Build the content of a m.room.message event."""
         data = {"msgtype": msgtype, "body": message}
         if format: data["format"] = format
         if formatted_body: data["formatted_body"] = formatted_body
         if url: data["url"] = url
         if info: data["info"] = info
-
-        res = self.send_room_event(room_id, "m.room.message", data)
-        return Event(res["event_id"], timestamp=time())
+        return data
 
     def leave_room(self, room_id: str) -> dict:
         """
@@ -329,31 +739,185 @@ class Bot():
         """
         return self._make_request("POST", f"/rooms/{room_id}/leave", {})
 
-    def sync(self, since: str = "", set_as_new: bool = False) -> State:
+    def sync(self, since: str = "", set_as_new: bool = False) -> RoomStore:
         """
         Sync the client state.
 
+        The response is merged into the room store, the changes it
+        introduced are kept in last_delta.
+
         :param since: The token to sync from.
-        :param set_as_new: Set the state as new.
-        :return: The new state.
+        :param set_as_new: Forget the stored rooms before applying the response.
+        :return: The room store.
+        """
+        start = perf_counter()
+        params, timeout = self._sync_params(since, self.get_sync_filter_id())
+        res = self._make_request("GET",
+                                 "/sync", {},
+                                 params=params,
+                                 timeout=timeout)
+
+        state = self._apply_sync(res, initial=set_as_new or not since)
+        self._sync_seconds.observe(perf_counter() - start)
+        return state
+
+    def _sync_params(self, since: str, filter_id: str) -> Tuple[dict, float]:
+        """
+        Build the parameters of a sync request.
+
+        :param since: The token to sync from.
+        :param filter_id: The filter id or JSON filter.
+        :return: The query parameters and the client side timeout in seconds.
         """
         params = {}
-        # if since: params["since"] = since
+        timeout = None
+        if filter_id: params["filter"] = filter_id
+        if since:
+            params["since"] = since
+            params["timeout"] = self.sync_timeout
+            # give the homeserver some slack before giving up on the long-poll
+            timeout = self.sync_timeout / 1000 + 30
         # if self.set_as_online: params["presence"] = "online"
+        return params, timeout
+
+    def _apply_sync(self, res: dict, initial: bool) -> RoomStore:
+        """
+        Merge a sync response into the room store.
 
-        res = self._make_request("GET", "/sync", {}, params=params)
+        Encrypted timeline events are decrypted before the sync listeners
+        see them.
+
+        :param res: The sync response.
+        :param initial: Whether the response is a full sync.
+        :return: The room store.
+        """
+        start = perf_counter()
+        self._merge_sync(res, initial)
+        if self.decryptor.needed(self.last_delta):
+            # room keys are only accepted from devices with known keys
+            senders = self.decryptor.senders(self.last_delta)
+            if senders:
+                try:
+                    self.get_device_keys(senders)
+                except Exception as e:
+                    self._device_query_failed(senders, e)
+            self.decryptor.decrypt_delta(self.last_delta)
+            self.state.replace_events(self.last_delta.timeline)
+        state = self._finish_sync()
+        self._sync_processing_seconds.observe(perf_counter() - start)
+        return state
+
+    def _device_query_failed(self, user_ids: List[str], error: Exception) -> None:
+        """
+        Log a failed device key query of a sync and query the users again next time.
 
-        state = parse_state(res)
-        self.state = state
-        # if set_as_new:
-        #     self.state = state
-        # else:
-        #     self.state.next_batch = state.next_batch
-        #     self.state.invited_rooms += state.invited_rooms
-        #     self.state.joined_rooms += state.joined_rooms
+        The sync is merged already, so it goes on and the room keys of
+        these users are rejected instead.
+        """
+        logger.warning("Querying the device keys of %s failed (%r), their room keys are rejected",
+                       ", ".join(user_ids), error)
+        self.devices.update(changed=user_ids)
+
+    def _merge_sync(self, res: dict, initial: bool) -> None:
+        """Merge a sync response into the room store and keep its changes in last_delta."""
+        if initial:
+            self.state.clear()
+        self.last_delta = self.state.apply(res, initial=initial)
+        self._discard_outbound_sessions(self.last_delta)
+        if initial:
+            # full syncs don't report device list changes
+            self.devices.forget()
+        elif self.last_delta.device_lists:
+            self.devices.update(self.last_delta.device_lists.get("changed", []),
+                                self.last_delta.device_lists.get("left", []))
+        self.key_maintainer.update(self.last_delta.one_time_keys_count)
+        if self.metrics.enabled:
+            self._events_parsed.inc(
+                sum(len(events) for events in self.last_delta.timeline.values()))
+
+    def _finish_sync(self) -> RoomStore:
+        """Persist the changes of a merged sync and pass them to the sync listeners."""
+        # the outbound sessions are stored once per sync, not after every message
+        self.olm.flush()
+        if self.storage:
+            self._save_sync(self.last_delta)
+        for listener in self.sync_listeners:
+            listener(self.last_delta)
 
         return self.state
 
+    def _discard_outbound_sessions(self, delta: Sync_Delta) -> None:
+        """Stop using the Megolm session of rooms that members left, they must not read new messages."""
+        discarded = set()
+        for room_id, events in delta.timeline.items():
+            for event in events:
+                if event.type == "m.room.member" and (event.content or {}).get(
+                        "membership") in ["leave", "ban"]:
+                    self.olm.discard_outbound_group_session(room_id)
+                    discarded.add(room_id)
+                    break
+        # the state section holds the changes in the gap of a limited sync, and the full
+        # state on a full sync, so only members that got the room key count there
+        for room_id, events in delta.state.items():
+            if room_id in discarded:
+                continue
+            left = {event.get("state_key") for event in events
+                    if event.get("type") == "m.room.member" and (event.get("content") or {}).get(
+                        "membership") in ["leave", "ban"]}
+            if left and left & self.olm.shared_users(room_id):
+                self.olm.discard_outbound_group_session(room_id)
+
+    def add_sync_listener(self, listener: Callable[[Sync_Delta],
+                                                   None]) -> None:
+        """
+        Call a function with the changes of every sync.
+
+        :param listener: Called with the Sync_Delta from the syncing thread or task.
+        """
+        self.sync_listeners.append(listener)
+
+    def upload_filter(self, filter: dict) -> str:
+        """
+        Upload a filter, filters that were uploaded before are not uploaded again.
+
+        :param filter: The filter, see filters.make_sync_filter.
+        :return: The filter id.
+        """
+        key, filter_id = self._cached_filter_id(filter)
+        if filter_id:
+            return filter_id
+
+        res = self._make_request("POST",
+                                 f"/user/{quote(self.auth.user_id)}/filter",
+                                 filter)
+        return self._remember_filter_id(key, res["filter_id"])
+
+    def get_sync_filter_id(self) -> str:
+        """
+        Get the filter to pass to /sync, uploading sync_filter if needed.
+
+        :return: The filter id or JSON filter, None if there is no filter.
+        """
+        if not self.sync_filter or isinstance(self.sync_filter, str):
+            return self.sync_filter
+        return self.upload_filter(self.sync_filter)
+
+    def _cached_filter_id(self, filter: dict) -> Tuple[str, str]:
+        """Get the cache key and, if known, the id of a filter."""
+        key = canonical_json(filter).decode("UTF-8")
+        filter_id = self.filter_ids.get(key)
+        if not filter_id and self.storage:
+            filter_id = self.storage.get_value(f"filter:{key}")
+            if filter_id: self.filter_ids[key] = filter_id
+        return key, filter_id
+
+    def _remember_filter_id(self, key: str, filter_id: str) -> str:
+        """Cache the id of an uploaded filter."""
+        self.filter_ids[key] = filter_id
+        if self.storage:
+            self.storage.set_value(f"filter:{key}", filter_id)
+        return filter_id
+
     def get_room_id(self, room_alias: str) -> str:
         """
         Get the room id from a room alias.
@@ -365,17 +929,46 @@ class Bot():
             "GET", "/directory/room/{}".format(quote(room_alias)))
         return content.get("room_id", None) if content else None
 
-    def get_room_members(self, room_id: str) -> List[User]:
+    def get_room_members(self, room_id: str, refresh: bool = False) -> List[User]:
         """
         Get the members of a room.
 
+        The members of joined rooms are fetched once and then kept current
+        from the m.room.member events of the sync.
+
         :param room_id: The room id.
+        :param refresh: Fetch the members from the homeserver even if they are cached.
         :return: List of users.
         """
-        res = self._make_request("GET", f"/rooms/{room_id}/joined_members")
+        members = None if refresh else self.state.get_members(room_id)
+        if members is None:
+            res = self._make_request("GET",
+                                     f"/rooms/{quote(room_id)}/joined_members")
+            members = self._parse_members(res)
+            self.state.set_members(room_id, members)
+        return members
+
+    def is_room_member(self, room_id: str, user_id: str) -> bool:
+        """
+        Check if a user is a joined member of a room, from the member cache if possible.
+
+        :param room_id: The room id.
+        :param user_id: The user id.
+        :return: Whether the user is joined.
+        """
+        member = self.state.is_member(room_id, user_id)
+        if member is None:
+            return any(user.user_id == user_id
+                       for user in self.get_room_members(room_id))
+        return member
+
+    def _parse_members(self, res: dict) -> List[User]:
+        """Parse a /joined_members response."""
         if res:
             return [
-                User(i, avatar_url=res["joined"][i]["avatar_url"])
+                User(i,
+                     displayname=res["joined"][i].get("display_name"),
+                     avatar_url=res["joined"][i].get("avatar_url"))
                 for i in res["joined"]
             ]
         return []
@@ -437,42 +1030,73 @@ class Bot():
                                       ],  # only joins and messages
             to_t: str = "",
             from_t: str = "",
-            filter: str = "") -> List[Event]:
+            filter: Any = "") -> List[Event]:
         """
         Get the events of a room.
 
         :param room_id: The room id.
         :param direction: The direction of the events.
         :param limit: How many events to get.
-        :param only_events: Only get events of these types.
-        :param to_t: Get events before this timestamp.
-        :param from_t: Get events after this timestamp.
-        :param filter: Filter the events.
+        :param only_events: Only get events of these types, filtered by the homeserver.
+        :param to_t: Stop at this pagination token.
+        :param from_t: Start at this pagination token.
+        :param filter: A RoomEventFilter dict or JSON string, replaces only_events.
         :return: List of events.
         """
+        filter = self._room_event_filter(filter, only_events)
+        return self.get_room_events_page(room_id, from_t, direction, limit,
+                                         filter, to_t).events
+
+    def get_room_events_page(self,
+                             room_id: str,
+                             from_token: str = "",
+                             direction: str = "b",
+                             limit: int = 10,
+                             filter: Any = None,
+                             to_token: str = "") -> Room_Events_Page:
+        """
+        Get a page of room events with the tokens to get the next one.
 
-        params = {
-            "from": from_t,
-            "to": to_t,
-            "limit": limit,
-            "dir": direction,
-            "filter": filter
-        }
+        :param room_id: The room id.
+        :param from_token: Start at this pagination token, the latest event if empty.
+        :param direction: "b" for older events, "f" for newer events.
+        :param limit: How many events to get.
+        :param filter: A RoomEventFilter dict or JSON string, e.g. {"types": ["m.room.message"]}.
+        :param to_token: Stop at this pagination token.
+        :return: The page, its end token continues in the same direction. Encrypted events are decrypted if their room key is known.
+        """
         res = self._make_request("GET",
                                  f"/rooms/{quote(room_id)}/messages",
-                                 params=params)
-        if res:
-            if only_events:
-                events = [
-                    event for event in res["chunk"]
-                    if event["type"] in only_events
-                ]
-            else:
-                events = res["chunk"]
-
-            return parse_room_events(events)
-
-        return None
+                                 params=self._messages_params(
+                                     from_token, to_token, direction, limit,
+                                     filter))
+        page = self._parse_room_events_page(res)
+        if any(event.type == "m.room.encrypted" for event in page.events):
+            page.events = self.decryptor.decrypt_events(room_id, page.events)
+        return page
+
+    def _room_event_filter(self, filter: Any, only_events: List[str]) -> Any:
+        """Turn an only_events list into a server side filter."""
+        if filter or not only_events:
+            return filter
+        return {"types": list(only_events)}
+
+    def _messages_params(self, from_token: str, to_token: str, direction: str,
+                         limit: int, filter: Any) -> dict:
+        """Build the query parameters of /messages."""
+        params = {"dir": direction, "limit": limit}
+        if from_token: params["from"] = from_token
+        if to_token: params["to"] = to_token
+        if filter:
+            params["filter"] = filter if isinstance(
+                filter, str) else codec.dumps(filter).decode("UTF-8")
+        return params
+
+    def _parse_room_events_page(self, res: dict) -> Room_Events_Page:
+        """Parse a /messages response."""
+        return Room_Events_Page(events=parse_room_events(res.get("chunk", [])),
+                                start=res.get("start"),
+                                end=res.get("end"))
 
     def mark_as_read(self, room_id: str, event_id: str) -> dict:
         """
@@ -492,16 +1116,19 @@ class Bot():
         while self.run:
             sleep(1)
 
-    def upload_keys(self, device_id: str, keys: str) -> dict:
+    def upload_keys(self, device_keys: dict = None,
+                    one_time_keys: Mapping[str, dict] = None) -> dict:
         """
         Upload keys to the homeserver.
         https://matrix.org/docs/spec/client_server/r0.4.0#post-matrix-client-r0-keys-upload
 
-        :param device_id: The device id
-        :param keys: The keys to upload
-        :return: The response from the homeserver.
+        :param device_keys: Our signed device keys, see Olm.device_keys.
+        :param one_time_keys: Signed one time keys, see Olm.signed_one_time_keys.
+        :return: The response from the homeserver, with the one_time_key_counts.
         """
-        data = {"device_id": device_id, "keys": keys}
+        data = {}
+        if device_keys: data["device_keys"] = device_keys
+        if one_time_keys: data["one_time_keys"] = one_time_keys
         return self._make_request("POST", "/keys/upload", data=data)
 
     def query_keys(self,
@@ -517,13 +1144,54 @@ class Bot():
         :return: The response from the homeserver.
         """
         data = {"device_keys": device_keys, "timeout": timeout}
-        if since: data["since"] = since
+        if since: data["token"] = since
 
         res = self._make_request("POST", "/keys/query", data=data)
         if res:
             return parse_device_keys_response(res)
         return None
 
+    def _create_key_maintainer(self, target: int) -> OneTimeKeyMaintainer:
+        """Create the maintainer that keeps one time keys uploaded."""
+        return OneTimeKeyMaintainer(self.upload_keys, self.olm, target)
+
+    def _create_device_store(self) -> DeviceStore:
+        """Create the device key cache behind get_device_keys."""
+        return DeviceStore(self._query_device_keys, self.device_verifier)
+
+    def _query_device_keys(self, user_ids: List[str]) -> Device_Keys_Response:
+        """Query all device keys of users, used by the device store."""
+        return self.query_keys({user_id: [] for user_id in user_ids},
+                               since=self.state.next_batch)
+
+    def get_device_keys(self, user_ids: List[str]) -> Mapping[str, Devices]:
+        """
+        Get the device keys of users from the device store.
+
+        Only users that aren't cached yet or whose devices changed (see
+        update_device_lists) are queried, together in batches.
+
+        :param user_ids: The user ids, their device lists are tracked from now on.
+        :return: The device keys, keyed by user id and device id.
+        """
+        return self.devices.get(user_ids)
+
+    def _known_devices(self, user_id: str) -> Devices:
+        """Get the cached device keys of a user, without querying."""
+        return self.devices.cached([user_id]).get(user_id, {})
+
+    def update_device_lists(self, from_token: str, to_token: str = "") -> None:
+        """
+        Mark the users whose devices changed between two sync tokens as outdated, e.g. after a restart.
+
+        Incremental syncs do this on their own.
+
+        :param from_token: The next_batch token of an earlier sync.
+        :param to_token: The next_batch token of a recent sync, the current one if empty.
+        """
+        res = self.keys_changes(from_token, to_token or self.state.next_batch)
+        self.devices.update(res.get("changed", []), res.get("left", []))
+
     def claim_keys(self,
                    keys: Mapping[str, Mapping[str, str]],
                    timeout: int = 10000) -> dict:
@@ -538,6 +1206,137 @@ class Bot():
         data = {"device_keys": keys, "timeout": timeout}
         return self._make_request("POST", "/keys/claim", data=data)
 
+    def send_to_device(self, event_type: str,
+                       messages: Mapping[str, Mapping[str, dict]]) -> dict:
+        """
+        Send events to devices.
+
+        :param event_type: The event type.
+        :param messages: The contents, keyed by user id and device id ("*" for all devices).
+        :return: The response from the homeserver.
+        """
+        path = f"/sendToDevice/{quote(event_type)}/{quote(self._make_txn_id())}"
+        return self._make_request("PUT", path, {"messages": messages})
+
+    def _rotation_settings(self, room_id: str) -> Tuple[int, float]:
+        """Get the Megolm rotation settings of a room from its m.room.encryption event."""
+        room = self.state.get_room(room_id)
+        for event in (room.state.get("events", []) if room else []):
+            if event.get("type") == "m.room.encryption":
+                content = event.get("content") or {}
+                period = content.get("rotation_period_ms")
+                return content.get("rotation_period_msgs"), period / 1000 if period else None
+        return None, None
+
+    def _unshared_devices(self, outbound: Outbound_Group_Session,
+                          devices: Mapping[str, Mapping[str, Device_Keys]]) -> Dict[Tuple[str, str], Device_Keys]:
+        """Get the devices that don't have the key of an outbound session yet."""
+        return {(user_id, device_id): keys
+                for user_id, user_devices in devices.items()
+                for device_id, keys in user_devices.items()
+                if f"{user_id}|{device_id}" not in outbound.shared_with and
+                (user_id, device_id) != (self.olm.user_id, self.olm.device_id)}
+
+    def _olm_claims(self, devices: Mapping[Tuple[str, str], Device_Keys]) -> dict:
+        """Build the /keys/claim request for the devices without an Olm session."""
+        claims = {}
+        for (user_id, device_id), keys in devices.items():
+            curve = (keys.keys or {}).get(f"curve25519:{device_id}")
+            if curve and not self.olm.get_olm_sessions(curve):
+                claims.setdefault(user_id, {})[device_id] = "signed_curve25519"
+        return claims
+
+    def _create_olm_sessions(self, res: dict,
+                             devices: Mapping[Tuple[str, str], Device_Keys]) -> None:
+        """Start Olm sessions with the one time keys of a /keys/claim response."""
+        for user_id, user_keys in (res.get("one_time_keys") or {}).items():
+            for device_id, one_time_keys in user_keys.items():
+                keys = devices.get((user_id, device_id))
+                if keys is None:
+                    continue
+                curve = keys.keys.get(f"curve25519:{device_id}")
+                ed25519 = keys.keys.get(f"ed25519:{device_id}")
+                for key in one_time_keys.values():
+                    # the key must be signed by the device, skip it otherwise
+                    if check_one_time_key_signature(key, user_id, device_id, ed25519):
+                        self.olm.create_olm_session(curve, key["key"])
+                    break
+
+    def _room_key_messages(self, room_id: str,
+                           devices: Mapping[Tuple[str, str], Device_Keys],
+                           outbound: Outbound_Group_Session) -> Tuple[dict, List[str]]:
+        """Encrypt the key of an outbound session for every device with an Olm session."""
+        room_key = self.olm.room_key_content(room_id, outbound)
+        own_keys = self.olm.get_identity_keys()
+        messages, shared = {}, []
+        for (user_id, device_id), keys in devices.items():
+            curve = keys.keys.get(f"curve25519:{device_id}")
+            if not curve or not self.olm.get_olm_sessions(curve):
+                continue  # no one time key left, try again next time
+            payload = {
+                "type": "m.room_key",
+                "content": room_key,
+                "sender": self.olm.user_id,
+                "sender_device": self.olm.device_id,
+                "keys": {"ed25519": own_keys["ed25519"]},
+                "recipient": user_id,
+                "recipient_keys": {"ed25519": keys.keys.get(f"ed25519:{device_id}")}
+            }
+            messages.setdefault(user_id, {})[device_id] = {
+                "algorithm": "m.olm.v1.curve25519-aes-sha2",
+                "sender_key": own_keys["curve25519"],
+                "ciphertext": {curve: self.olm.encrypt_olm(curve, payload)}
+            }
+            shared.append(f"{user_id}|{device_id}")
+        return messages, shared
+
+    def share_room_key(self, room_id: str,
+                       outbound: Outbound_Group_Session = None) -> Outbound_Group_Session:
+        """
+        Send the key of the outbound Megolm session of a room to the member devices that don't have it yet.
+
+        :param room_id: The room id.
+        :param outbound: The session to share, the current one of the room if not given.
+        :return: The shared session.
+        """
+        if not self.olm.active:
+            self.olm.load_or_create()
+        outbound = outbound or self.olm.get_outbound_group_session(room_id, *self._rotation_settings(room_id))
+        members = [user.user_id for user in self.get_room_members(room_id)]
+        devices = self._unshared_devices(outbound, self.get_device_keys(members))
+        if not devices:
+            return outbound
+
+        claims = self._olm_claims(devices)
+        if claims:
+            self._create_olm_sessions(self.claim_keys(claims), devices)
+        messages, shared = self._room_key_messages(room_id, devices, outbound)
+        if messages:
+            self.send_to_device("m.room.encrypted", messages)
+            self.olm.mark_shared(room_id, shared, outbound)
+        return outbound
+
+    def send_encrypted(self, room_id: str, event_type: str, content: Dict) -> dict:
+        """
+        Send an event to an encrypted room.
+
+        The room key is only sent to devices that don't have it yet, so
+        usually this is one Megolm encryption and one request.
+
+        :param room_id: The room id.
+        :param event_type: The event type.
+        :param content: The event content.
+        :return: The response from the homeserver.
+        """
+        if not self.olm.active:
+            self.olm.load_or_create()
+        # share and encrypt with the same session, a rotation or a discard in between
+        # would encrypt with a session no device received
+        outbound = self.olm.get_outbound_group_session(room_id, *self._rotation_settings(room_id))
+        self.share_room_key(room_id, outbound)
+        encrypted = self.olm.get_encrypted_content(room_id, event_type, content, outbound=outbound)
+        return self.send_room_event(room_id, "m.room.encrypted", encrypted)
+
     def keys_changes(self, from_token: str, to_token: str) -> dict:
         """
         Get the changes in keys.
@@ -570,8 +1369,9 @@ class Bot():
         data = {"via": via, "suggested": suggested, "auto_join": auto_join}
 
         res = self._make_request(
-            "POST",
-            f"/rooms/{quote(space_id)}/state/m.space.child/{quote(room_id)}")
+            "PUT",
+            f"/rooms/{quote(space_id)}/state/m.space.child/{quote(room_id)}",
+            data)
         if res:
             return parse_event(res)
         return None
@@ -579,13 +1379,22 @@ class Bot():
     def media_upload(self,
                      content: Any,
                      content_type: str,
-                     filename: str = None) -> Dict:
+                     filename: str = None,
+                     progress: Progress = None,
+                     chunked: bool = False,
+                     chunk_size: int = CHUNK_SIZE) -> Dict:
         """
         Upload media to the homeserver.
 
-        :param content: The content to upload.
+        Paths, file objects and mmaps are streamed, so the content is never
+        read into memory all at once.
+
+        :param content: The content to upload: bytes, a path (pathlib.Path), a binary file object, a mmap or an iterator of bytes.
         :param content_type: The content type
         :param filename: The filename
+        :param progress: Called with the bytes sent so far and the total size.
+        :param chunked: Use chunked transfer encoding instead of sending the size first.
+        :param chunk_size: How many bytes to read at once.
         :return: The response from the homeserver.
         """
 
@@ -593,9 +1402,172 @@ class Bot():
         if filename: query_params['filename'] = filename
         headers = {'Content-Type': content_type}
 
-        return self._make_request("POST",
-                                  "/upload",
-                                  raw_data=content,
-                                  params=query_params,
-                                  headers=headers,
-                                  API_path="/_matrix/media/r0")
+        raw = content if isinstance(content, (bytes, str)) else None
+        if progress or chunked or raw is None:
+            content = UploadStream(content, chunk_size, progress, chunked)
+
+        res = self._make_request("POST",
+                                 "/upload",
+                                 raw_data=content,
+                                 params=query_params,
+                                 headers=headers,
+                                 API_path="/_matrix/media/r0")
+        self._cache_upload(res, raw)
+        return res
+
+    def _cache_upload(self, res: dict, content: Any) -> None:
+        """Cache uploaded bytes, so downloading them again doesn't hit the homeserver."""
+        if self.media_cache is not None and content is not None and res.get("content_uri"):
+            if isinstance(content, str): content = content.encode("UTF-8")
+            self.media_cache.put(MediaCache.key(res["content_uri"]), content)
+
+    def iter_media(self,
+                   mxc_uri: str,
+                   offset: int = 0,
+                   progress: Progress = None,
+                   chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+        """
+        Download media in chunks.
+
+        A broken download continues with a range request where it stopped.
+
+        :param mxc_uri: The mxc:// uri of the media.
+        :param offset: Start at this byte, to resume an earlier download.
+        :param progress: Called with the bytes received so far (including the offset) and the total size.
+        :param chunk_size: How many bytes to read at once.
+        :return: An iterator over the chunks.
+        """
+        return self._iter_media(self._media_endpoint("download", mxc_uri), {},
+                                offset, progress, chunk_size)
+
+    def _media_endpoint(self, kind: str, mxc_uri: str) -> str:
+        """Build the download or thumbnail endpoint of a mxc uri."""
+        server_name, media_id = parse_mxc(mxc_uri)
+        return f"/{kind}/{quote(server_name)}/{quote(media_id)}"
+
+    def _iter_media(self, endpoint: str, params: dict, offset: int,
+                    progress: Progress, chunk_size: int) -> Iterator[bytes]:
+        """Stream a media endpoint, see iter_media."""
+        headers, params = self._prepare_request("GET", params, {}, False)
+        done = offset
+
+        for attempt in range(self.max_retries + 1):
+            if done: headers["Range"] = f"bytes={done}-"
+            try:
+                r = self._request("GET", endpoint, None, params, headers,
+                                  "/_matrix/media/r0", stream=True)
+            except MatrixError as e:
+                if e.status_code == 416:
+                    return  # there is nothing after the offset
+                raise
+
+            with r:
+                start, total = self._content_range(r.status_code, r.headers, done)
+                skip = done - start
+                try:
+                    for chunk in r.iter_content(chunk_size):
+                        # the homeserver ignored the range, drop what we have
+                        if skip:
+                            dropped = min(skip, len(chunk))
+                            chunk, skip = chunk[dropped:], skip - dropped
+                            if not chunk: continue
+                        done += len(chunk)
+                        if progress: progress(done, total)
+                        yield chunk
+                except requests.exceptions.RequestException:
+                    if attempt == self.max_retries:
+                        raise
+                    continue
+            return
+
+    def _content_range(self, status_code: int, headers: Mapping[str, str],
+                       offset: int) -> Tuple[int, int]:
+        """Get the first byte and the total size of a media download."""
+        if status_code == 206:
+            start, total = parse_content_range(headers.get("Content-Range"))
+            if start is not None:
+                return start, total
+        length = headers.get("Content-Length")
+        return 0, int(length) if length is not None else None
+
+    def media_download(self,
+                       mxc_uri: str,
+                       file: Any = None,
+                       resume: bool = False,
+                       progress: Progress = None,
+                       chunk_size: int = CHUNK_SIZE) -> Any:
+        """
+        Download media, streamed so memory use doesn't grow with the file size.
+
+        :param mxc_uri: The mxc:// uri of the media.
+        :param file: A path or a binary file object to write to, without one an iterator over the chunks is returned.
+        :param resume: Continue a partial download, paths are downloaded to path + ".part" first and resumed from there, file objects from their position.
+        :param progress: Called with the bytes received so far and the total size.
+        :param chunk_size: How many bytes to read at once.
+        :return: The size of the file, or the chunk iterator.
+        """
+        if self.media_cache is not None:
+            return self._cached_media(MediaCache.key(mxc_uri),
+                                      self._media_endpoint("download", mxc_uri),
+                                      {}, file, progress, chunk_size)
+
+        if file is None:
+            return self.iter_media(mxc_uri, progress=progress, chunk_size=chunk_size)
+
+        if isinstance(file, (str, os.PathLike)):
+            if not resume:
+                with open(file, "wb") as f:
+                    return self.media_download(mxc_uri, f, False, progress, chunk_size)
+            # keep partial downloads apart, so an unrelated file is never appended to
+            part = os.fspath(file) + ".part"
+            with open(part, "ab") as f:
+                size = self.media_download(mxc_uri, f, True, progress, chunk_size)
+            os.replace(part, file)
+            return size
+
+        offset = file.tell() if resume else 0
+        for chunk in self.iter_media(mxc_uri, offset, progress, chunk_size):
+            file.write(chunk)
+            offset += len(chunk)
+        return offset
+
+    def get_thumbnail(self,
+                      mxc_uri: str,
+                      width: int,
+                      height: int,
+                      method: str = "scale",
+                      file: Any = None,
+                      progress: Progress = None,
+                      chunk_size: int = CHUNK_SIZE) -> Any:
+        """
+        Download a thumbnail of media.
+
+        :param mxc_uri: The mxc:// uri of the media.
+        :param width: The desired width.
+        :param height: The desired height.
+        :param method: "crop" or "scale".
+        :param file: A path or a binary file object to write to, without one an iterator over the chunks is returned.
+        :param progress: Called with the bytes received so far and the total size.
+        :param chunk_size: How many bytes to read at once.
+        :return: The size of the thumbnail, or the chunk iterator.
+        """
+        endpoint = self._media_endpoint("thumbnail", mxc_uri)
+        params = {"width": width, "height": height, "method": method}
+        if self.media_cache is not None:
+            return self._cached_media(
+                MediaCache.key(mxc_uri, width, height, method), endpoint,
+                params, file, progress, chunk_size)
+
+        chunks = self._iter_media(endpoint, params, 0, progress, chunk_size)
+        return chunks if file is None else write_chunks(chunks, file)
+
+    def _cached_media(self, key: str, endpoint: str, params: dict, file: Any,
+                      progress: Progress, chunk_size: int) -> Any:
+        """Serve media from the cache, a miss streams the download into the cache while passing it on."""
+        cached = self.media_cache.open(key)
+        if cached is None:
+            chunks = self.media_cache.fill(
+                key, self._iter_media(endpoint, params, 0, progress, chunk_size))
+        else:
+            chunks = iter_file(cached, chunk_size)
+        return chunks if file is None else write_chunks(chunks, file)
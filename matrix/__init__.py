@@ -27,6 +27,21 @@ from .client import *
 from .parsers import *
 from .utils import *
 from .e2ee import *
+from .store import *
+from .storage import *
+from .async_api import *
+from .scheduler import *
+from .filters import *
+from .ratelimit import *
+from .outbound import *
+from .runner import *
+from .media import *
+from .history import *
+from .devices import *
+from .crypto_store import *
+from .decryption import *
+from .keys import *
+from .metrics import *
 
 class VersionInfo(NamedTuple):
     major: int
@@ -0,0 +1,828 @@
+from .API import Bot, quote
+from .classes import Authentication, Device_Keys_Response, Event, Room_Events_Page, Room_Preset, User
+from .parsers import parse_event, parse_device_keys_response
+from .exceptions import *
+from .store import RoomStore
+from .outbound import AsyncSendQueue
+from .devices import AsyncDeviceStore
+from .keys import AsyncOneTimeKeyMaintainer
+from .metrics import endpoint_template
+from .e2ee import Outbound_Group_Session
+from .media import CHUNK_SIZE, MediaCache, Progress, UploadStream, aiter_file, awrite_chunks
+from . import codec
+from typing import Any, AsyncIterator, Dict, List, Mapping
+import os
+from time import perf_counter, time
+import asyncio
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+def create_session(pool_connections: int = 10,
+                   pool_maxsize: int = 10,
+                   keep_alive: bool = True,
+                   stats: Dict[str, int] = None) -> "aiohttp.ClientSession":
+    """
+    Create a pooled aiohttp session, can be shared by several AsyncBots.
+
+    Must be called from a running event loop.
+
+    :param pool_connections: How many hosts to keep connection pools for.
+    :param pool_maxsize: How many connections to keep open per host.
+    :param keep_alive: Reuse connections between requests.
+    :param stats: Count requests, opened and reused connections in this dict.
+    :return: The session.
+    """
+    # aiohttp never opens more than the limits, it waits for a
+    # free connection instead
+    connector = aiohttp.TCPConnector(limit=pool_connections * pool_maxsize,
+                                     limit_per_host=pool_maxsize,
+                                     force_close=not keep_alive)
+
+    trace_configs = []
+    if stats is not None:
+        trace = aiohttp.TraceConfig()
+        trace.on_request_start.append(_count(stats, "requests"))
+        trace.on_connection_create_end.append(_count(stats, "opened"))
+        trace.on_connection_reuseconn.append(_count(stats, "reused"))
+        trace_configs.append(trace)
+
+    return aiohttp.ClientSession(connector=connector,
+                                 trace_configs=trace_configs)
+
+
+def _count(stats: Dict[str, int], key: str):
+    """Build a trace callback incrementing a connection counter."""
+
+    async def count(session, context, params) -> None:
+        stats[key] = stats.get(key, 0) + 1
+
+    return count
+
+
+class AsyncBot(Bot):
+    """
+    Asynchronous version of Bot, backed by an aiohttp session.
+
+    Every method that talks to the homeserver is a coroutine. Methods
+    that return the homeserver response unchanged (send_room_event,
+    join_room, leave_room, invite_to_room, upload_keys, ...) are
+    inherited from Bot and return awaitables as well, as do create_space
+    and get_device_keys.
+    """
+
+    def __init__(self, *args, session: "aiohttp.ClientSession" = None, **kwargs) -> None:
+        """
+        Initialize the client, takes the same arguments as Bot.
+
+        :param session: Share this session (see create_session) instead of creating one, it is not closed with the bot.
+        """
+        if aiohttp is None:
+            raise ImportError(
+                "AsyncBot requires aiohttp, install it with `pip install matrix-chat[async]`"
+            )
+
+        super().__init__(*args, **kwargs)
+        self.sync_task = None
+        self.stats = {"requests": 0, "opened": 0, "reused": 0}
+        self.shared_session = session is not None
+        if self.shared_session:
+            self.session = session
+
+    _transport_errors = (asyncio.TimeoutError, OSError, ParsingError) + (
+        (aiohttp.ClientError, ) if aiohttp else ())
+
+    def _create_session(self) -> None:
+        """The aiohttp session needs a running loop, see _get_session."""
+        return None
+
+    def _get_session(self) -> "aiohttp.ClientSession":
+        """Get the pooled HTTP session, creating it on first use."""
+        if not self.shared_session and (self.session is None
+                                        or self.session.closed):
+            self.session = create_session(self.pool_connections,
+                                          self.pool_maxsize, self.keep_alive,
+                                          self.stats)
+        return self.session
+
+    def close_session(self) -> None:
+        """Close all pooled connections once the loop gets to it."""
+        if self.shared_session:
+            return
+        if self.session and not self.session.closed:
+            try:
+                asyncio.get_running_loop().create_task(self.session.close())
+            except RuntimeError:
+                pass
+
+    def connection_stats(self) -> Dict[str, int]:
+        """
+        Get connection statistics, to check that connections are reused.
+
+        :return: The number of requests, opened and reused connections.
+        """
+        return dict(self.stats)
+
+    async def close(self) -> None:
+        """Stop syncing and close the HTTP session."""
+        self.stop()
+        if self.sync_task:
+            self.sync_task.cancel()
+        if self.session and not self.shared_session:
+            await self.session.close()
+
+    async def _make_request(self,
+                            method: str,
+                            endpoint: str,
+                            data: dict = {},
+                            params: dict = {},
+                            skip_auth_check: bool = False,
+                            API_path: str = "/_matrix/client/r0",
+                            raw_data: Any = None,
+                            headers: Dict[str, str] = {},
+                            timeout: float = None) -> dict:
+        """
+        Make a request to the homeserver.
+
+        :param method: HTTP method
+        :param endpoint: Endpoint
+        :param data: JSON data to send
+        :param params: Parameters
+        :param skip_auth_check: Skip the auth check
+        :param API_path: API path
+        :param raw_data: Raw data
+        :param headers: HTTP Headers
+        :param timeout: Client side timeout in seconds
+        :return: Response from the homeserver
+        """
+        headers, params = self._prepare_request(method, params, headers,
+                                                skip_auth_check)
+        if headers is None:
+            return None
+
+        body = codec.dumps(data) if raw_data is None else raw_data
+        r = await self._request(method, endpoint, body, params, headers,
+                                API_path, timeout)
+        try:
+            content = await r.read()
+            self._record_bytes(endpoint, len(content))
+            return self._parse_response(content, r.status)
+        finally:
+            r.release()
+
+    async def _request(self,
+                       method: str,
+                       endpoint: str,
+                       body: Any,
+                       params: dict,
+                       headers: Dict[str, str],
+                       API_path: str,
+                       timeout: float = None) -> "aiohttp.ClientResponse":
+        """
+        Send a prepared request, retrying it when the homeserver rate limits it.
+
+        :param method: HTTP method
+        :param endpoint: Endpoint
+        :param body: The request body, bytes or a media.UploadStream
+        :param params: Parameters
+        :param headers: HTTP Headers
+        :param API_path: API path
+        :param timeout: Client side timeout in seconds
+        :return: The successful response, the caller has to release it.
+        """
+        # aiohttp only accepts str, int and float query parameters
+        params = {
+            k: str(v).lower() if isinstance(v, bool) else v
+            for k, v in params.items() if v is not None
+        }
+
+        # without a timeout the session default applies
+        extra = {"timeout": aiohttp.ClientTimeout(total=timeout)} if timeout else {}
+
+        bucket = self.rate_limiter.bucket(endpoint, API_path)
+
+        for attempt in range(self.max_retries + 1):
+            delay = bucket.reserve()
+            if delay > 0: await asyncio.sleep(delay)
+
+            data, request_headers = body, headers
+            if isinstance(body, UploadStream):
+                data = body.__aiter__()
+                if not body.chunked:
+                    request_headers = {**headers, "Content-Length": str(body.total)}
+
+            start = perf_counter()
+            try:
+                r = await self._get_session().request(
+                    method.upper(),
+                    f"{self.base}{API_path}{endpoint}",
+                    params=params,
+                    data=data,
+                    headers=request_headers,
+                    **extra)
+            except Exception:
+                self._record_response(method, endpoint, "error", start)
+                raise
+            self._record_response(method, endpoint, r.status, start)
+            if r.status >= 400:
+                try:
+                    self._parse_response(await r.read(), r.status)
+                except RateLimited as e:
+                    bucket.limited(self._retry_after(e, attempt))
+                    if attempt == self.max_retries or not self._can_resend(body):
+                        raise
+                    if self.metrics.enabled:
+                        self._retries.inc(endpoint=endpoint_template(endpoint))
+                    continue
+                finally:
+                    r.release()
+
+            bucket.succeeded()
+            return r
+
+    async def login(self,
+                    start_syncing: bool = True,
+                    device_id: str = "") -> Authentication:
+        """
+        Login to the homeserver.
+
+        :param start_syncing: Start the sync task.
+        :param device_id: The device id.
+        :return: The authentication object.
+        """
+        data = {
+            "type": "m.login.password",
+            "user": self.user,
+            "password": self.pwd
+        }
+
+        if device_id: data["device_id"] = device_id
+
+        r = await self._make_request("POST",
+                                     "/login",
+                                     data,
+                                     skip_auth_check=True)
+        if r:
+            self._set_auth(r)
+            if start_syncing: await self.start_sync()
+            return self.auth
+
+    async def register(self, start_syncing: bool = True) -> Authentication:
+        """
+        Register a new user.
+
+        :param start_syncing: Start the sync task.
+        :return: The authentication object.
+        """
+        data = {
+            "username": self.user,
+            "password": self.pwd,
+            "auth": {
+                "type": "m.login.dummy"
+            }
+        }
+        r = await self._make_request("POST",
+                                     "/register",
+                                     data,
+                                     skip_auth_check=True)
+        if r:
+            self._set_auth(r)
+            if start_syncing: await self.start_sync()
+            return self.auth
+
+    async def start_sync(self) -> None:
+        """Do the initial sync and start the sync task."""
+        if not self.restore():
+            await self.sync(set_as_new=True)
+        self.sync_task = asyncio.ensure_future(self.sync_forever())
+
+    async def sync_forever(self) -> None:
+        """Sync until the bot is stopped, retrying failed syncs."""
+        while self.run:
+            try:
+                if self.incremental_sync and self.state.next_batch:
+                    await self.sync(since=self.state.next_batch)
+                else:
+                    await asyncio.sleep(self.sync_delay)
+                    await self.sync(set_as_new=True)
+            except Exception as e:
+                if not self.run:
+                    return
+                await asyncio.sleep(self._sync_failed(e))
+            else:
+                self.sync_failures = 0
+
+    async def run_forever(self) -> None:
+        """Run the client forever."""
+        while self.run:
+            await asyncio.sleep(1)
+
+    async def sync(self,
+                   since: str = "",
+                   set_as_new: bool = False) -> RoomStore:
+        """
+        Sync the client state.
+
+        :param since: The token to sync from.
+        :param set_as_new: Forget the stored rooms before applying the response.
+        :return: The room store.
+        """
+        start = perf_counter()
+        params, timeout = self._sync_params(since, await
+                                            self.get_sync_filter_id())
+        res = await self._make_request("GET",
+                                       "/sync", {},
+                                       params=params,
+                                       timeout=timeout)
+
+        processing = perf_counter()
+        self._merge_sync(res, initial=set_as_new or not since)
+        if self.decryptor.needed(self.last_delta):
+            senders = self.decryptor.senders(self.last_delta)
+            if senders:
+                try:
+                    await self.get_device_keys(senders)
+                except Exception as e:
+                    self._device_query_failed(senders, e)
+            # decrypting a busy room takes a while, keep it off the event loop
+            await asyncio.get_running_loop().run_in_executor(
+                None, self.decryptor.decrypt_delta, self.last_delta)
+            self.state.replace_events(self.last_delta.timeline)
+        state = self._finish_sync()
+        self._sync_processing_seconds.observe(perf_counter() - processing)
+        self._sync_seconds.observe(perf_counter() - start)
+        return state
+
+    async def upload_filter(self, filter: dict) -> str:
+        """
+        Upload a filter, filters that were uploaded before are not uploaded again.
+
+        :param filter: The filter, see filters.make_sync_filter.
+        :return: The filter id.
+        """
+        key, filter_id = self._cached_filter_id(filter)
+        if filter_id:
+            return filter_id
+
+        res = await self._make_request(
+            "POST", f"/user/{quote(self.auth.user_id)}/filter", filter)
+        return self._remember_filter_id(key, res["filter_id"])
+
+    async def get_sync_filter_id(self) -> str:
+        """
+        Get the filter to pass to /sync, uploading sync_filter if needed.
+
+        :return: The filter id or JSON filter, None if there is no filter.
+        """
+        if not self.sync_filter or isinstance(self.sync_filter, str):
+            return self.sync_filter
+        return await self.upload_filter(self.sync_filter)
+
+    async def create_room(self,
+                          alias: str = "",
+                          preset: str = Room_Preset.public_chat,
+                          topic: str = "",
+                          invite: List[str] = [],
+                          creation_content: Dict = {},
+                          initial_state: List[Event] = [],
+                          visibility: str = "private",
+                          power_level_content_override: Dict = {}) -> str:
+        """
+        Create a new room.
+
+        :param alias: Room alias
+        :param preset: Room preset from classes.Room_Preset.
+        :param topic: Room topic
+        :param invite: List of user IDs to invite
+        :param creation_content: Room creation content
+        :param initial_state: Initial state
+        :param visibility: Room visibility
+        :param power_level_content_override: Override the default power levels.
+        :return: Room ID
+        """
+        data = self._create_room_data(alias, preset, topic, invite,
+                                      creation_content, initial_state,
+                                      visibility, power_level_content_override)
+        res = await self._make_request("POST", "/createRoom", data)
+        return res.get("room_id")
+
+    async def send_message(self,
+                           room_id: str,
+                           message: str,
+                           msgtype: str = "m.text",
+                           format: str = "",
+                           formatted_body: str = "",
+                           url: str = "",
+                           info: Dict = {}) -> Event:
+        """
+        Send a message to a room.
+
+        :param room_id: Room ID
+        :param message: Message text
+        :param msgtype: Message type
+        :param format: Message format
+        :param formatted_body: Message formatted body
+        :param url: URL, only for m.image, m.file, m.audio, m.video
+        :param info: Additional info, only for m.image, m.file, m.audio, m.video
+        :return: Event object
+        """
+        data = self._message_content(message, msgtype, format, formatted_body,
+                                     url, info)
+        res = await self.send_room_event(room_id, "m.room.message", data)
+        return Event(res["event_id"], timestamp=time())
+
+    def _create_send_queue(self) -> AsyncSendQueue:
+        """Create the queue behind enqueue_send, enqueue_send must be called from the event loop."""
+        return AsyncSendQueue(self.send_room_event, self.max_in_flight)
+
+    async def flush_sends(self) -> None:
+        """Wait until every queued event was sent or failed."""
+        if self.send_queue is not None:
+            await self.send_queue.flush()
+
+    async def get_room_id(self, room_alias: str) -> str:
+        """
+        Get the room id from a room alias.
+
+        :param room_alias: The room alias.
+        :return: The room id.
+        """
+        content = await self._make_request(
+            "GET", "/directory/room/{}".format(quote(room_alias)))
+        return content.get("room_id", None) if content else None
+
+    async def get_room_members(self, room_id: str, refresh: bool = False) -> List[User]:
+        """
+        Get the members of a room, see Bot.get_room_members.
+
+        :param room_id: The room id.
+        :param refresh: Fetch the members from the homeserver even if they are cached.
+        :return: List of users.
+        """
+        members = None if refresh else self.state.get_members(room_id)
+        if members is None:
+            res = await self._make_request(
+                "GET", f"/rooms/{quote(room_id)}/joined_members")
+            members = self._parse_members(res)
+            self.state.set_members(room_id, members)
+        return members
+
+    async def is_room_member(self, room_id: str, user_id: str) -> bool:
+        """
+        Check if a user is a joined member of a room, from the member cache if possible.
+
+        :param room_id: The room id.
+        :param user_id: The user id.
+        :return: Whether the user is joined.
+        """
+        member = self.state.is_member(room_id, user_id)
+        if member is None:
+            return any(user.user_id == user_id
+                       for user in await self.get_room_members(room_id))
+        return member
+
+    async def whoami(self) -> User:
+        """
+        Get the user info.
+
+        :return: The user object.
+        """
+        res = await self._make_request("GET", "/account/whoami")
+        return User(res["user_id"], res["device_id"],
+                    res["org.matrix.msc3069.is_guest"]) if res else None
+
+    async def get_room_events(
+            self,
+            room_id: str,
+            direction: str = "b",
+            limit: int = 10,
+            only_events: List[str] = ["m.room.message", "m.room.member"],
+            to_t: str = "",
+            from_t: str = "",
+            filter: Any = "") -> List[Event]:
+        """
+        Get the events of a room.
+
+        :param room_id: The room id.
+        :param direction: The direction of the events.
+        :param limit: How many events to get.
+        :param only_events: Only get events of these types, filtered by the homeserver.
+        :param to_t: Stop at this pagination token.
+        :param from_t: Start at this pagination token.
+        :param filter: A RoomEventFilter dict or JSON string, replaces only_events.
+        :return: List of events.
+        """
+        filter = self._room_event_filter(filter, only_events)
+        page = await self.get_room_events_page(room_id, from_t, direction,
+                                               limit, filter, to_t)
+        return page.events
+
+    async def get_room_events_page(self,
+                                   room_id: str,
+                                   from_token: str = "",
+                                   direction: str = "b",
+                                   limit: int = 10,
+                                   filter: Any = None,
+                                   to_token: str = "") -> Room_Events_Page:
+        """
+        Get a page of room events with the tokens to get the next one.
+
+        :param room_id: The room id.
+        :param from_token: Start at this pagination token, the latest event if empty.
+        :param direction: "b" for older events, "f" for newer events.
+        :param limit: How many events to get.
+        :param filter: A RoomEventFilter dict or JSON string, e.g. {"types": ["m.room.message"]}.
+        :param to_token: Stop at this pagination token.
+        :return: The page, its end token continues in the same direction. Encrypted events are decrypted if their room key is known.
+        """
+        res = await self._make_request("GET",
+                                       f"/rooms/{quote(room_id)}/messages",
+                                       params=self._messages_params(
+                                           from_token, to_token, direction,
+                                           limit, filter))
+        page = self._parse_room_events_page(res)
+        if any(event.type == "m.room.encrypted" for event in page.events):
+            page.events = await asyncio.get_running_loop().run_in_executor(
+                None, self.decryptor.decrypt_events, room_id, page.events)
+        return page
+
+    async def query_keys(self,
+                         device_keys: Mapping[str, List[str]],
+                         timeout: int = 10000,
+                         since: str = "") -> Device_Keys_Response:
+        """
+        Query keys from the homeserver.
+
+        :param device_keys: The device keys to query.
+        :param timeout: The timeout in milliseconds.
+        :return: The response from the homeserver.
+        """
+        data = {"device_keys": device_keys, "timeout": timeout}
+        if since: data["token"] = since
+
+        res = await self._make_request("POST", "/keys/query", data=data)
+        if res:
+            return parse_device_keys_response(res)
+        return None
+
+    def _create_key_maintainer(self, target: int) -> AsyncOneTimeKeyMaintainer:
+        """Create the maintainer that keeps one time keys uploaded, in tasks on the event loop."""
+        return AsyncOneTimeKeyMaintainer(self.upload_keys, self.olm, target)
+
+    def _create_device_store(self) -> AsyncDeviceStore:
+        """Create the device key cache behind get_device_keys, whose get is a coroutine."""
+        return AsyncDeviceStore(self._query_device_keys, self.device_verifier)
+
+    async def update_device_lists(self, from_token: str, to_token: str = "") -> None:
+        """
+        Mark the users whose devices changed between two sync tokens as outdated, see Bot.update_device_lists.
+
+        :param from_token: The next_batch token of an earlier sync.
+        :param to_token: The next_batch token of a recent sync, the current one if empty.
+        """
+        res = await self.keys_changes(from_token, to_token
+                                      or self.state.next_batch)
+        self.devices.update(res.get("changed", []), res.get("left", []))
+
+    async def add_room_to_space(self,
+                                space_id: str,
+                                room_id: str,
+                                via: List[str],
+                                suggested: bool = False,
+                                auto_join: bool = False) -> Event:
+        """
+        Add a room to a space.
+
+        :param space_id: The space id
+        :param room_id: The room id
+        :param via: List of servers (["matrix.org", "matrix.example.org"])
+        :param suggested: Whether the room is suggested
+        :param auto_join: Whether the room should be auto joined
+        :return: The event
+        """
+        data = {"via": via, "suggested": suggested, "auto_join": auto_join}
+
+        res = await self._make_request(
+            "PUT",
+            f"/rooms/{quote(space_id)}/state/m.space.child/{quote(room_id)}",
+            data)
+        if res:
+            return parse_event(res)
+        return None
+
+    async def media_upload(self,
+                           content: Any,
+                           content_type: str,
+                           filename: str = None,
+                           progress: Progress = None,
+                           chunked: bool = False,
+                           chunk_size: int = CHUNK_SIZE) -> Dict:
+        """
+        Upload media to the homeserver, see Bot.media_upload.
+
+        :param content: The content to upload: bytes, a path (pathlib.Path), a binary file object, a mmap or an iterator of bytes.
+        :param content_type: The content type
+        :param filename: The filename
+        :param progress: Called with the bytes sent so far and the total size.
+        :param chunked: Use chunked transfer encoding instead of sending the size first.
+        :param chunk_size: How many bytes to read at once.
+        :return: The response from the homeserver.
+        """
+        query_params = {}
+        if filename: query_params['filename'] = filename
+        headers = {'Content-Type': content_type}
+
+        raw = content if isinstance(content, (bytes, str)) else None
+        if progress or chunked or raw is None:
+            content = UploadStream(content, chunk_size, progress, chunked)
+
+        res = await self._make_request("POST",
+                                       "/upload",
+                                       raw_data=content,
+                                       params=query_params,
+                                       headers=headers,
+                                       API_path="/_matrix/media/r0")
+        self._cache_upload(res, raw)
+        return res
+
+    def iter_media(self,
+                   mxc_uri: str,
+                   offset: int = 0,
+                   progress: Progress = None,
+                   chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+        """
+        Download media in chunks, see Bot.iter_media.
+
+        :param mxc_uri: The mxc:// uri of the media.
+        :param offset: Start at this byte, to resume an earlier download.
+        :param progress: Called with the bytes received so far (including the offset) and the total size.
+        :param chunk_size: How many bytes to read at once.
+        :return: An async iterator over the chunks.
+        """
+        return self._iter_media(self._media_endpoint("download", mxc_uri), {},
+                                offset, progress, chunk_size)
+
+    async def _iter_media(self, endpoint: str, params: dict, offset: int,
+                          progress: Progress,
+                          chunk_size: int) -> AsyncIterator[bytes]:
+        """Stream a media endpoint, see iter_media."""
+        headers, params = self._prepare_request("GET", params, {}, False)
+        done = offset
+
+        for attempt in range(self.max_retries + 1):
+            if done: headers["Range"] = f"bytes={done}-"
+            try:
+                r = await self._request("GET", endpoint, None, params,
+                                        headers, "/_matrix/media/r0")
+            except MatrixError as e:
+                if e.status_code == 416:
+                    return  # there is nothing after the offset
+                raise
+
+            try:
+                start, total = self._content_range(r.status, r.headers, done)
+                skip = done - start
+                async for chunk in r.content.iter_chunked(chunk_size):
+                    # the homeserver ignored the range, drop what we have
+                    if skip:
+                        dropped = min(skip, len(chunk))
+                        chunk, skip = chunk[dropped:], skip - dropped
+                        if not chunk: continue
+                    done += len(chunk)
+                    if progress: progress(done, total)
+                    yield chunk
+            except aiohttp.ClientPayloadError:
+                if attempt == self.max_retries:
+                    raise
+                continue
+            finally:
+                r.release()
+            return
+
+    async def media_download(self,
+                             mxc_uri: str,
+                             file: Any = None,
+                             resume: bool = False,
+                             progress: Progress = None,
+                             chunk_size: int = CHUNK_SIZE) -> Any:
+        """
+        Download media, see Bot.media_download.
+
+        :param mxc_uri: The mxc:// uri of the media.
+        :param file: A path or a binary file object to write to, without one an async iterator over the chunks is returned.
+        :param resume: Continue a partial download, paths are downloaded to path + ".part" first and resumed from there, file objects from their position.
+        :param progress: Called with the bytes received so far and the total size.
+        :param chunk_size: How many bytes to read at once.
+        :return: The size of the file, or the chunk iterator.
+        """
+        if self.media_cache is not None:
+            return await self._cached_media(
+                MediaCache.key(mxc_uri), self._media_endpoint("download", mxc_uri),
+                {}, file, progress, chunk_size)
+
+        if file is None:
+            return self.iter_media(mxc_uri, progress=progress, chunk_size=chunk_size)
+
+        if isinstance(file, (str, os.PathLike)):
+            if not resume:
+                with open(file, "wb") as f:
+                    return await self.media_download(mxc_uri, f, False, progress, chunk_size)
+            # keep partial downloads apart, so an unrelated file is never appended to
+            part = os.fspath(file) + ".part"
+            with open(part, "ab") as f:
+                size = await self.media_download(mxc_uri, f, True, progress, chunk_size)
+            os.replace(part, file)
+            return size
+
+        offset = file.tell() if resume else 0
+        async for chunk in self.iter_media(mxc_uri, offset, progress, chunk_size):
+            file.write(chunk)
+            offset += len(chunk)
+        return offset
+
+    async def get_thumbnail(self,
+                            mxc_uri: str,
+                            width: int,
+                            height: int,
+                            method: str = "scale",
+                            file: Any = None,
+                            progress: Progress = None,
+                            chunk_size: int = CHUNK_SIZE) -> Any:
+        """
+        Download a thumbnail of media, see Bot.get_thumbnail.
+
+        :param mxc_uri: The mxc:// uri of the media.
+        :param width: The desired width.
+        :param height: The desired height.
+        :param method: "crop" or "scale".
+        :param file: A path or a binary file object to write to, without one an async iterator over the chunks is returned.
+        :param progress: Called with the bytes received so far and the total size.
+        :param chunk_size: How many bytes to read at once.
+        :return: The size of the thumbnail, or the chunk iterator.
+        """
+        endpoint = self._media_endpoint("thumbnail", mxc_uri)
+        params = {"width": width, "height": height, "method": method}
+        if self.media_cache is not None:
+            return await self._cached_media(
+                MediaCache.key(mxc_uri, width, height, method), endpoint,
+                params, file, progress, chunk_size)
+
+        chunks = self._iter_media(endpoint, params, 0, progress, chunk_size)
+        return chunks if file is None else await awrite_chunks(chunks, file)
+
+    async def _cached_media(self, key: str, endpoint: str, params: dict,
+                            file: Any, progress: Progress,
+                            chunk_size: int) -> Any:
+        """Serve media from the cache, a miss streams the download into the cache while passing it on."""
+        cached = self.media_cache.open(key)
+        if cached is None:
+            chunks = self.media_cache.afill(
+                key, self._iter_media(endpoint, params, 0, progress, chunk_size))
+        else:
+            chunks = aiter_file(cached, chunk_size)
+        return chunks if file is None else await awrite_chunks(chunks, file)
+
+    async def share_room_key(self, room_id: str,
+                             outbound: Outbound_Group_Session = None) -> Outbound_Group_Session:
+        """
+        Send the key of the outbound Megolm session of a room to the member devices that don't have it yet.
+
+        :param room_id: The room id.
+        :param outbound: The session to share, the current one of the room if not given.
+        :return: The shared session.
+        """
+        if not self.olm.active:
+            self.olm.load_or_create()
+        outbound = outbound or self.olm.get_outbound_group_session(room_id, *self._rotation_settings(room_id))
+        members = [user.user_id for user in await self.get_room_members(room_id)]
+        devices = self._unshared_devices(outbound, await self.get_device_keys(members))
+        if not devices:
+            return outbound
+
+        claims = self._olm_claims(devices)
+        if claims:
+            self._create_olm_sessions(await self.claim_keys(claims), devices)
+        messages, shared = self._room_key_messages(room_id, devices, outbound)
+        if messages:
+            await self.send_to_device("m.room.encrypted", messages)
+            self.olm.mark_shared(room_id, shared, outbound)
+        return outbound
+
+    async def send_encrypted(self, room_id: str, event_type: str, content: Dict) -> dict:
+        """
+        Send an event to an encrypted room, see Bot.send_encrypted.
+
+        :param room_id: The room id.
+        :param event_type: The event type.
+        :param content: The event content.
+        :return: The response from the homeserver.
+        """
+        if not self.olm.active:
+            self.olm.load_or_create()
+        outbound = self.olm.get_outbound_group_session(room_id, *self._rotation_settings(room_id))
+        await self.share_room_key(room_id, outbound)
+        encrypted = self.olm.get_encrypted_content(room_id, event_type, content, outbound=outbound)
+        return await self.send_room_event(room_id, "m.room.encrypted", encrypted)
@@ -1,5 +1,5 @@
 from typing import List, Mapping
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
 
 @dataclass
@@ -32,6 +32,60 @@ class Event:
     state_key: str = None
 
 
+class Lazy_Event:
+    """
+    Event that keeps the raw event dict and only reads from it when a
+    field is accessed. Has the same fields as Event.
+    """
+    __slots__ = ("raw", "_parsed_message")
+
+    def __init__(self, raw: dict) -> None:
+        self.raw = raw
+        self._parsed_message = None
+
+    def __repr__(self) -> str:
+        return f"Lazy_Event(event_id={self.event_id!r}, type={self.type!r})"
+
+    @property
+    def event_id(self) -> str:
+        return self.raw.get("event_id")
+
+    @property
+    def type(self) -> str:
+        return self.raw.get("type")
+
+    @property
+    def content(self) -> dict:
+        return self.raw.get("content")
+
+    @property
+    def timestamp(self) -> int:
+        return self.raw.get("origin_server_ts")
+
+    @property
+    def sender(self) -> str:
+        return self.raw.get("sender")
+
+    @property
+    def state_key(self) -> str:
+        return self.raw.get("state_key")
+
+    @property
+    def parsed_message(self) -> Message:
+        content = self.raw.get("content")
+        if self._parsed_message is None and content and self.type == "m.room.message":
+            self._parsed_message = Message(
+                type=content.get("msgtype"),
+                body=content.get("body"),
+                format=content.get("format"),
+                formatted_body=content.get("formatted_body"))
+        return self._parsed_message
+
+    @parsed_message.setter
+    def parsed_message(self, value: Message) -> None:
+        self._parsed_message = value
+
+
 @dataclass
 class Room:
     """Class to keep room data."""
@@ -45,6 +99,85 @@ class Room:
     encrypted: bool
 
 
+class Lazy_Room:
+    """
+    Room that keeps the raw room dict and only parses its timeline, unread
+    notifications and encryption when they are accessed. Has the same
+    fields as Room.
+    """
+    __slots__ = ("raw", "id", "_timeline", "_unread_notifications", "_encrypted")
+
+    def __init__(self, raw: dict, room_id: str) -> None:
+        self.raw = raw
+        self.id = room_id
+        self._timeline = None
+        self._unread_notifications = None
+        self._encrypted = None
+
+    def __repr__(self) -> str:
+        return f"Lazy_Room(id={self.id!r})"
+
+    @property
+    def timeline(self) -> List[Lazy_Event]:
+        if self._timeline is None:
+            self._timeline = [
+                Lazy_Event(event)
+                for event in self.raw.get("timeline", {}).get("events", [])
+            ]
+        return self._timeline
+
+    @timeline.setter
+    def timeline(self, value: List[Lazy_Event]) -> None:
+        self._timeline = value
+
+    @property
+    def state(self) -> dict:
+        return self.raw.setdefault("state", {})
+
+    @property
+    def account_data(self) -> dict:
+        return self.raw.setdefault("account_data", {})
+
+    @property
+    def summary(self) -> dict:
+        return self.raw.setdefault("summary", {})
+
+    @property
+    def unread_notifications(self) -> "Unread_Notification":
+        if self._unread_notifications is None:
+            notifications = self.raw.get("unread_notifications", {})
+            self._unread_notifications = Unread_Notification(
+                notification_count=notifications.get("notification_count", 0),
+                highlight_count=notifications.get("highlight_count", 0))
+        return self._unread_notifications
+
+    @unread_notifications.setter
+    def unread_notifications(self, value: "Unread_Notification") -> None:
+        self._unread_notifications = value
+
+    @property
+    def unread_count(self) -> int:
+        return self.raw.get("org.matrix.msc2654.unread_count")
+
+    @unread_count.setter
+    def unread_count(self, value: int) -> None:
+        self.raw["org.matrix.msc2654.unread_count"] = value
+
+    @property
+    def encrypted(self) -> bool:
+        # read from the raw events, without building the timeline
+        if self._encrypted is None:
+            self._encrypted = any(
+                event.get("type") == "m.room.encryption"
+                and (event.get("content") or {}).get("algorithm") == "m.megolm.v1.aes-sha2"
+                for event in self.raw.get("timeline", {}).get("events", []))
+        return self._encrypted
+
+    @encrypted.setter
+    def encrypted(self, value: bool) -> None:
+        self._encrypted = value
+
+
 @dataclass
 class Invite_State:
     """Class to keep invite state data."""
@@ -68,6 +201,28 @@ class State:
     invited_rooms: List[Invite] = None
 
 
+@dataclass
+class Sync_Delta:
+    """Class to keep the changes introduced by a single sync response."""
+    next_batch: str = None
+    initial: bool = False
+    timeline: Mapping[str, List[Event]] = field(default_factory=dict)
+    state: Mapping[str, List[dict]] = field(default_factory=dict)
+    invites: List[Invite] = field(default_factory=list)
+    left_rooms: List[str] = field(default_factory=list)
+    device_lists: Mapping[str, List[str]] = field(default_factory=dict)
+    to_device: List[dict] = field(default_factory=list)
+    one_time_keys_count: Mapping[str, int] = None
+
+
+@dataclass
+class Room_Events_Page:
+    """Class to keep a page of room events and the pagination tokens around it."""
+    events: List[Event] = field(default_factory=list)
+    start: str = None
+    end: str = None
+
+
 @dataclass
 class Timeline:
     """Class to keep timeline data."""
@@ -109,6 +264,7 @@ class Device_Keys:
     user_id: str
     unsigned: Mapping[str, str]
     signatures: Mapping[str, Mapping[str, str]]
+    raw: dict = field(default=None, repr=False, compare=False)
 
 
 @dataclass
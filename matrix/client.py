@@ -1,87 +1,178 @@
 from .API import Bot
-from time import sleep, time
+from .async_api import AsyncBot
+from .storage import Storage
+from .classes import Event, Sync_Delta
+from .utils import SeenSet
+from .scheduler import Scheduler
+from .metrics import NULL_METRICS, Metrics
+from .filters import MESSAGE_EVENT_TYPES, make_sync_filter
+from time import time
 from .discord_like_classes import *
-from threading import Thread
 import asyncio
 
 
 class Client:
-    def __init__(self, silent=True):
-        """Initialize client."""
+    def __init__(self, silent=True, seen_capacity: int = 10000, seen_ttl: float = None, scheduler: Scheduler = None, metrics: Metrics = None):
+        """
+        Initialize client.
+
+        :param silent: don't print status messages
+        :param seen_capacity: how many handled message and invite ids to remember
+        :param seen_ttl: how many seconds to remember handled ids, None to remember them until evicted
+        :param scheduler: runs the handlers, defaults to Scheduler() (handlers of a room run in order, rooms and accounts concurrently)
+        :param metrics: record dispatch, handler and request metrics in this registry, e.g. Metrics() (optional)
+        """
         self.loop = None
+        self.queue = None
         self.client = Bot
         self.is_running = False
         self.silent = silent
+        self.answered_commands = SeenSet(seen_capacity, seen_ttl)
+        self.handled_invites = SeenSet(seen_capacity, seen_ttl)
+        self.metrics = metrics or NULL_METRICS
+        self.scheduler = scheduler or Scheduler(metrics=self.metrics)
+        self._init_metrics()
+        self._own_scheduler = scheduler is None
+        self._skip_next_sync = True
+
+    def _init_metrics(self) -> None:
+        """Create the metrics the client records, again after metrics was replaced."""
+        self._dispatched = self.metrics.counter("matrix_events_dispatched_total", "Events handed to a handler.")
 
     def _print(self, msg: str) -> None:
         """Print message if not silent."""
         if not self.silent:
             print(msg)
 
-    def _handle_messages(self) -> None:
-        """Handle messages."""
-        answered_commands = []
-        initial = True
-        while self.is_running:
-            sleep(self.client.sync_delay)
-            # for every room
-            for i, room in enumerate(self.client.state.joined_rooms):
-                # get all messages
-                for m in self.client.state.joined_rooms[i].timeline:
-                    # if it's a message
-                    if m.event_id not in answered_commands and m.type == "m.room.message":
-                        # Mark as read, so we don't get it again
-                        answered_commands.append(m.event_id)
-                        if not initial:
-                            r = Room(
-                                id=room.id,
-                                topic=None,
-                                last_message=room.timeline[-1],
-                                last_message_id=room.timeline[-1].event_id,
-                                _bot=self.client,
-                            )
-
-                            msg = Message(
-                                type=m.type,
-                                content=m.parsed_message.body,
-                                author=m.sender,
-                                id=m.event_id,
-                                room=r,
-                                channel=r,
-                                created_at=m.timestamp,
-                                edited_at=None,
-                                _bot=self.client,
-                            )
-                            asyncio.run(self.on_message(msg))
-            if initial:
-                self._print(f"[+] {len(answered_commands)} messages answered so far.")
-                initial = False
-            initial = False
-
-    def _handle_invites(self) -> None:
-        """Handle invites."""
-        handled_invites = []
-        initial = True
+    def sync_filter(self) -> dict:
+        """
+        Build the sync filter from the handlers that are defined.
+
+        Presence, typing notifications, receipts and account data are never
+        synced, messages only if on_message is defined. Override this to
+        use a different filter, or return None to sync everything.
+
+        :return: The filter, see filters.make_sync_filter.
+        """
+        return make_sync_filter(
+            timeline_not_types=None if hasattr(self, "on_message") else MESSAGE_EVENT_TYPES,
+        )
+
+    def _on_sync(self, delta: Sync_Delta) -> None:
+        """Hand the changes of a sync from the sync thread to the event loop."""
+        if not self.is_running:
+            return
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, delta)
+
+    def _on_sync_done(self, task: asyncio.Task) -> None:
+        """Stop dispatching once the sync task of an AsyncBot died."""
+        if not task.cancelled() and task.exception():
+            self._print(f"[-] Sync of {self.user} failed: {task.exception()!r}")
+        self.queue.put_nowait(None)
+
+    def _dispatch(self, delta: Sync_Delta) -> None:
+        """Start handlers for all new messages and invites of a sync."""
+        # the first sync contains old events, only mark them as seen
+        initial = self._skip_next_sync
+        self._skip_next_sync = False
+        seen = []
+
+        for room_id, events in delta.timeline.items():
+            for m in events:
+                # Mark as read, so we don't get it again
+                if m.type != "m.room.message" or not self.answered_commands.add(m.event_id):
+                    continue
+                seen.append(m.event_id)
+                if not initial:
+                    self._start_handler("on_message", room_id, self._make_message(room_id, m))
+
+        for invite in delta.invites:
+            key = f"{invite.room_id}|{invite.invitee}"
+            if not self.handled_invites.add(key):
+                continue
+            seen.append(key)
+            if not initial:
+                i = Invite(
+                    room_id=invite.room_id,
+                    inviter=invite.invitee,
+                    created_at=time(),
+                    _invite_state=invite.invite_state,
+                    _bot=self.client,
+                )
+                self._start_handler("on_invite", invite.room_id, i)
+
+        if self.client.storage and seen:
+            self.client.storage.add_seen(seen, limit=self.answered_commands.capacity)
+        if initial:
+            self._print(f"[+] {len(self.answered_commands)} messages answered so far.")
+            self._print(f"[+] {len(self.handled_invites)} invites handled so far.")
+
+    def _make_message(self, room_id: str, m: Event) -> Message:
+        """Build the message passed to on_message."""
+        return message_from_event(self.client, room_id, m)
+
+    def _start_handler(self, name: str, room_id: str, *args) -> None:
+        """Queue a handler on the scheduler, if it is defined."""
+        handler = getattr(self, name, None)
+        if handler is None:
+            return
+        self._dispatched.inc(handler=name)
+        # the scheduler may be shared with other accounts, which must not wait for this one
+        self.scheduler.submit((self.user, room_id), handler, *args)
+
+    async def _run(self) -> None:
+        """Sync in a thread and dispatch the events on this loop."""
+        await self._start_sync()
+        await self._serve()
+
+    async def _start_sync(self) -> None:
+        """Do the initial sync, start syncing in the background and call on_ready."""
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.client.add_sync_listener(self._on_sync)
+        self._dispatch_queue_depth = self.metrics.gauge("matrix_dispatch_queue_depth", "Syncs waiting to be dispatched.")
+        self._dispatch_queue_depth.set_function(self.queue.qsize, user=self.user)
+
+        if isinstance(self.client, AsyncBot):
+            await self.client.start_sync()
+            self.client.sync_task.add_done_callback(self._on_sync_done)
+        else:
+            await self.loop.run_in_executor(None, self.client.start_sync)
+        # a resumed bot only gets events it hasn't seen yet
+        self._skip_next_sync = not self.client.resumed
+        self._start_handler("on_ready", None)
+
+    async def _serve(self) -> None:
+        """Dispatch the synced events until the client is stopped."""
         while self.is_running:
-            sleep(self.client.sync_delay)
-            for invite in self.client.state.invited_rooms:
-                if hash(invite.room_id + invite.invitee) not in handled_invites:
-                    handled_invites.append(hash(invite.room_id + invite.invitee))
-                    if not initial:
-                        i = Invite(
-                            room_id=invite.room_id,
-                            inviter=invite.invitee,
-                            created_at=time(),
-                            _invite_state=invite.invite_state,
-                            _bot=self.client,
-                        )
-                        asyncio.run(self.on_invite(i))
-            if initial:
-                self._print(f"[+] {len(handled_invites)} invites handled so far.")
-                initial = False
-
-
-    def run(self, username: str, password: str, homeserver: str, device_id: str = "") -> None:
+            delta = await self.queue.get()
+            if delta is None:
+                break
+            self._dispatch(delta)
+
+        self._dispatch_queue_depth.remove_function(user=self.user)
+        # let running handlers finish, a shared scheduler is closed by its owner
+        await self.scheduler.join(self.user)
+        if self._own_scheduler:
+            self.scheduler.close()
+
+    def stop(self) -> None:
+        """Stop syncing and dispatching."""
+        self.is_running = False
+        self.client.stop()
+        if self.loop:
+            if isinstance(self.client, AsyncBot) and self.client.sync_task:
+                self.loop.call_soon_threadsafe(self.client.sync_task.cancel)
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    def _load_seen(self) -> None:
+        """Remember the handled ids of the storage, so they aren't handled again."""
+        if self.client.storage:
+            seen = self.client.storage.get_seen(limit=self.answered_commands.capacity)
+            self.answered_commands.update(seen)
+            self.handled_invites.update(seen)
+
+    def run(self, username: str, password: str, homeserver: str, device_id: str = "", storage: Storage = None, **options) -> None:
         """
         Run client.
 
@@ -89,14 +180,57 @@ class Client:
         :param password: password of the user
         :param homeserver: homeserver of the user
         :param device_id: device id of the user (optional)
+        :param storage: storage to resume the sync state from, e.g. SQLiteStorage("bot.db") (optional)
+        :param options: passed on to Bot, e.g. lazy_events=True
         """
-        self.client = Bot(homeserver=homeserver, username=username, password=password, device_id=device_id)
-        self.auth = self.client.login(device_id=device_id)
+        options.setdefault("metrics", self.metrics)
+        self.client = Bot(homeserver=homeserver, username=username, password=password, device_id=device_id, storage=storage, sync_filter=self.sync_filter(), **options)
+        self.auth = self.client.login(start_syncing=False, device_id=device_id)
         self.user = self.auth.user_id
         self.is_running = True
+        self._load_seen()
+
+        asyncio.run(self._run())
+
+    async def start(self, username: str, password: str, homeserver: str, device_id: str = "", storage: Storage = None, **options) -> None:
+        """
+        Run client on the running event loop, until it is stopped.
+
+        Unlike run, this syncs with an AsyncBot task instead of a thread,
+        so many clients can share one loop, see runner.Runner.
+
+        :param username: username of the user
+        :param password: password of the user
+        :param homeserver: homeserver of the user
+        :param device_id: device id of the user (optional)
+        :param storage: storage to resume the sync state from (optional)
+        :param options: passed on to AsyncBot, e.g. session=create_session()
+        """
+        await self.connect(username, password, homeserver, device_id, storage, **options)
+        await self.serve()
+
+    async def connect(self, username: str, password: str, homeserver: str, device_id: str = "", storage: Storage = None, **options) -> None:
+        """
+        Log in, do the initial sync and start syncing, the first half of start.
+
+        Takes the same arguments as start.
+        """
+        options.setdefault("metrics", self.metrics)
+        self.client = AsyncBot(homeserver=homeserver, username=username, password=password, device_id=device_id, storage=storage, sync_filter=self.sync_filter(), **options)
+        try:
+            self.auth = await self.client.login(start_syncing=False, device_id=device_id)
+            self.user = self.auth.user_id
+            self.is_running = True
+            self._load_seen()
+            await self._start_sync()
+        except BaseException:
+            self.is_running = False
+            await self.client.close()
+            raise
 
-        self.client.start_sync()
-        Thread(target=self._handle_messages).start()
-        Thread(target=self._handle_invites).start()
-        asyncio.run(self.on_ready())
-        self.client.run_forever()
+    async def serve(self) -> None:
+        """Dispatch events until the client is stopped, the second half of start."""
+        try:
+            await self._serve()
+        finally:
+            await self.client.close()
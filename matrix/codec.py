@@ -0,0 +1,129 @@
+from typing import Any, Union
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class JSONCodec():
+    """JSON codec backed by the standard library."""
+    name = "json"
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        """
+        Decode JSON.
+
+        :param data: The JSON document, bytes are decoded as UTF-8.
+        :return: The decoded object.
+        """
+        return json.loads(data)
+
+    def dumps(self, value: Any) -> bytes:
+        """
+        Encode JSON.
+
+        :param value: The object to encode.
+        :return: The compact UTF-8 encoded JSON document.
+        """
+        return json.dumps(value, ensure_ascii=False,
+                          separators=(',', ':')).encode("UTF-8")
+
+    def canonical(self, value: Any) -> bytes:
+        """
+        Encode canonical JSON, see https://spec.matrix.org/v1.1/appendices/#canonical-json
+
+        :param value: The object to encode.
+        :return: The UTF-8 encoded canonical JSON document.
+        """
+        return json.dumps(
+            value,
+            # Encode code-points outside of ASCII as UTF-8 rather than \u escapes
+            ensure_ascii=False,
+            # Remove unnecessary white space.
+            separators=(',', ':'),
+            # Sort the keys of dictionaries.
+            sort_keys=True,
+            # Encode the resulting Unicode as UTF-8 bytes.
+        ).encode("UTF-8")
+
+
+class OrjsonCodec(JSONCodec):
+    """
+    JSON codec backed by orjson, falls back to the standard library for
+    values orjson refuses: integers above 64 bit and lone surrogates when
+    encoding, lone surrogates and numbers out of the float range when
+    decoding. orjson decodes integers above 64 bit as floats, Matrix only
+    allows integers up to 2**53 anyway.
+    """
+    name = "orjson"
+
+    def loads(self, data: Union[bytes, str]) -> Any:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # invalid JSON raises a json.JSONDecodeError here as well
+            return super().loads(data)
+
+    def dumps(self, value: Any) -> bytes:
+        try:
+            return orjson.dumps(value)
+        except TypeError:
+            return super().dumps(value)
+
+    def canonical(self, value: Any) -> bytes:
+        try:
+            return orjson.dumps(value, option=orjson.OPT_SORT_KEYS)
+        except TypeError:
+            return super().canonical(value)
+
+
+codecs = {"json": JSONCodec}
+if orjson is not None: codecs["orjson"] = OrjsonCodec
+
+codec = OrjsonCodec() if orjson is not None else JSONCodec()
+
+
+def set_codec(name: str) -> JSONCodec:
+    """
+    Select the JSON codec used for requests, responses, storages and canonical JSON.
+
+    :param name: "orjson" or "json".
+    :return: The selected codec.
+    """
+    global codec
+    if name not in codecs:
+        raise ValueError(f"JSON codec {name} is not available")
+    codec = codecs[name]()
+    return codec
+
+
+def loads(data: Union[bytes, str]) -> Any:
+    """
+    Decode JSON with the selected codec.
+
+    :param data: The JSON document.
+    :return: The decoded object.
+    """
+    return codec.loads(data)
+
+
+def dumps(value: Any) -> bytes:
+    """
+    Encode JSON with the selected codec.
+
+    :param value: The object to encode.
+    :return: The UTF-8 encoded JSON document.
+    """
+    return codec.dumps(value)
+
+
+def canonical_dumps(value: Any) -> bytes:
+    """
+    Encode canonical JSON with the selected codec.
+
+    :param value: The object to encode.
+    :return: The UTF-8 encoded canonical JSON document.
+    """
+    return codec.canonical(value)
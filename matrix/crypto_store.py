@@ -0,0 +1,269 @@
+from typing import Dict, List, Optional, Tuple
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+from . import codec
+
+
+class CryptoStore(ABC):
+    """
+    Base class for encryption key storage backends.
+
+    Keeps the Olm account, the Olm sessions with other devices and the
+    Megolm group sessions as pickles, encrypted with the pickle key by Olm.
+    """
+
+    @abstractmethod
+    def load_account(self) -> Optional[str]:
+        """
+        Get the pickled Olm account.
+
+        :return: The pickle, or None if there is no account yet.
+        """
+
+    @abstractmethod
+    def save_account(self, pickle: str) -> None:
+        """
+        Store the pickled Olm account.
+
+        :param pickle: The pickle.
+        """
+
+    @abstractmethod
+    def load_olm_sessions(self, sender_key: str) -> List[str]:
+        """
+        Get the pickled Olm sessions with a device, most recently used first.
+
+        :param sender_key: The curve25519 key of the device.
+        :return: The pickles.
+        """
+
+    @abstractmethod
+    def save_olm_session(self, sender_key: str, session_id: str, pickle: str,
+                         last_used: float) -> None:
+        """
+        Store a pickled Olm session.
+
+        :param sender_key: The curve25519 key of the device.
+        :param session_id: The session id.
+        :param pickle: The pickle.
+        :param last_used: When the session was last used, as a unix timestamp.
+        """
+
+    @abstractmethod
+    def load_inbound_group_session(
+            self, room_id: str, sender_key: str,
+            session_id: str) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
+        """
+        Get a pickled inbound Megolm session.
+
+        :param room_id: The room id.
+        :param sender_key: The curve25519 key of the sending device.
+        :param session_id: The session id.
+        :return: The pickle, the user that sent the room key and the ed25519 key of the sending device, or None if the session is unknown.
+        """
+
+    @abstractmethod
+    def save_inbound_group_session(self, room_id: str, sender_key: str,
+                                   session_id: str, pickle: str,
+                                   sender: str = None,
+                                   signing_key: str = None) -> None:
+        """
+        Store a pickled inbound Megolm session.
+
+        :param room_id: The room id.
+        :param sender_key: The curve25519 key of the sending device.
+        :param session_id: The session id.
+        :param pickle: The pickle.
+        :param sender: The user that sent the room key.
+        :param signing_key: The verified ed25519 key of the sending device.
+        """
+
+    @abstractmethod
+    def load_outbound_group_session(
+            self, room_id: str) -> Optional[Tuple[str, float, List[str]]]:
+        """
+        Get the pickled outbound Megolm session of a room.
+
+        :param room_id: The room id.
+        :return: The pickle, the creation time and the devices it was shared with, or None.
+        """
+
+    @abstractmethod
+    def save_outbound_group_session(self, room_id: str, pickle: str,
+                                    created: float,
+                                    shared_with: List[str]) -> None:
+        """
+        Store the pickled outbound Megolm session of a room, replacing the old one.
+
+        :param room_id: The room id.
+        :param pickle: The pickle.
+        :param created: When the session was created, as a unix timestamp.
+        :param shared_with: The devices ("user_id|device_id") that got the session key.
+        """
+
+    @abstractmethod
+    def delete_outbound_group_session(self, room_id: str) -> None:
+        """
+        Delete the outbound Megolm session of a room.
+
+        :param room_id: The room id.
+        """
+
+    def commit(self) -> None:
+        """Persist all changes."""
+
+    def close(self) -> None:
+        """Persist all changes and release the store."""
+        self.commit()
+
+
+class MemoryCryptoStore(CryptoStore):
+    def __init__(self) -> None:
+        """Initialize an in-memory key store, keys are lost on exit."""
+        self.account = None
+        self.olm_sessions: Dict[str, Dict[str, Tuple[str, float]]] = {}
+        self.inbound: Dict[Tuple[str, str, str], Tuple[str, Optional[str], Optional[str]]] = {}
+        self.outbound: Dict[str, Tuple[str, float, List[str]]] = {}
+
+    def load_account(self) -> Optional[str]:
+        return self.account
+
+    def save_account(self, pickle: str) -> None:
+        self.account = pickle
+
+    def load_olm_sessions(self, sender_key: str) -> List[str]:
+        sessions = self.olm_sessions.get(sender_key, {}).values()
+        return [p for p, _ in sorted(sessions, key=lambda s: -s[1])]
+
+    def save_olm_session(self, sender_key: str, session_id: str, pickle: str,
+                         last_used: float) -> None:
+        self.olm_sessions.setdefault(sender_key,
+                                     {})[session_id] = (pickle, last_used)
+
+    def load_inbound_group_session(
+            self, room_id: str, sender_key: str,
+            session_id: str) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
+        return self.inbound.get((room_id, sender_key, session_id))
+
+    def save_inbound_group_session(self, room_id: str, sender_key: str,
+                                   session_id: str, pickle: str,
+                                   sender: str = None,
+                                   signing_key: str = None) -> None:
+        self.inbound[(room_id, sender_key, session_id)] = (pickle, sender, signing_key)
+
+    def load_outbound_group_session(
+            self, room_id: str) -> Optional[Tuple[str, float, List[str]]]:
+        return self.outbound.get(room_id)
+
+    def save_outbound_group_session(self, room_id: str, pickle: str,
+                                    created: float,
+                                    shared_with: List[str]) -> None:
+        self.outbound[room_id] = (pickle, created, list(shared_with))
+
+    def delete_outbound_group_session(self, room_id: str) -> None:
+        self.outbound.pop(room_id, None)
+
+
+class SQLiteCryptoStore(CryptoStore):
+    def __init__(self, path: str) -> None:
+        """
+        Initialize a SQLite backed key store.
+
+        :param path: The database file, created if it doesn't exist. Can be the file of a SQLiteStorage.
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS olm_account (id INTEGER PRIMARY KEY, pickle TEXT)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS olm_sessions (session_id TEXT PRIMARY KEY, sender_key TEXT, pickle TEXT, last_used REAL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS olm_sessions_sender ON olm_sessions (sender_key)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS inbound_group_sessions (room_id TEXT, sender_key TEXT, session_id TEXT, pickle TEXT, sender TEXT, signing_key TEXT, PRIMARY KEY (room_id, sender_key, session_id))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS outbound_group_sessions (room_id TEXT PRIMARY KEY, pickle TEXT, created REAL, shared_with TEXT)"
+        )
+        self.db.commit()
+
+    def load_account(self) -> Optional[str]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT pickle FROM olm_account WHERE id = 0").fetchone()
+        return row[0] if row else None
+
+    def save_account(self, pickle: str) -> None:
+        with self.lock:
+            self.db.execute(
+                "REPLACE INTO olm_account (id, pickle) VALUES (0, ?)",
+                (pickle, ))
+
+    def load_olm_sessions(self, sender_key: str) -> List[str]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT pickle FROM olm_sessions WHERE sender_key = ? ORDER BY last_used DESC",
+                (sender_key, )).fetchall()
+        return [row[0] for row in rows]
+
+    def save_olm_session(self, sender_key: str, session_id: str, pickle: str,
+                         last_used: float) -> None:
+        with self.lock:
+            self.db.execute(
+                "REPLACE INTO olm_sessions (session_id, sender_key, pickle, last_used) VALUES (?, ?, ?, ?)",
+                (session_id, sender_key, pickle, last_used))
+
+    def load_inbound_group_session(
+            self, room_id: str, sender_key: str,
+            session_id: str) -> Optional[Tuple[str, Optional[str], Optional[str]]]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT pickle, sender, signing_key FROM inbound_group_sessions WHERE room_id = ? AND sender_key = ? AND session_id = ?",
+                (room_id, sender_key, session_id)).fetchone()
+        return tuple(row) if row else None
+
+    def save_inbound_group_session(self, room_id: str, sender_key: str,
+                                   session_id: str, pickle: str,
+                                   sender: str = None,
+                                   signing_key: str = None) -> None:
+        with self.lock:
+            self.db.execute(
+                "REPLACE INTO inbound_group_sessions (room_id, sender_key, session_id, pickle, sender, signing_key) VALUES (?, ?, ?, ?, ?, ?)",
+                (room_id, sender_key, session_id, pickle, sender, signing_key))
+
+    def load_outbound_group_session(
+            self, room_id: str) -> Optional[Tuple[str, float, List[str]]]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT pickle, created, shared_with FROM outbound_group_sessions WHERE room_id = ?",
+                (room_id, )).fetchone()
+        return (row[0], row[1], codec.loads(row[2])) if row else None
+
+    def save_outbound_group_session(self, room_id: str, pickle: str,
+                                    created: float,
+                                    shared_with: List[str]) -> None:
+        with self.lock:
+            self.db.execute(
+                "REPLACE INTO outbound_group_sessions (room_id, pickle, created, shared_with) VALUES (?, ?, ?, ?)",
+                (room_id, pickle, created, codec.dumps(list(shared_with))))
+
+    def delete_outbound_group_session(self, room_id: str) -> None:
+        with self.lock:
+            self.db.execute(
+                "DELETE FROM outbound_group_sessions WHERE room_id = ?",
+                (room_id, ))
+
+    def commit(self) -> None:
+        with self.lock:
+            self.db.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.commit()
+            self.db.close()
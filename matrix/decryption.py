@@ -0,0 +1,386 @@
+from .classes import Device_Keys, Event, Lazy_Event, Sync_Delta
+from .parsers import parse_event
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import threading
+
+MEGOLM = "m.megolm.v1.aes-sha2"
+OLM = "m.olm.v1.curve25519-aes-sha2"
+
+# (room_id, sender_key, session_id) of a Megolm session
+Session_Key = Tuple[str, str, str]
+
+
+def _session_key(room_id: str, event: Any) -> Session_Key:
+    """Get the Megolm session of an encrypted event, None if it isn't Megolm encrypted."""
+    if event.type != "m.room.encrypted":
+        return None
+    content = event.content or {}
+    if content.get("algorithm") != MEGOLM or not content.get("ciphertext"):
+        return None
+    return room_id, content.get("sender_key"), content.get("session_id")
+
+
+def _decrypted_event(event: Any, payload: dict) -> Any:
+    """Build the event a decrypted payload describes, of the same class as the encrypted one."""
+    raw = {
+        "event_id": event.event_id,
+        "sender": event.sender,
+        "origin_server_ts": event.timestamp,
+        "type": payload.get("type"),
+        "content": payload.get("content") or {}
+    }
+    if isinstance(event, Lazy_Event):
+        return Lazy_Event(raw)
+    return parse_event(raw)
+
+
+class Decryptor():
+    def __init__(self,
+                 olm: Any,
+                 max_workers: int = 4,
+                 cache_size: int = 10000,
+                 batch_threshold: int = 8,
+                 device_keys: Callable[[str], Dict[str, Device_Keys]] = None,
+                 pending_size: int = 1000) -> None:
+        """
+        Initialize the decryption stage between sync parsing and dispatch.
+
+        Encrypted timeline events are grouped by Megolm session and the
+        sessions are decrypted concurrently on a thread pool (libolm runs
+        without the GIL), the events of one session one after another.
+        Decrypted events are cached by event id, so an event that comes
+        in again (a restored or repeated sync, history) isn't decrypted twice.
+
+        Room keys are only accepted from devices whose keys are known, and
+        a Megolm session only decrypts events of the user that shared it.
+
+        Synced events whose room key didn't arrive yet are kept, and
+        decrypt_delta adds them to the sync that brings their key.
+
+        :param olm: The Olm engine holding the sessions.
+        :param max_workers: How many sessions may be decrypted at the same time.
+        :param cache_size: How many decrypted events to remember.
+        :param batch_threshold: Decrypt smaller batches in the calling thread, the pool doesn't pay off for them.
+        :param device_keys: Gets the known (verified) device keys of a user by device id, e.g. from a DeviceStore. Without it every room key is rejected.
+        :param pending_size: How many events waiting for their room key to keep, the oldest are dropped.
+        """
+        self.olm = olm
+        self.device_keys = device_keys
+        self.executor = ThreadPoolExecutor(max_workers)
+        self.cache_size = cache_size
+        self.batch_threshold = batch_threshold
+        self.cache: Dict[str, Any] = OrderedDict()
+        self.indices: Dict[Tuple[str, str, str, int], str] = OrderedDict()
+        self.pending_size = pending_size
+        # events waiting for their room key by session, then event id
+        self.pending: Dict[Session_Key, Dict[str, Any]] = OrderedDict()
+        self.pending_count = 0
+        self.lock = threading.Lock()
+        # one batch at a time, a Megolm session must not decrypt in two threads
+        self.batch_lock = threading.Lock()
+        self.decrypted = 0
+        self.hits = 0
+        self.missing = 0
+        self.failed = 0
+        self.room_keys = 0
+        self.late = 0
+
+    def _ensure_account(self) -> bool:
+        """Load the stored Olm account, to-device messages can't be decrypted without it."""
+        if not self.olm.active:
+            pickle = self.olm.store.load_account()
+            if pickle is None:
+                return False
+            self.olm.load(pickle.encode(), self.olm.pickle_key)
+        return True
+
+    def handle_to_device(self, events: List[dict]) -> int:
+        """
+        Decrypt the Olm encrypted to-device events of a sync and store the room keys they carry.
+
+        Run this before decrypting the timeline, a room key usually
+        arrives in the same sync as the first messages it encrypts.
+
+        :param events: The to_device events of the sync.
+        :return: How many room keys were added.
+        """
+        return len(self._handle_to_device(events))
+
+    def _handle_to_device(self, events: List[dict]) -> List[Session_Key]:
+        """Store the room keys of to-device events, see handle_to_device, and return their sessions."""
+        added = []
+        for event in events:
+            content = event.get("content") or {}
+            if event.get("type") != "m.room.encrypted" or content.get("algorithm") != OLM:
+                continue
+            if not self._ensure_account():
+                return added
+            own_keys = self.olm.get_identity_keys()
+            message = (content.get("ciphertext") or {}).get(own_keys["curve25519"])
+            sender_key = content.get("sender_key")
+            if not message or not sender_key:
+                continue
+            try:
+                payload = self.olm.decrypt_olm(sender_key, message.get("type"), message.get("body"))
+            except Exception:
+                with self.lock:
+                    self.failed += 1
+                continue
+            # the payload must be meant for us and come from the device that sent it
+            if payload.get("sender") != event.get("sender") \
+                    or payload.get("recipient") != self.olm.user_id \
+                    or (payload.get("recipient_keys") or {}).get("ed25519") != own_keys["ed25519"]:
+                with self.lock:
+                    self.failed += 1
+                continue
+            if payload.get("type") != "m.room_key":
+                continue
+            # a room key must come from a known device, not just any Olm channel
+            signing_key = self._signing_key(event["sender"], sender_key, payload)
+            if signing_key is None:
+                with self.lock:
+                    self.failed += 1
+                continue
+            session = self._add_room_key(sender_key, payload.get("content") or {},
+                                         event["sender"], signing_key)
+            if session is not None:
+                added.append(session)
+        with self.lock:
+            self.room_keys += len(added)
+        return added
+
+    def senders(self, delta: Sync_Delta) -> List[str]:
+        """
+        Get the users that sent Olm encrypted to-device events in a sync.
+
+        Fetch their device keys before decrypt_delta, or their room keys are rejected.
+
+        :param delta: The changes of the sync.
+        :return: The user ids.
+        """
+        return list(dict.fromkeys(
+            event["sender"] for event in delta.to_device
+            if event.get("type") == "m.room.encrypted" and event.get("sender")
+            and (event.get("content") or {}).get("algorithm") == OLM))
+
+    def _signing_key(self, user_id: str, sender_key: str,
+                     payload: dict) -> Optional[str]:
+        """Get the ed25519 key of the device that owns an Olm channel, None if it doesn't match the one the payload claims."""
+        claimed = (payload.get("keys") or {}).get("ed25519")
+        if not claimed or self.device_keys is None:
+            return None
+        for device_id, device in self.device_keys(user_id).items():
+            keys = device.keys or {}
+            if keys.get(f"curve25519:{device_id}") == sender_key:
+                return claimed if keys.get(f"ed25519:{device_id}") == claimed else None
+        return None
+
+    def _add_room_key(self, sender_key: str, content: dict, sender: str,
+                      signing_key: str) -> Optional[Session_Key]:
+        """Store the inbound Megolm session of a m.room_key event, bound to the device that sent it."""
+        if content.get("algorithm") != MEGOLM or not content.get("room_id") \
+                or not content.get("session_key"):
+            return None
+        try:
+            session = self.olm.add_inbound_group_session(content["room_id"], sender_key,
+                                                         content["session_key"],
+                                                         sender, signing_key)
+        except Exception:
+            with self.lock:
+                self.failed += 1
+            return None
+        return content["room_id"], sender_key, session.id
+
+    def _cached(self, event_id: str) -> Any:
+        """Get a decrypted event from the cache."""
+        with self.lock:
+            event = self.cache.get(event_id)
+            if event is not None:
+                self.cache.move_to_end(event_id)
+            return event
+
+    def _remember(self, key: Any, value: Any, cache: OrderedDict) -> None:
+        """Add an entry to a bounded cache, evicting the least recently used ones."""
+        with self.lock:
+            cache[key] = value
+            cache.move_to_end(key)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+
+    def _defer(self, session: Session_Key, event: Any) -> None:
+        """Keep an event until the room key of its session arrives, dropping the oldest kept events."""
+        with self.lock:
+            events = self.pending.setdefault(session, OrderedDict())
+            if event.event_id not in events:
+                self.pending_count += 1
+            events[event.event_id] = event
+            self.pending.move_to_end(session)
+            while self.pending_count > self.pending_size:
+                oldest = next(iter(self.pending))
+                self.pending[oldest].popitem(last=False)
+                self.pending_count -= 1
+                if not self.pending[oldest]:
+                    del self.pending[oldest]
+
+    def _take_pending(self, sessions: List[Session_Key]) -> Dict[str, List[Any]]:
+        """Remove the events kept for sessions, by room."""
+        taken: Dict[str, List[Any]] = {}
+        with self.lock:
+            for session in sessions:
+                events = self.pending.pop(session, None)
+                if events:
+                    self.pending_count -= len(events)
+                    taken.setdefault(session[0], []).extend(events.values())
+        return taken
+
+    def _decrypt_session(self, session: Session_Key, events: List[Any],
+                         defer: bool = False) -> List[Any]:
+        """Decrypt the events of one Megolm session, None for the ones that failed."""
+        room_id, sender_key, session_id = session
+        owner, _ = self.olm.get_inbound_group_session_owner(*session)
+        results = []
+        decrypted_count = missing = failed = 0
+        for event in events:
+            try:
+                payload, index = self.olm.decrypt_group(room_id, sender_key, session_id,
+                                                        event.content["ciphertext"])
+            except Exception:
+                failed += 1
+                results.append(None)
+                continue
+            if payload is None:
+                # the room key didn't arrive (yet)
+                missing += 1
+                if defer and event.event_id:
+                    self._defer(session, event)
+                results.append(None)
+                continue
+
+            # a message index reused by another event is a replay, and only
+            # the user that shared the session may send with it
+            with self.lock:
+                replayed = self.indices.get((*session, index))
+            if payload.get("room_id") != room_id or (replayed and replayed != event.event_id) \
+                    or (owner is not None and owner != event.sender):
+                failed += 1
+                results.append(None)
+                continue
+            self._remember((*session, index), event.event_id, self.indices)
+
+            decrypted = _decrypted_event(event, payload)
+            if event.event_id:
+                self._remember(event.event_id, decrypted, self.cache)
+            decrypted_count += 1
+            results.append(decrypted)
+
+        # sessions are decrypted on several pool threads
+        with self.lock:
+            self.decrypted += decrypted_count
+            self.missing += missing
+            self.failed += failed
+        return results
+
+    def decrypt_events(self, room_id: str, events: List[Any]) -> List[Any]:
+        """
+        Decrypt the Megolm encrypted events of a room.
+
+        :param room_id: The room id.
+        :param events: The events, of any type.
+        :return: The events, the encrypted ones replaced by the decrypted events. Events that can't be decrypted are kept as they are.
+        """
+        return self._decrypt({room_id: events})[room_id]
+
+    def _decrypt(self, timeline: Dict[str, List[Any]],
+                 defer: bool = False) -> Dict[str, List[Any]]:
+        """Decrypt the events of several rooms in one batch, defer keeps the events without a room key."""
+        result = {room_id: list(events) for room_id, events in timeline.items()}
+        sessions: Dict[Session_Key, List[Tuple[str, int]]] = {}
+        hits = 0
+        for room_id, events in result.items():
+            for i, event in enumerate(events):
+                session = _session_key(room_id, event)
+                if session is None:
+                    continue
+                cached = self._cached(event.event_id) if event.event_id else None
+                if cached is not None:
+                    hits += 1
+                    events[i] = cached
+                    continue
+                sessions.setdefault(session, []).append((room_id, i))
+        if hits:
+            with self.lock:
+                self.hits += hits
+        if not sessions:
+            return result
+
+        jobs = [(session, [result[room_id][i] for room_id, i in positions])
+                for session, positions in sessions.items()]
+        with self.batch_lock:
+            if len(jobs) > 1 and sum(len(events) for _, events in jobs) >= self.batch_threshold:
+                decrypted = list(self.executor.map(lambda job: self._decrypt_session(*job, defer), jobs))
+            else:
+                decrypted = [self._decrypt_session(*job, defer) for job in jobs]
+
+        for (session, _), events in zip(jobs, decrypted):
+            for (room_id, i), event in zip(sessions[session], events):
+                if event is not None:
+                    result[room_id][i] = event
+        return result
+
+    def needed(self, delta: Sync_Delta) -> bool:
+        """
+        Check if a sync has anything to decrypt.
+
+        :param delta: The changes of the sync.
+        :return: True if it has encrypted to-device or timeline events.
+        """
+        return bool(delta.to_device) or any(
+            event.type == "m.room.encrypted"
+            for events in delta.timeline.values() for event in events)
+
+    def decrypt_delta(self, delta: Sync_Delta) -> None:
+        """
+        Store the room keys of a sync and replace its encrypted timeline events by the decrypted ones.
+
+        Events of earlier syncs that the new room keys decrypt are put in
+        front of the timeline of their room, so they are dispatched now.
+
+        :param delta: The changes of the sync, modified in place.
+        """
+        if delta.to_device:
+            late = self._take_pending(self._handle_to_device(delta.to_device))
+            for room_id, events in late.items():
+                timeline = delta.timeline.get(room_id, [])
+                ids = {event.event_id for event in timeline}
+                late_events = [event for event in events if event.event_id not in ids]
+                with self.lock:
+                    self.late += len(late_events)
+                delta.timeline[room_id] = late_events + timeline
+        if delta.timeline:
+            delta.timeline.update(self._decrypt(delta.timeline, defer=True))
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the decryption statistics.
+
+        :return: The number of decrypted events, cache hits, events without a known session, failures, added room keys, cached events, events waiting for their room key and events decrypted after it arrived.
+        """
+        with self.lock:
+            cached = len(self.cache)
+            pending = self.pending_count
+        return {
+            "decrypted": self.decrypted,
+            "hits": self.hits,
+            "missing": self.missing,
+            "failed": self.failed,
+            "room_keys": self.room_keys,
+            "cached": cached,
+            "pending": pending,
+            "late": self.late
+        }
+
+    def close(self) -> None:
+        """Shut the worker pool down."""
+        self.executor.shutdown(wait=False)
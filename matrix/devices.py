@@ -0,0 +1,226 @@
+from .classes import Device_Keys, Device_Keys_Response
+from concurrent.futures import Future
+from typing import Callable, Dict, Iterable, List, Set
+import threading
+import asyncio
+
+# Device keys of a user, keyed by device id
+Devices = Dict[str, Device_Keys]
+
+
+class DeviceStore():
+    def __init__(self,
+                 query: Callable[[List[str]], Device_Keys_Response],
+                 verify: Callable[[Device_Keys], bool] = None,
+                 batch_size: int = 100) -> None:
+        """
+        Initialize the device key store.
+
+        Caches the device keys of tracked users. Users are queried again
+        only after sync (or /keys/changes) reports their device list as
+        changed, outdated users are queried together in batches and a user
+        that is already being queried is not queried a second time.
+
+        :param query: Queries the device keys of users, e.g. Bot._query_device_keys.
+        :param verify: Checks a device key, keys it rejects are dropped. A verify with a verify_many method (e.g. e2ee.DeviceKeyVerifier) checks every response at once.
+        :param batch_size: How many users to query per /keys/query request.
+        """
+        self.query = query
+        self.verify = verify
+        self.batch_size = batch_size
+        self.devices: Dict[str, Devices] = {}
+        self.tracked: Set[str] = set()
+        self.outdated: Set[str] = set()
+        self.pending: Dict[str, Future] = {}
+        self.lock = threading.Lock()
+        self.queries = 0
+
+    def update(self, changed: Iterable[str] = (),
+               left: Iterable[str] = ()) -> None:
+        """
+        Apply the device_lists of a sync or a /keys/changes response.
+
+        :param changed: Users whose devices changed, their keys are queried again on the next get.
+        :param left: Users who no longer share an encrypted room, they are not tracked anymore.
+        """
+        with self.lock:
+            for user_id in changed:
+                if user_id in self.tracked:
+                    self.outdated.add(user_id)
+            for user_id in left:
+                self.tracked.discard(user_id)
+                self.outdated.discard(user_id)
+                self.devices.pop(user_id, None)
+
+    def forget(self) -> None:
+        """Mark all tracked users as outdated, e.g. after missing syncs."""
+        with self.lock:
+            self.outdated.update(self.tracked)
+
+    def cached(self, user_ids: Iterable[str]) -> Dict[str, Devices]:
+        """
+        Get the cached device keys without querying.
+
+        :param user_ids: The user ids.
+        :return: The device keys of the users that are cached.
+        """
+        with self.lock:
+            return {
+                user_id: dict(self.devices[user_id])
+                for user_id in user_ids if user_id in self.devices
+            }
+
+    def _claim(self, user_ids: List[str], future) -> tuple:
+        """Start tracking users and claim the outdated ones nobody queries yet."""
+        with self.lock:
+            self.tracked.update(user_ids)
+            claimed = [
+                user_id for user_id in dict.fromkeys(user_ids)
+                if (user_id in self.outdated or user_id not in self.devices)
+                and user_id not in self.pending
+            ]
+            waits = {
+                self.pending[user_id]
+                for user_id in user_ids if user_id in self.pending
+            }
+            for user_id in claimed:
+                self.pending[user_id] = future
+                # a change reported during the query marks it outdated again
+                self.outdated.discard(user_id)
+        return claimed, waits
+
+    def _release(self, user_ids: List[str], failed: bool) -> None:
+        """Stop marking users as being queried."""
+        with self.lock:
+            for user_id in user_ids:
+                self.pending.pop(user_id, None)
+                if failed: self.outdated.add(user_id)
+
+    def _batches(self, user_ids: List[str]) -> List[List[str]]:
+        """Split users into /keys/query batches."""
+        return [
+            user_ids[i:i + self.batch_size]
+            for i in range(0, len(user_ids), self.batch_size)
+        ]
+
+    def _check(self, res: Device_Keys_Response) -> Set[int]:
+        """Verify the device keys of a response, return the ids of the rejected Device_Keys objects."""
+        if not self.verify or not res or not res.device_keys:
+            return set()
+        devices = [device for keys in res.device_keys.values() for device in keys]
+        verify_many = getattr(self.verify, "verify_many", None)
+        if verify_many is not None:
+            valid = verify_many(devices)
+        else:
+            valid = [self.verify(device) for device in devices]
+        return {id(device) for device, ok in zip(devices, valid) if not ok}
+
+    def _apply(self, user_ids: List[str], res: Device_Keys_Response,
+               rejected: Set[int] = frozenset()) -> None:
+        """Store the queried device keys of users, except the rejected ones (see _check)."""
+        failures = (res.failures or {}) if res else {}
+        device_keys = (res.device_keys or {}) if res else {}
+        with self.lock:
+            self.queries += 1
+            for user_id in user_ids:
+                if user_id not in device_keys:
+                    if user_id.split(":", 1)[-1] in failures:
+                        # their homeserver didn't answer, try again next time
+                        self.outdated.add(user_id)
+                    else:
+                        self.devices[user_id] = {}
+                    continue
+
+                known = self.devices.get(user_id, {})
+                devices = {}
+                for device in device_keys[user_id]:
+                    if device.user_id != user_id or not device.device_id:
+                        continue
+                    old = known.get(device.device_id)
+                    key = f"ed25519:{device.device_id}"
+                    if old and (old.keys or {}).get(key) != (device.keys or {}).get(key):
+                        # a device must never change its identity key, keep the old one
+                        devices[device.device_id] = old
+                        continue
+                    if id(device) in rejected:
+                        continue
+                    devices[device.device_id] = device
+                self.devices[user_id] = devices
+
+    def get(self, user_ids: Iterable[str]) -> Dict[str, Devices]:
+        """
+        Get the device keys of users, querying the ones that aren't cached or are outdated.
+
+        :param user_ids: The user ids, they are tracked from now on.
+        :return: The device keys, keyed by user id and device id.
+        """
+        user_ids = list(user_ids)
+        future = Future()
+        claimed, waits = self._claim(user_ids, future)
+
+        if claimed:
+            failed = True
+            try:
+                for batch in self._batches(claimed):
+                    res = self.query(batch)
+                    self._apply(batch, res, self._check(res))
+                failed = False
+            finally:
+                self._release(claimed, failed)
+                future.set_result(None)
+
+        for other in waits:
+            other.result()
+        return self.cached(user_ids)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the store statistics.
+
+        :return: The number of tracked, outdated and cached users and of queries.
+        """
+        with self.lock:
+            return {
+                "tracked": len(self.tracked),
+                "outdated": len(self.outdated),
+                "cached": len(self.devices),
+                "queries": self.queries
+            }
+
+
+class AsyncDeviceStore(DeviceStore):
+    """
+    Device key store for AsyncBot, query is a coroutine function and get
+    a coroutine. Batches are queried concurrently.
+    """
+
+    async def get(self, user_ids: Iterable[str]) -> Dict[str, Devices]:
+        """
+        Get the device keys of users, querying the ones that aren't cached or are outdated.
+
+        :param user_ids: The user ids, they are tracked from now on.
+        :return: The device keys, keyed by user id and device id.
+        """
+        user_ids = list(user_ids)
+        future = asyncio.get_running_loop().create_future()
+        claimed, waits = self._claim(user_ids, future)
+
+        if claimed:
+            failed = True
+            try:
+                batches = self._batches(claimed)
+                results = await asyncio.gather(
+                    *[self.query(batch) for batch in batches])
+                loop = asyncio.get_running_loop()
+                for batch, res in zip(batches, results):
+                    # verifying thousands of keys takes a while, keep it off the event loop
+                    rejected = await loop.run_in_executor(None, self._check, res)
+                    self._apply(batch, res, rejected)
+                failed = False
+            finally:
+                self._release(claimed, failed)
+                future.set_result(None)
+
+        if waits:
+            await asyncio.gather(*waits)
+        return self.cached(user_ids)
@@ -1,8 +1,10 @@
 from dataclasses import dataclass
 from time import time
-from typing import List
+from typing import AsyncIterator, List
 from .API import Bot
 from .classes import Event
+from .history import iter_history
+from .utils import call_bot
 # https://discordpy.readthedocs.io/en/stable/api.html
 
 # https://discordpy.readthedocs.io/en/stable/api.html#user
@@ -35,15 +37,23 @@ class Room:
 
     async def send(self, content: str, msg_type: str = "m.text", formatted_body: str = None, format: str = None, info: dict = {}):
         """Send a message to the room."""
-        return self._bot.send_message(self.id, content, formatted_body=formatted_body, format=format, msgtype=msg_type, info=info)
+        return await call_bot(self._bot.send_message, self.id, content, formatted_body=formatted_body, format=format, msgtype=msg_type, info=info)
 
     async def invite_user(self, user_id: str):
         """Invite a user to the room."""
-        return self._bot.invite_to_room(user_id, self.id)
+        return await call_bot(self._bot.invite_to_room, user_id, self.id)
 
-    async def get_users(self) -> List[User]:
-        """Get the users of the room."""
-        return self._bot.get_room_members(self.id)
+    async def get_users(self, refresh: bool = False) -> List[User]:
+        """
+        Get the users of the room, cached after the first call.
+
+        :param refresh: Fetch the users from the homeserver even if they are cached.
+        """
+        return await call_bot(self._bot.get_room_members, self.id, refresh=refresh)
+
+    async def has_user(self, user_id: str) -> bool:
+        """Check if a user is joined to the room."""
+        return await call_bot(self._bot.is_room_member, self.id, user_id)
 
     async def kick_user(self, user_id: str):
         """Kick a user from the room. (Not implemented)"""
@@ -70,8 +80,29 @@ class Room:
         raise NotImplementedError
 
     async def get_messages(self, limit: int = 100) -> List[Message]:
-        """Get the messages of the room. (Not implemented)"""
-        raise NotImplementedError
+        """
+        Get the latest messages of the room, newest first.
+
+        :param limit: How many messages to get.
+        :return: The messages.
+        """
+        return [m async for m in self.history(limit=limit, page_size=min(limit, 100))]
+
+    async def history(self, limit: int = None, direction: str = "b", from_token: str = "", until_ts: int = None, until_event: str = None, types: List[str] = ["m.room.message"], page_size: int = 100) -> AsyncIterator[Message]:
+        """
+        Iterate over the messages of the room, see history.iter_history.
+
+        :param limit: Stop after this many messages.
+        :param direction: "b" to go back in time, "f" to go forward.
+        :param from_token: The pagination token to start at, the latest message if empty.
+        :param until_ts: Stop at messages older (or newer, going forward) than this timestamp in milliseconds.
+        :param until_event: Stop at this event id, it is not included.
+        :param types: Only get events of these types.
+        :param page_size: How many events to request per page.
+        :return: An async iterator over the messages.
+        """
+        async for event in iter_history(self._bot, self.id, direction=direction, from_token=from_token, types=types, until_ts=until_ts, until_event=until_event, limit=limit, page_size=page_size):
+            yield message_from_event(self._bot, self.id, event, room=self)
 
 
 
@@ -173,10 +204,45 @@ class Message:
                     {self.author}</a><br>{self.content}
                     </blockquote></mx-reply>{content}"""
             }
-            res = self._bot.send_room_event(self.room.id, "m.room.message", content)
+            res = await call_bot(self._bot.send_room_event, self.room.id, "m.room.message", content)
             return Event(event_id=res.get("event_id"), timestamp=time())
         else:
-            return self._bot.send_message(self.room.id, content)
+            return await call_bot(self._bot.send_message, self.room.id, content)
+
+
+def message_from_event(bot: Bot, room_id: str, event: Event, room: Room = None) -> Message:
+    """
+    Build a Message from a room event.
+
+    :param bot: The bot the message belongs to.
+    :param room_id: The room id.
+    :param event: The event.
+    :param room: The room of the message, built from the bot state if not given.
+    :return: The message.
+    """
+    if room is None:
+        state = bot.state.get_room(room_id)
+        last_message = state.timeline[-1] if state and state.timeline else event
+        room = Room(
+            id=room_id,
+            topic=None,
+            last_message=last_message,
+            last_message_id=last_message.event_id,
+            _bot=bot,
+        )
+
+    parsed = event.parsed_message
+    return Message(
+        type=event.type,
+        content=parsed.body if parsed else None,
+        author=event.sender,
+        id=event.event_id,
+        room=room,
+        channel=room,
+        created_at=event.timestamp,
+        edited_at=None,
+        _bot=bot,
+    )
 
 # https://discordpy.readthedocs.io/en/stable/api.html#invite
 @dataclass
@@ -195,7 +261,7 @@ class Invite:
         :param reason: The reason for accepting the invite.
         :return: The Event (Event ID and timestamp).
         """
-        return self._bot.join_room(self.room_id, reason=reason)
+        return await call_bot(self._bot.join_room, self.room_id, reason=reason)
     
     async def decline(self) -> Event:
         """
@@ -203,4 +269,4 @@ class Invite:
         
         :return: The Event (Event ID and timestamp).
         """
-        return self._bot.leave_room(self.room_id)
+        return await call_bot(self._bot.leave_room, self.room_id)
@@ -1,8 +1,15 @@
-from typing import List
-from olm import Account
-from olm.utility import ed25519_verify, OlmVerifyError
-from dataclasses import dataclass
-import json
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from olm import Account, InboundGroupSession, InboundSession, OlmMessage, OlmPreKeyMessage, OutboundGroupSession, OutboundSession, Session
+from olm.utility import _Utility, ed25519_verify, OlmVerifyError
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from .classes import Device_Keys
+from .codec import canonical_dumps
+from .crypto_store import CryptoStore, MemoryCryptoStore
+from . import codec
+from time import time
+import threading
 
 # https://poljar.github.io/python-olm/html/olm.html
 # https://matrix.org/docs/guides/end-to-end-encryption-implementation-guide
@@ -22,6 +29,14 @@ class One_time_keys:
     keys: List[str]
 
 
+@dataclass
+class Outbound_Group_Session:
+    """Outbound Megolm session of a room."""
+    session: OutboundGroupSession
+    created: float  # unix timestamp
+    shared_with: Set[str] = field(default_factory=set)  # "user_id|device_id"
+
+
 @dataclass
 class Encrypted_Event_Content:
     """Content of an encrypted event."""
@@ -33,23 +48,32 @@ class Encrypted_Event_Content:
 
 
 # from https://spec.matrix.org/v1.1/appendices/#signing-json
-def canonical_json(value: dict) -> str:
+def canonical_json(value: dict) -> bytes:
     """
     Canonicalize a JSON object.
 
     :param value: The JSON object.
     :return: The canonicalized JSON object.
     """
-    return json.dumps(
-        value,
-        # Encode code-points outside of ASCII as UTF-8 rather than \u escapes
-        ensure_ascii=False,
-        # Remove unnecessary white space.
-        separators=(',', ':'),
-        # Sort the keys of dictionaries.
-        sort_keys=True,
-        # Encode the resulting Unicode as UTF-8 bytes.
-    ).encode("UTF-8")
+    return canonical_dumps(value)
+
+
+def _device_key_message(device_keys: dict) -> bytes:
+    """Get the signed part of a device key: everything but signatures and unsigned, as canonical JSON."""
+    return canonical_json({
+        key: value
+        for key, value in device_keys.items()
+        if key not in ("signatures", "unsigned")
+    })
+
+
+def _device_key_signature(device_keys: dict) -> Tuple[str, str]:
+    """Get the ed25519 key of a device and the signature it made of its device key."""
+    key_id = f"ed25519:{device_keys.get('device_id')}"
+    key = (device_keys.get("keys") or {}).get(key_id)
+    signature = ((device_keys.get("signatures") or {}).get(
+        device_keys.get("user_id")) or {}).get(key_id)
+    return key, signature
 
 
 def check_device_key_signature(data: dict) -> bool:
@@ -63,36 +87,229 @@ def check_device_key_signature(data: dict) -> bool:
     signature for the signature parameter. If the signature 
     check fails, no further processing should be done on the device.
 
-    :param device_key: The device key to check
+    :param data: The DeviceKeys object, or a dict holding it as "device_keys".
     :return: True if the signature is valid, False otherwise
     """
+    device_keys = data.get("device_keys", data)
+    key, signature = _device_key_signature(device_keys)
+    if not key or not signature:
+        return False
+    try:
+        ed25519_verify(key, _device_key_message(device_keys), signature)
+        return True
+    except OlmVerifyError:
+        return False
 
-    device_keys = data["device_keys"]
-
-    # Remove the signature
-    device_key_json = device_keys.copy()
-    del device_key_json["signatures"]
 
-    # TODO: fix and test this
+def check_one_time_key_signature(one_time_key: dict, user_id: str,
+                                 device_id: str, ed25519_key: str) -> bool:
+    """
+    Check the signature of a signed_curve25519 key from /keys/claim, made by
+    the device it belongs to. Without it the homeserver could hand out a
+    one time key of its own.
 
+    :param one_time_key: The key object, {"key": ..., "signatures": ...}.
+    :param user_id: The user the device belongs to.
+    :param device_id: The device id.
+    :param ed25519_key: The verified ed25519 key of the device.
+    :return: True if the signature is valid, False otherwise
+    """
+    if not isinstance(one_time_key, dict) or not ed25519_key:
+        return False
+    signature = ((one_time_key.get("signatures") or {}).get(user_id)
+                 or {}).get(f"ed25519:{device_id}")
+    if not signature:
+        return False
     try:
-        ed25519_verify(device_keys["signatures"]["ed25519"],
-                       canonical_json(device_keys["signatures"]),
-                       device_keys["signatures"]["ed25519_key"])
+        ed25519_verify(ed25519_key, _device_key_message(one_time_key), signature)
         return True
     except OlmVerifyError:
         return False
 
 
-def get_encrypted_content(sender):
-    raise NotImplementedError
+def _device_keys_dict(device: Device_Keys) -> dict:
+    """Get the DeviceKeys object a Device_Keys was parsed from."""
+    if device.raw is not None:
+        return device.raw
+    data = {
+        "algorithms": device.algorithms,
+        "device_id": device.device_id,
+        "keys": device.keys,
+        "user_id": device.user_id,
+        "signatures": device.signatures
+    }
+    return {key: value for key, value in data.items() if value is not None}
+
+
+class DeviceKeyVerifier():
+    def __init__(self,
+                 max_workers: int = 4,
+                 cache_size: int = 10000,
+                 parallel_threshold: int = 64) -> None:
+        """
+        Initialize the device key signature checker.
+
+        Results are remembered per user, device and ed25519 key together
+        with the signed content, so a device whose key didn't change is
+        compared instead of canonicalized and verified again. Use it as
+        the verify callback of a DeviceStore, which checks every
+        /keys/query response at once through verify_many.
+
+        :param max_workers: How many threads verify large batches.
+        :param cache_size: How many results to remember.
+        :param parallel_threshold: Verify batches of at least this many unknown devices on the thread pool.
+        """
+        self.max_workers = max_workers
+        self.executor = None
+        self.cache_size = cache_size
+        self.parallel_threshold = parallel_threshold
+        self.cache: Dict[Tuple[str, str, str], Tuple[dict, bool]] = OrderedDict()
+        self.lock = threading.Lock()
+        self.verified = 0
+        self.hits = 0
+
+    def _lookup(self, data: dict) -> Tuple[Tuple[str, str, str], bool]:
+        """Get the cache key of a device key and the remembered result, None if unknown."""
+        key, signature = _device_key_signature(data)
+        cache_key = (data.get("user_id"), data.get("device_id"), key)
+        signed = {k: v for k, v in data.items() if k != "unsigned"}
+        with self.lock:
+            cached = self.cache.get(cache_key)
+            if cached is not None and cached[0] == signed:
+                self.cache.move_to_end(cache_key)
+                self.hits += 1
+                return cache_key, cached[1]
+        return cache_key, None
+
+    def _remember(self, cache_key: Tuple[str, str, str], data: dict,
+                  valid: bool) -> None:
+        """Remember the result of a device key."""
+        signed = {k: v for k, v in data.items() if k != "unsigned"}
+        with self.lock:
+            self.cache[cache_key] = (signed, valid)
+            self.cache.move_to_end(cache_key)
+            self.verified += 1
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+    def _check_all(self, items: List[dict]) -> List[bool]:
+        """Verify device keys, on the thread pool for large batches."""
+        if len(items) < self.parallel_threshold or self.max_workers < 2:
+            return [check_device_key_signature(data) for data in items]
+        if self.executor is None:
+            # ed25519_verify allocates one shared olm utility on first use,
+            # allocate it here before the threads race to do it
+            if not _Utility._utility:
+                _Utility._allocate()
+            self.executor = ThreadPoolExecutor(self.max_workers)
+        size = -(-len(items) // self.max_workers)
+        chunks = [items[i:i + size] for i in range(0, len(items), size)]
+        results = self.executor.map(
+            lambda chunk: [check_device_key_signature(data) for data in chunk],
+            chunks)
+        return [valid for chunk in results for valid in chunk]
+
+    def verify_many(self, devices: Iterable[Device_Keys]) -> List[bool]:
+        """
+        Check the signatures of many device keys.
+
+        :param devices: The device keys, as returned by /keys/query.
+        :return: For every device, whether its signature is valid.
+        """
+        devices = list(devices)
+        results: List[bool] = [None] * len(devices)
+        unknown = []
+        for i, device in enumerate(devices):
+            data = _device_keys_dict(device)
+            cache_key, valid = self._lookup(data)
+            if valid is None:
+                unknown.append((i, cache_key, data))
+            else:
+                results[i] = valid
+
+        checked = self._check_all([data for _, _, data in unknown])
+        for (i, cache_key, data), valid in zip(unknown, checked):
+            self._remember(cache_key, data, valid)
+            results[i] = valid
+        return results
+
+    def __call__(self, device: Device_Keys) -> bool:
+        """
+        Check the signature of a device key.
+
+        :param device: The device key.
+        :return: True if the signature is valid.
+        """
+        return self.verify_many([device])[0]
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the verifier statistics.
+
+        :return: The number of verified device keys, cache hits and cached results.
+        """
+        with self.lock:
+            return {
+                "verified": self.verified,
+                "hits": self.hits,
+                "cached": len(self.cache)
+            }
+
+    def close(self) -> None:
+        """Shut the thread pool down."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+
+def get_encrypted_content(olm: "Olm", room_id: str, event_type: str,
+                          content: dict) -> dict:
+    """
+    Encrypt an event for a room with its outbound Megolm session.
+
+    :param olm: The Olm engine.
+    :param room_id: The room id.
+    :param event_type: The type of the event to encrypt.
+    :param content: The content of the event to encrypt.
+    :return: The content of the m.room.encrypted event.
+    """
+    return olm.get_encrypted_content(room_id, event_type, content)
 
 
 class Olm():
-    def __init__(self):
-        """Initialize the Olm class."""
+    def __init__(self,
+                 store: CryptoStore = None,
+                 pickle_key: str = "",
+                 rotation_messages: int = 100,
+                 rotation_period: float = 7 * 24 * 60 * 60):
+        """
+        Initialize the Olm class.
+
+        Sessions are loaded from the store when they are first needed and
+        kept in memory from then on. A room keeps using its outbound Megolm
+        session until it encrypted rotation_messages messages or is older
+        than rotation_period.
+
+        :param store: Where to keep the account and the sessions, in memory if not given.
+        :param pickle_key: The passphrase the pickles are encrypted with.
+        :param rotation_messages: Replace an outbound session after this many messages, unless the room sets rotation_period_msgs.
+        :param rotation_period: Replace an outbound session after this many seconds, unless the room sets rotation_period_ms.
+        """
         self.active = False
         self.account = Account
+        self.store = store or MemoryCryptoStore()
+        self.pickle_key = pickle_key
+        self.rotation_messages = rotation_messages
+        self.rotation_period = rotation_period
+        self.user_id = None
+        self.device_id = None
+        self.lock = threading.RLock()
+        self.olm_sessions: Dict[str, List[Session]] = {}
+        self.inbound: Dict[Tuple[str, str, str], InboundGroupSession] = {}
+        # (room id, sender key, session id): (sender, ed25519 key of the device)
+        self.inbound_owners: Dict[Tuple[str, str, str], Tuple[Optional[str], Optional[str]]] = {}
+        self.outbound: Dict[str, Outbound_Group_Session] = {}
+        # outbound sessions that encrypted since they were stored, see flush
+        self.unsaved: Dict[str, Outbound_Group_Session] = {}
 
     def create(self) -> Account:
         """
@@ -102,6 +319,7 @@ class Olm():
         """
         self.account = Account()
         self.active = True
+        self.save_account()
         return self.account
 
     def load(self, pickle: str, passphrase: str = "") -> Account:
@@ -116,6 +334,382 @@ class Olm():
         self.active = True
         return self.account
 
+    def load_or_create(self) -> Account:
+        """
+        Load the account from the store, or create one if there is none.
+
+        :return: The Olm account.
+        """
+        pickle = self.store.load_account()
+        if pickle is None:
+            return self.create()
+        return self.load(pickle.encode(), self.pickle_key)
+
+    def save_account(self) -> None:
+        """Store the account, needed after its one time keys changed."""
+        self.store.save_account(self._pickle(self.account))
+        self.store.commit()
+
+    def _pickle(self, obj) -> str:
+        """Pickle an account or session with the pickle key."""
+        return obj.pickle(self.pickle_key).decode()
+
+    def _unpickle(self, cls, pickle: str):
+        """Load an account or session pickled with the pickle key."""
+        return cls.from_pickle(pickle.encode(), self.pickle_key)
+
+    # Megolm
+
+    def get_outbound_group_session(
+            self,
+            room_id: str,
+            rotation_messages: int = None,
+            rotation_period: float = None) -> Outbound_Group_Session:
+        """
+        Get the outbound Megolm session of a room, creating a new one if it needs to rotate.
+
+        :param room_id: The room id.
+        :param rotation_messages: Overrides the rotation_messages of the engine.
+        :param rotation_period: Overrides the rotation_period of the engine.
+        :return: The session, check shared_with before using it.
+        """
+        rotation_messages = rotation_messages or self.rotation_messages
+        rotation_period = rotation_period or self.rotation_period
+        with self.lock:
+            outbound = self.outbound.get(room_id)
+            if outbound is None:
+                stored = self.store.load_outbound_group_session(room_id)
+                if stored is not None:
+                    pickle, created, shared_with = stored
+                    outbound = Outbound_Group_Session(
+                        self._unpickle(OutboundGroupSession, pickle), created,
+                        set(shared_with))
+
+            if outbound is None or outbound.session.message_index >= rotation_messages \
+                    or time() - outbound.created >= rotation_period:
+                outbound = Outbound_Group_Session(OutboundGroupSession(), time())
+                # keep the inbound half to decrypt our own messages
+                own_keys = self.get_identity_keys()
+                self.add_inbound_group_session(room_id, own_keys["curve25519"],
+                                               outbound.session.session_key,
+                                               self.user_id, own_keys["ed25519"])
+                self._save_outbound(room_id, outbound)
+
+            self.outbound[room_id] = outbound
+            return outbound
+
+    def shared_users(self, room_id: str) -> Set[str]:
+        """
+        Get the users that got the key of the outbound session of a room.
+
+        :param room_id: The room id.
+        :return: The user ids, empty if the room has no outbound session.
+        """
+        with self.lock:
+            outbound = self.outbound.get(room_id)
+            if outbound is not None:
+                shared_with = outbound.shared_with
+            else:
+                stored = self.store.load_outbound_group_session(room_id)
+                shared_with = stored[2] if stored else []
+            return {device.split("|", 1)[0] for device in shared_with}
+
+    def _save_outbound(self, room_id: str, outbound: Outbound_Group_Session,
+                       commit: bool = True) -> None:
+        """Store an outbound session."""
+        self.unsaved.pop(room_id, None)
+        self.store.save_outbound_group_session(room_id,
+                                               self._pickle(outbound.session),
+                                               outbound.created,
+                                               sorted(outbound.shared_with))
+        if commit:
+            self.store.commit()
+
+    def _ratcheted(self, room_id: str, outbound: Outbound_Group_Session) -> None:
+        """
+        Note that an outbound session encrypted a message, it is stored by the next flush.
+
+        The stored copy is deleted until then, a restart after a crash
+        starts a new session instead of reusing message indices.
+        """
+        if self.outbound.get(room_id) is not outbound or room_id in self.unsaved:
+            return
+        self.unsaved[room_id] = outbound
+        self.store.delete_outbound_group_session(room_id)
+        self.store.commit()
+
+    def flush(self) -> None:
+        """Store the outbound sessions that encrypted messages since they were last stored, in one transaction."""
+        with self.lock:
+            if not self.unsaved:
+                return
+            for room_id, outbound in list(self.unsaved.items()):
+                if self.outbound.get(room_id) is outbound:
+                    self._save_outbound(room_id, outbound, commit=False)
+            self.unsaved.clear()
+            self.store.commit()
+
+    def discard_outbound_group_session(self, room_id: str) -> None:
+        """
+        Stop using the outbound session of a room, e.g. after a member left.
+
+        :param room_id: The room id.
+        """
+        with self.lock:
+            self.outbound.pop(room_id, None)
+            self.unsaved.pop(room_id, None)
+            self.store.delete_outbound_group_session(room_id)
+            self.store.commit()
+
+    def _current_outbound(self, room_id: str) -> Outbound_Group_Session:
+        """Get the outbound session of a room without rotating a loaded one."""
+        with self.lock:
+            return self.outbound.get(
+                room_id) or self.get_outbound_group_session(room_id)
+
+    def _save_if_current(self, room_id: str,
+                         outbound: Outbound_Group_Session) -> None:
+        """Store an outbound session, unless it was discarded or rotated meanwhile."""
+        if self.outbound.get(room_id) is outbound:
+            self._save_outbound(room_id, outbound)
+
+    def mark_shared(self, room_id: str, devices: List[str],
+                    outbound: Outbound_Group_Session = None) -> None:
+        """
+        Remember that devices got the key of the outbound session of a room.
+
+        :param room_id: The room id.
+        :param devices: The devices, as "user_id|device_id".
+        :param outbound: The session that was shared, the current one if not given.
+        """
+        with self.lock:
+            outbound = outbound or self._current_outbound(room_id)
+            outbound.shared_with.update(devices)
+            self._save_if_current(room_id, outbound)
+
+    def room_key_content(self, room_id: str,
+                         outbound: Outbound_Group_Session = None) -> dict:
+        """
+        Build the m.room_key content that shares the outbound session of a room.
+
+        :param room_id: The room id.
+        :param outbound: The session to share, the current one if not given.
+        :return: The content.
+        """
+        session = (outbound or self._current_outbound(room_id)).session
+        return {
+            "algorithm": "m.megolm.v1.aes-sha2",
+            "room_id": room_id,
+            "session_id": session.id,
+            "session_key": session.session_key
+        }
+
+    def get_encrypted_content(self,
+                              room_id: str,
+                              event_type: str,
+                              content: dict,
+                              rotation_messages: int = None,
+                              rotation_period: float = None,
+                              outbound: Outbound_Group_Session = None) -> dict:
+        """
+        Encrypt an event for a room with its outbound Megolm session.
+
+        :param room_id: The room id.
+        :param event_type: The type of the event to encrypt.
+        :param content: The content of the event to encrypt.
+        :param rotation_messages: Overrides the rotation_messages of the engine.
+        :param rotation_period: Overrides the rotation_period of the engine.
+        :param outbound: Encrypt with this session, e.g. the one whose key was just shared, instead of the current one.
+        :return: The content of the m.room.encrypted event.
+        """
+        payload = codec.dumps({
+            "type": event_type,
+            "content": content,
+            "room_id": room_id
+        }).decode("UTF-8")
+        with self.lock:
+            outbound = outbound or self.get_outbound_group_session(
+                room_id, rotation_messages, rotation_period)
+            ciphertext = outbound.session.encrypt(payload)
+            self._ratcheted(room_id, outbound)
+            return Encrypted_Event_Content(
+                sender_key=self.get_identity_keys()["curve25519"],
+                ciphertext=ciphertext,
+                session_id=outbound.session.id,
+                device_id=self.device_id).__dict__
+
+    def add_inbound_group_session(self, room_id: str, sender_key: str,
+                                  session_key: str, sender: str = None,
+                                  signing_key: str = None) -> InboundGroupSession:
+        """
+        Store the inbound Megolm session from a m.room_key event.
+
+        :param room_id: The room id.
+        :param sender_key: The curve25519 key of the sending device.
+        :param session_key: The session key.
+        :param sender: The user that sent the room key, only their events are decrypted with the session.
+        :param signing_key: The verified ed25519 key of the sending device.
+        :return: The session.
+        """
+        session = InboundGroupSession(session_key)
+        key = (room_id, sender_key, session.id)
+        with self.lock:
+            self.inbound[key] = session
+            self.inbound_owners[key] = (sender, signing_key)
+            self.store.save_inbound_group_session(room_id, sender_key,
+                                                  session.id,
+                                                  self._pickle(session),
+                                                  sender, signing_key)
+            self.store.commit()
+        return session
+
+    def get_inbound_group_session(self, room_id: str, sender_key: str,
+                                  session_id: str) -> InboundGroupSession:
+        """
+        Get an inbound Megolm session.
+
+        :param room_id: The room id.
+        :param sender_key: The curve25519 key of the sending device.
+        :param session_id: The session id.
+        :return: The session, or None if it is unknown.
+        """
+        key = (room_id, sender_key, session_id)
+        with self.lock:
+            session = self.inbound.get(key)
+            if session is None:
+                stored = self.store.load_inbound_group_session(*key)
+                if stored is not None:
+                    pickle, sender, signing_key = stored
+                    session = self._unpickle(InboundGroupSession, pickle)
+                    self.inbound[key] = session
+                    self.inbound_owners[key] = (sender, signing_key)
+            return session
+
+    def get_inbound_group_session_owner(
+            self, room_id: str, sender_key: str,
+            session_id: str) -> Tuple[Optional[str], Optional[str]]:
+        """
+        Get who shared an inbound Megolm session with us.
+
+        :param room_id: The room id.
+        :param sender_key: The curve25519 key of the sending device.
+        :param session_id: The session id.
+        :return: The user that sent the room key and the ed25519 key of their device, (None, None) if unknown.
+        """
+        with self.lock:
+            if self.get_inbound_group_session(room_id, sender_key, session_id) is None:
+                return None, None
+            return self.inbound_owners.get((room_id, sender_key, session_id), (None, None))
+
+    def decrypt_group(self, room_id: str, sender_key: str, session_id: str,
+                      ciphertext: str) -> Tuple[dict, int]:
+        """
+        Decrypt a Megolm message.
+
+        :param room_id: The room id.
+        :param sender_key: The curve25519 key of the sending device.
+        :param session_id: The session id.
+        :param ciphertext: The ciphertext.
+        :return: The decrypted payload and its message index, or (None, None) if the session is unknown.
+        """
+        session = self.get_inbound_group_session(room_id, sender_key,
+                                                 session_id)
+        if session is None:
+            return None, None
+        plaintext, index = session.decrypt(ciphertext)
+        return codec.loads(plaintext), index
+
+    # Olm
+
+    def get_olm_sessions(self, sender_key: str) -> List[Session]:
+        """
+        Get the Olm sessions with a device, most recently used first.
+
+        :param sender_key: The curve25519 key of the device.
+        :return: The sessions.
+        """
+        with self.lock:
+            sessions = self.olm_sessions.get(sender_key)
+            if sessions is None:
+                sessions = [
+                    self._unpickle(Session, pickle)
+                    for pickle in self.store.load_olm_sessions(sender_key)
+                ]
+                self.olm_sessions[sender_key] = sessions
+            return sessions
+
+    def _use_olm_session(self, sender_key: str, session: Session) -> None:
+        """Move a session to the front and store it."""
+        sessions = self.get_olm_sessions(sender_key)
+        if session in sessions:
+            sessions.remove(session)
+        sessions.insert(0, session)
+        self.store.save_olm_session(sender_key, session.id,
+                                    self._pickle(session), time())
+        self.store.commit()
+
+    def create_olm_session(self, identity_key: str,
+                           one_time_key: str) -> Session:
+        """
+        Start an Olm session with a device.
+
+        :param identity_key: The curve25519 key of the device.
+        :param one_time_key: A one time key claimed from the device.
+        :return: The session.
+        """
+        session = OutboundSession(self.account, identity_key, one_time_key)
+        with self.lock:
+            self._use_olm_session(identity_key, session)
+        return session
+
+    def encrypt_olm(self, identity_key: str, payload: dict) -> dict:
+        """
+        Encrypt a payload for a device with the most recent Olm session.
+
+        :param identity_key: The curve25519 key of the device.
+        :param payload: The payload.
+        :return: The ciphertext entry of the device ({"type": ..., "body": ...}).
+        """
+        with self.lock:
+            sessions = self.get_olm_sessions(identity_key)
+            if not sessions:
+                raise ValueError(f"No Olm session with {identity_key}")
+            session = sessions[0]
+            message = session.encrypt(codec.dumps(payload).decode("UTF-8"))
+            self._use_olm_session(identity_key, session)
+        return {"type": message.message_type, "body": message.ciphertext}
+
+    def decrypt_olm(self, sender_key: str, message_type: int,
+                    body: str) -> dict:
+        """
+        Decrypt an Olm message, starting a new session for pre-key messages.
+
+        :param sender_key: The curve25519 key of the sending device.
+        :param message_type: 0 for pre-key messages, 1 for normal messages.
+        :param body: The ciphertext.
+        :return: The decrypted payload.
+        """
+        message = OlmPreKeyMessage(body) if message_type == 0 else OlmMessage(body)
+        with self.lock:
+            for session in self.get_olm_sessions(sender_key):
+                if message_type == 0 and not session.matches(message, sender_key):
+                    continue
+                try:
+                    plaintext = session.decrypt(message)
+                except Exception:
+                    continue
+                self._use_olm_session(sender_key, session)
+                return codec.loads(plaintext)
+
+            if message_type != 0:
+                raise ValueError(f"No Olm session with {sender_key} can decrypt the message")
+            session = InboundSession(self.account, message, sender_key)
+            self.account.remove_one_time_keys(session)
+            self.save_account()
+            plaintext = session.decrypt(message)
+            self._use_olm_session(sender_key, session)
+            return codec.loads(plaintext)
+
     def get_identity_keys(self):
         """
         Get the identity keys.
@@ -141,3 +735,57 @@ class Olm():
         :param count: The number of keys to generate.
         """
         self.account.generate_one_time_keys(count)
+
+    def _sign(self, value: dict) -> dict:
+        """Build the signatures property of a JSON object signed with our ed25519 key."""
+        signature = self.account.sign(canonical_json(value))
+        return {self.user_id: {f"ed25519:{self.device_id}": signature}}
+
+    def device_keys(self) -> dict:
+        """
+        Build our signed device keys, as uploaded to /keys/upload.
+
+        :return: The DeviceKeys object.
+        """
+        identity_keys = self.get_identity_keys()
+        device_keys = {
+            "user_id": self.user_id,
+            "device_id": self.device_id,
+            "algorithms": ["m.olm.v1.curve25519-aes-sha2", "m.megolm.v1.aes-sha2"],
+            "keys": {
+                f"curve25519:{self.device_id}": identity_keys["curve25519"],
+                f"ed25519:{self.device_id}": identity_keys["ed25519"]
+            }
+        }
+        device_keys["signatures"] = self._sign(device_keys)
+        return device_keys
+
+    def signed_one_time_keys(self, count: int) -> Dict[str, dict]:
+        """
+        Generate one time keys until count of them are unpublished and sign all unpublished ones.
+
+        Keys stay unpublished until mark_keys_as_published, so the keys of
+        a failed upload are signed and uploaded again next time.
+
+        :param count: How many unpublished keys there should be, capped to half of what the account can hold.
+        :return: The signed keys, keyed by "signed_curve25519:<key id>".
+        """
+        with self.lock:
+            count = min(count, self.account.max_one_time_keys // 2)
+            unpublished = self.account.one_time_keys["curve25519"]
+            if count > len(unpublished):
+                self.account.generate_one_time_keys(count - len(unpublished))
+                unpublished = self.account.one_time_keys["curve25519"]
+            signed = {}
+            for key_id, key in unpublished.items():
+                signed[f"signed_curve25519:{key_id}"] = {
+                    "key": key,
+                    "signatures": self._sign({"key": key})
+                }
+            return signed
+
+    def mark_keys_as_published(self) -> None:
+        """Mark the unpublished one time keys as uploaded and store the account."""
+        with self.lock:
+            self.account.mark_keys_as_published()
+            self.save_account()
@@ -1,9 +1,16 @@
 class MatrixError(Exception):
-    pass
+    def __init__(self, message: str = "", errcode: str = None, status_code: int = None):
+        super().__init__(message)
+        self.errcode = errcode
+        self.status_code = status_code
+
+class RateLimited(MatrixError):
+    def __init__(self, message: str = "", errcode: str = "M_LIMIT_EXCEEDED", status_code: int = 429, retry_after_ms: int = None):
+        super().__init__(message, errcode, status_code)
+        self.retry_after_ms = retry_after_ms
 
 class NotAuthenticated(Exception):
     pass
 
 class ParsingError(Exception):
     pass
-
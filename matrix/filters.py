@@ -0,0 +1,59 @@
+from typing import List
+
+# https://spec.matrix.org/v1.1/client-server-api/#filtering
+
+# Events that carry conversation rather than room state, safe to drop from
+# the timeline when nothing handles messages.
+MESSAGE_EVENT_TYPES = [
+    "m.room.message", "m.room.encrypted", "m.reaction", "m.sticker"
+]
+
+
+def make_sync_filter(timeline_limit: int = None,
+                     timeline_types: List[str] = None,
+                     timeline_not_types: List[str] = None,
+                     lazy_load_members: bool = True,
+                     rooms: List[str] = None,
+                     not_rooms: List[str] = None,
+                     presence: bool = False,
+                     ephemeral: bool = False,
+                     account_data: bool = False) -> dict:
+    """
+    Build a filter for /sync.
+
+    The homeserver applies the timeline limit to every room, it has no
+    per-room limits. Use rooms/not_rooms to restrict which rooms are synced.
+
+    :param timeline_limit: How many timeline events to send per room.
+    :param timeline_types: Only send these timeline event types (state events of other types are lost!).
+    :param timeline_not_types: Don't send these timeline event types.
+    :param lazy_load_members: Only send the m.room.member events of senders in the timeline.
+    :param rooms: Only sync these rooms.
+    :param not_rooms: Don't sync these rooms.
+    :param presence: Send presence events.
+    :param ephemeral: Send typing notifications and receipts.
+    :param account_data: Send global and room account data.
+    :return: The filter.
+    """
+    nothing = {"not_types": ["*"]}
+
+    timeline = {"lazy_load_members": lazy_load_members}
+    if timeline_limit is not None: timeline["limit"] = timeline_limit
+    if timeline_types is not None: timeline["types"] = timeline_types
+    if timeline_not_types: timeline["not_types"] = timeline_not_types
+
+    room = {
+        "timeline": timeline,
+        "state": {
+            "lazy_load_members": lazy_load_members
+        },
+    }
+    if rooms is not None: room["rooms"] = rooms
+    if not_rooms: room["not_rooms"] = not_rooms
+    if not ephemeral: room["ephemeral"] = nothing
+    if not account_data: room["account_data"] = nothing
+
+    data = {"room": room}
+    if not presence: data["presence"] = nothing
+    if not account_data: data["account_data"] = nothing
+    return data
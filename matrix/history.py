@@ -0,0 +1,89 @@
+from .classes import Event, Room_Events_Page
+from functools import partial
+from typing import Any, AsyncIterator, List
+import asyncio
+
+
+def _fetch_page(bot: Any, room_id: str, token: str, direction: str,
+                page_size: int, filter: Any) -> "asyncio.Future[Room_Events_Page]":
+    """Start fetching a page, in the background so it overlaps with the caller's work."""
+    fetch = partial(bot.get_room_events_page, room_id, token, direction,
+                    page_size, filter)
+    if asyncio.iscoroutinefunction(bot.get_room_events_page):
+        return asyncio.ensure_future(fetch())
+    # a blocking Bot fetches in a thread
+    return asyncio.get_running_loop().run_in_executor(None, fetch)
+
+
+def _reached(event: Event, direction: str, until_ts: int,
+             until_event: str) -> bool:
+    """Check if an event is past the point the iteration stops at."""
+    if until_event is not None and event.event_id == until_event:
+        return True
+    if until_ts is None or event.timestamp is None:
+        return False
+    if direction == "b":
+        return event.timestamp < until_ts
+    return event.timestamp > until_ts
+
+
+async def iter_history(bot: Any,
+                       room_id: str,
+                       direction: str = "b",
+                       from_token: str = "",
+                       types: List[str] = None,
+                       filter: Any = None,
+                       until_ts: int = None,
+                       until_event: str = None,
+                       limit: int = None,
+                       page_size: int = 100) -> AsyncIterator[Event]:
+    """
+    Iterate over the events of a room, following the pagination tokens.
+
+    The next page is requested as soon as a page arrives, so it loads
+    while the caller handles the current one. Works with Bot and AsyncBot.
+
+    :param bot: The Bot or AsyncBot.
+    :param room_id: The room id.
+    :param direction: "b" to go back in time, "f" to go forward.
+    :param from_token: The pagination token to start at, the latest event if empty.
+    :param types: Only get events of these types. Encrypted events are requested as well and kept if they decrypt to one of them.
+    :param filter: A RoomEventFilter dict or JSON string, replaces types.
+    :param until_ts: Stop at events older (or newer, going forward) than this timestamp in milliseconds.
+    :param until_event: Stop at this event id, it is not included.
+    :param limit: Stop after this many events.
+    :param page_size: How many events to request per page.
+    :return: An async iterator over the events.
+    """
+    wanted = None
+    if not filter and types:
+        wanted = set(types)
+        # the homeserver only sees the m.room.encrypted type of encrypted events
+        filter = {"types": list(dict.fromkeys([*types, "m.room.encrypted"]))}
+
+    count = 0
+    token = from_token
+    pending = _fetch_page(bot, room_id, token, direction, page_size, filter)
+    try:
+        while pending is not None:
+            page = await pending
+            pending = None
+            # a page can be empty after filtering, only a missing end token
+            # (or one that doesn't move) marks the end of the history
+            if page.end and page.end not in (page.start, token):
+                token = page.end
+                pending = _fetch_page(bot, room_id, token, direction,
+                                      page_size, filter)
+
+            for event in page.events:
+                if _reached(event, direction, until_ts, until_event):
+                    return
+                if wanted is not None and event.type not in wanted:
+                    continue
+                yield event
+                count += 1
+                if limit and count >= limit:
+                    return
+    finally:
+        if pending is not None:
+            pending.cancel()
@@ -0,0 +1,163 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Mapping, Optional, Tuple
+import threading
+import asyncio
+
+ALGORITHM = "signed_curve25519"
+
+
+class OneTimeKeyMaintainer():
+    def __init__(self,
+                 upload: Callable[[dict, Mapping[str, dict]], dict],
+                 olm: Any,
+                 target: int = None) -> None:
+        """
+        Initialize the one time key maintainer.
+
+        Every sync reports how many of our one time keys the homeserver
+        still has. Once that drops below the target, the missing keys are
+        generated, signed and uploaded in one request in the background,
+        then marked as published on the account. Only one upload runs at
+        a time. Counts reported while it runs, and by the first sync after
+        it, were likely counted before the upload, so the count of the
+        upload response is trusted instead of them.
+
+        :param upload: Uploads keys, called as upload(device_keys, one_time_keys), e.g. Bot.upload_keys.
+        :param olm: The Olm engine holding the account.
+        :param target: How many keys the homeserver should hold, half of what the account can hold by default.
+        """
+        self.upload = upload
+        self.olm = olm
+        self.target = target
+        self.count: Optional[int] = None
+        self.device_keys_uploaded = False
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(1)
+        self.pending: Future = None
+        # syncs whose counts to ignore, they may predate the last upload
+        self.stale_syncs = 0
+        self.uploads = 0
+        self.uploaded = 0
+        self.failed = 0
+
+    def _target(self) -> int:
+        """Get the number of keys to hold."""
+        return self.target or self.olm.account.max_one_time_keys // 2
+
+    def _needed(self, counts: Mapping[str, int]) -> bool:
+        """Remember the reported key count and check if keys have to be uploaded."""
+        if not self.olm.active or counts is None or (self.pending and not self.pending.done()):
+            return False
+        if self.stale_syncs:
+            self.stale_syncs -= 1
+            return False
+        self.count = counts.get(ALGORITHM, 0)
+        return self.count < self._target() or not self.device_keys_uploaded
+
+    def _prepare(self) -> Tuple[Optional[dict], Dict[str, dict]]:
+        """Sign the device keys if they weren't uploaded yet and the one time keys the homeserver is missing."""
+        device_keys = None if self.device_keys_uploaded else self.olm.device_keys()
+        missing = max(self._target() - (self.count or 0), 0)
+        one_time_keys = self.olm.signed_one_time_keys(missing) if missing else {}
+        return device_keys, one_time_keys
+
+    def _published(self, one_time_keys: Dict[str, dict], res: dict) -> None:
+        """Mark the uploaded keys as published and take over the new count."""
+        if one_time_keys:
+            self.olm.mark_keys_as_published()
+        self.device_keys_uploaded = True
+        self.uploads += 1
+        self.uploaded += len(one_time_keys)
+        counts = (res or {}).get("one_time_key_counts")
+        with self.lock:
+            if counts is not None:
+                self.count = counts.get(ALGORITHM, 0)
+            self.stale_syncs = 1
+
+    def update(self, counts: Mapping[str, int]) -> None:
+        """
+        Take the one time key counts of a sync, uploading keys in the background if they run low.
+
+        :param counts: The device_one_time_keys_count of the sync.
+        """
+        with self.lock:
+            if not self._needed(counts):
+                return
+            self.pending = self.executor.submit(self.replenish)
+
+    def replenish(self) -> dict:
+        """
+        Upload the keys the homeserver is missing now.
+
+        :return: The response from the homeserver, None if nothing was uploaded.
+        """
+        device_keys, one_time_keys = self._prepare()
+        if device_keys is None and not one_time_keys:
+            return None
+        try:
+            res = self.upload(device_keys, one_time_keys)
+        except Exception:
+            # the keys stay unpublished and are uploaded with the next batch
+            self.failed += 1
+            raise
+        self._published(one_time_keys, res)
+        return res
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the maintainer statistics.
+
+        :return: The last reported key count, the number of uploads, uploaded keys and failed uploads.
+        """
+        return {
+            "count": self.count,
+            "uploads": self.uploads,
+            "uploaded": self.uploaded,
+            "failed": self.failed
+        }
+
+    def close(self) -> None:
+        """Stop the background uploads, a running one still finishes."""
+        self.executor.shutdown(wait=False)
+
+
+class AsyncOneTimeKeyMaintainer(OneTimeKeyMaintainer):
+    """
+    One time key maintainer for AsyncBot, upload is a coroutine function
+    and the uploads run as tasks on the event loop.
+    """
+
+    def update(self, counts: Mapping[str, int]) -> None:
+        """
+        Take the one time key counts of a sync, uploading keys in a task if they run low.
+
+        :param counts: The device_one_time_keys_count of the sync.
+        """
+        if not self._needed(counts):
+            return
+        self.pending = asyncio.ensure_future(self.replenish())
+        # failures are counted in replenish, don't warn about them again
+        self.pending.add_done_callback(
+            lambda task: task.cancelled() or task.exception())
+
+    async def replenish(self) -> dict:
+        """
+        Upload the keys the homeserver is missing now.
+
+        :return: The response from the homeserver, None if nothing was uploaded.
+        """
+        device_keys, one_time_keys = self._prepare()
+        if device_keys is None and not one_time_keys:
+            return None
+        try:
+            res = await self.upload(device_keys, one_time_keys)
+        except Exception:
+            self.failed += 1
+            raise
+        self._published(one_time_keys, res)
+        return res
+
+    def close(self) -> None:
+        """Cancel a running upload."""
+        if self.pending and not self.pending.done():
+            self.pending.cancel()
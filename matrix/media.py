@@ -0,0 +1,422 @@
+from typing import Any, AsyncIterator, BinaryIO, Callable, Dict, Iterator, Optional, Tuple
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import tempfile
+import hashlib
+import asyncio
+import mmap
+import os
+import re
+
+# Called with the bytes transferred so far and the total size, if known
+Progress = Callable[[int, Optional[int]], None]
+
+CHUNK_SIZE = 64 * 1024
+
+
+def parse_mxc(mxc_uri: str) -> Tuple[str, str]:
+    """
+    Split a mxc:// uri.
+
+    :param mxc_uri: The uri, e.g. mxc://example.org/abcdef
+    :return: The server name and the media id.
+    """
+    match = re.fullmatch(r"mxc://([^/]+)/([^/?#]+)", mxc_uri)
+    if not match:
+        raise ValueError(f"Invalid mxc uri: {mxc_uri}")
+    return match.group(1), match.group(2)
+
+
+def parse_content_range(value: str) -> Tuple[Optional[int], Optional[int]]:
+    """
+    Parse a Content-Range header.
+
+    :param value: The header, e.g. "bytes 100-199/1000".
+    :return: The first byte and the total size, None if unknown.
+    """
+    match = re.fullmatch(r"bytes (\d+)-\d+/(\d+|\*)", (value or "").strip())
+    if not match:
+        return None, None
+    total = match.group(2)
+    return int(match.group(1)), None if total == "*" else int(total)
+
+
+class UploadStream():
+    def __init__(self,
+                 source: Any,
+                 chunk_size: int = CHUNK_SIZE,
+                 progress: Progress = None,
+                 chunked: bool = False) -> None:
+        """
+        Wrap upload content, so it is read in chunks instead of all at once.
+
+        :param source: A path (str is treated as content, use pathlib.Path or os.fspath-able objects), a binary file object, a mmap, bytes or an iterator of bytes.
+        :param chunk_size: How many bytes to read at once.
+        :param progress: Called with the bytes sent so far and the total size.
+        :param chunked: Send with chunked transfer encoding instead of a Content-Length.
+        """
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.owns_file = isinstance(source, os.PathLike)
+        if self.owns_file:
+            source = open(source, "rb")
+        elif isinstance(source, str):
+            source = source.encode("UTF-8")
+        if isinstance(source, (bytes, bytearray)):
+            source = memoryview(source)
+        elif not isinstance(source, (memoryview, mmap.mmap)) and not hasattr(source, "read"):
+            source = iter(source)
+
+        self.source = source
+        self.start = self._tell()
+        self.total = self._size()
+        # iterators have no size, they always need chunked transfer encoding
+        self.chunked = chunked or self.total is None
+        self.sent = 0
+
+    def _tell(self) -> int:
+        """Get the position the upload starts at."""
+        if isinstance(self.source, memoryview):
+            return 0
+        try:
+            return self.source.tell()
+        except (AttributeError, OSError):
+            return 0
+
+    def _size(self) -> Optional[int]:
+        """Get the number of bytes to upload, None if unknown."""
+        if isinstance(self.source, (memoryview, mmap.mmap)):
+            return len(self.source) - self.start
+        try:
+            return os.fstat(self.source.fileno()).st_size - self.start
+        except (AttributeError, OSError, ValueError):
+            pass
+        try:
+            end = self.source.seek(0, os.SEEK_END)
+            self.source.seek(self.start)
+            return end - self.start
+        except (AttributeError, OSError):
+            return None
+
+    def read(self, size: int = -1) -> bytes:
+        """
+        Read the next chunk.
+
+        :param size: How many bytes to read at most, -1 for a chunk.
+        :return: The chunk, empty at the end.
+        """
+        if size is None or size < 0:
+            size = self.chunk_size
+        if isinstance(self.source, memoryview):
+            chunk = bytes(self.source[self.sent:self.sent + size])
+        elif hasattr(self.source, "read"):
+            chunk = self.source.read(size)
+        else:
+            chunk = next(self.source, b"")
+        if isinstance(chunk, str):
+            chunk = chunk.encode("UTF-8")
+
+        if chunk:
+            self.sent += len(chunk)
+            if self.progress: self.progress(self.sent, self.total)
+        elif self.owns_file:
+            self.source.close()
+        return chunk
+
+    def __len__(self) -> int:
+        return self.total or 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            chunk = self.read()
+            if not chunk:
+                return
+            yield chunk
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        # file reads block, keep them off the event loop
+        loop = asyncio.get_running_loop()
+        while True:
+            chunk = await loop.run_in_executor(None, self.read)
+            if not chunk:
+                return
+            yield chunk
+
+    def rewind(self) -> bool:
+        """
+        Go back to the start, to send the content again.
+
+        :return: False if the source can't go back.
+        """
+        if not self.sent:
+            return True
+        if isinstance(self.source, memoryview):
+            self.sent = 0
+            return True
+        try:
+            if self.owns_file and self.source.closed:
+                self.source = open(self.source.name, "rb")
+            self.source.seek(self.start)
+        except (AttributeError, OSError, ValueError):
+            return False
+        self.sent = 0
+        return True
+
+
+def iter_file(file: BinaryIO, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """
+    Read a file in chunks and close it.
+
+    :param file: The binary file object.
+    :param chunk_size: How many bytes to read at once.
+    :return: An iterator over the chunks.
+    """
+    with file:
+        while True:
+            chunk = file.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+async def aiter_file(file: BinaryIO,
+                     chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """
+    Read a file in chunks without blocking the event loop and close it.
+
+    :param file: The binary file object.
+    :param chunk_size: How many bytes to read at once.
+    :return: An async iterator over the chunks.
+    """
+    loop = asyncio.get_running_loop()
+    with file:
+        while True:
+            chunk = await loop.run_in_executor(None, file.read, chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def write_chunks(chunks: Iterator[bytes], file: Any) -> int:
+    """
+    Write chunks to a file.
+
+    :param chunks: The chunks.
+    :param file: A path or a binary file object.
+    :return: The number of bytes written.
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "wb") as f:
+            return write_chunks(chunks, f)
+    size = 0
+    for chunk in chunks:
+        file.write(chunk)
+        size += len(chunk)
+    return size
+
+
+async def awrite_chunks(chunks: AsyncIterator[bytes], file: Any) -> int:
+    """
+    Write async chunks to a file.
+
+    :param chunks: The chunks.
+    :param file: A path or a binary file object.
+    :return: The number of bytes written.
+    """
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "wb") as f:
+            return await awrite_chunks(chunks, f)
+    size = 0
+    async for chunk in chunks:
+        file.write(chunk)
+        size += len(chunk)
+    return size
+
+
+class MediaCache():
+    def __init__(self, path: str, max_size: int = 512 * 1024 * 1024) -> None:
+        """
+        Initialize an on-disk media cache with least recently used eviction.
+
+        Entries are keyed by mxc uri (and thumbnail size and method), see
+        key. The least recently used order survives restarts through the
+        modification times of the files.
+
+        :param path: The cache directory, created if it doesn't exist.
+        :param max_size: Evict entries once the cache is larger than this many bytes.
+        """
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.entries: Dict[str, int] = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        os.makedirs(path, exist_ok=True)
+        files = []
+        for entry in os.scandir(path):
+            if entry.name.startswith(".tmp"):
+                # left behind by a crashed write
+                os.remove(entry.path)
+            elif entry.is_file():
+                stat = entry.stat()
+                files.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+
+    @staticmethod
+    def key(mxc_uri: str,
+            width: int = None,
+            height: int = None,
+            method: str = None) -> str:
+        """
+        Build the cache key of media or a thumbnail.
+
+        :param mxc_uri: The mxc:// uri.
+        :param width: The thumbnail width.
+        :param height: The thumbnail height.
+        :param method: The thumbnail method, "crop" or "scale".
+        :return: The key.
+        """
+        if width is None:
+            return mxc_uri
+        return f"{mxc_uri}#{width}x{height}/{method}"
+
+    def _name(self, key: str) -> str:
+        """Get the file name of a key."""
+        return hashlib.sha256(key.encode("UTF-8")).hexdigest()
+
+    def open(self, key: str, count: bool = True) -> Optional[BinaryIO]:
+        """
+        Open a cached entry.
+
+        :param key: The key, see key.
+        :param count: Count the lookup in the hit and miss statistics.
+        :return: The opened binary file, None if the entry isn't cached.
+        """
+        name = self._name(key)
+        with self.lock:
+            file = None
+            if name in self.entries:
+                try:
+                    file = open(os.path.join(self.path, name), "rb")
+                except FileNotFoundError:
+                    pass
+            if file is None:
+                if count: self.misses += 1
+                return None
+            if count: self.hits += 1
+            self.entries.move_to_end(name)
+        try:
+            os.utime(file.fileno())
+        except (OSError, NotImplementedError):
+            pass
+        return file
+
+    def __contains__(self, key: str) -> bool:
+        with self.lock:
+            return self._name(key) in self.entries
+
+    @contextmanager
+    def writer(self, key: str):
+        """
+        Write an entry, it only replaces the old one once the write succeeded.
+
+        :param key: The key, see key.
+        :return: A context manager giving a binary file to write to.
+        """
+        name = self._name(key)
+        file = tempfile.NamedTemporaryFile(dir=self.path,
+                                           prefix=".tmp",
+                                           delete=False)
+        try:
+            with file:
+                yield file
+                size = file.tell()
+            os.replace(file.name, os.path.join(self.path, name))
+        except BaseException:
+            os.remove(file.name)
+            raise
+
+        with self.lock:
+            self.size += size - self.entries.pop(name, 0)
+            self.entries[name] = size
+            self._evict()
+
+    def fill(self, key: str, chunks: Iterator[bytes]) -> Iterator[bytes]:
+        """
+        Cache chunks while passing them on, the entry is only added once all of them were read.
+
+        :param key: The key, see key.
+        :param chunks: The chunks, e.g. of a download.
+        :return: An iterator over the same chunks.
+        """
+        with self.writer(key) as file:
+            for chunk in chunks:
+                file.write(chunk)
+                yield chunk
+
+    async def afill(self, key: str,
+                    chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+        """
+        Cache async chunks while passing them on, see fill.
+
+        :param key: The key, see key.
+        :param chunks: The chunks, e.g. of a download.
+        :return: An async iterator over the same chunks.
+        """
+        with self.writer(key) as file:
+            async for chunk in chunks:
+                file.write(chunk)
+                yield chunk
+
+    def put(self, key: str, content: bytes) -> None:
+        """
+        Cache content.
+
+        :param key: The key, see key.
+        :param content: The content.
+        """
+        with self.writer(key) as file:
+            file.write(content)
+
+    def _evict(self) -> None:
+        """Delete the least recently used entries until the cache fits, keeps the newest entry."""
+        while self.size > self.max_size and len(self.entries) > 1:
+            name, size = self.entries.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(os.path.join(self.path, name))
+            except FileNotFoundError:
+                pass
+
+    def clear(self) -> None:
+        """Delete all entries."""
+        with self.lock:
+            for name in self.entries:
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except FileNotFoundError:
+                    pass
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the cache statistics.
+
+        :return: The number of hits, misses, evictions, entries and the size in bytes.
+        """
+        with self.lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self.entries),
+                "size": self.size
+            }
@@ -0,0 +1,357 @@
+from typing import Any, Callable, Dict, List, Mapping, Sequence, Tuple
+from bisect import bisect_left
+from time import time
+import threading
+
+# Seconds, from a fast API call to a long-poll /sync
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Bytes, from an empty response to a large initial sync
+BYTE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+# Sorted label items, the key of a labelled value
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels(labels: Mapping[str, Any]) -> Labels:
+    """Turn label keyword arguments into a hashable key."""
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def endpoint_template(endpoint: str) -> str:
+    """
+    Replace the ids in an endpoint by {}, so endpoints can be used as metric labels.
+
+    :param endpoint: The endpoint, e.g. /rooms/!id:example.org/send/m.room.message/1
+    :return: The template, e.g. /rooms/{}/send/m.room.message/{}
+    """
+    parts = endpoint.split("?", 1)[0].split("/")
+    media = 0
+    for i, part in enumerate(parts):
+        if media:
+            # server name and media id of /download and /thumbnail
+            parts[i] = "{}"
+            media -= 1
+        elif part in ("download", "thumbnail"):
+            media = 2
+        elif part and part[0] in "!@$#+%" or part.isdigit():
+            parts[i] = "{}"
+    if len(parts) > 3 and parts[-3] in ("send", "sendToDevice"):
+        # transaction ids aren't always numeric
+        parts[-1] = "{}"
+    return "/".join(parts)
+
+
+class Counter():
+    def __init__(self, name: str, help: str = "") -> None:
+        """
+        Initialize a counter, a value that only goes up.
+
+        :param name: The metric name, should end in _total.
+        :param help: The description.
+        """
+        self.name = name
+        self.help = help
+        self.values: Dict[Labels, float] = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels: Any) -> None:
+        """
+        Increase the counter.
+
+        :param value: The amount.
+        :param labels: The labels of the value to increase.
+        """
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        """Get the (name, labels, value) samples of the metric."""
+        with self.lock:
+            return [(self.name, key, value) for key, value in self.values.items()]
+
+    def to_dict(self) -> List[dict]:
+        """Get the labelled values."""
+        with self.lock:
+            return [{"labels": dict(key), "value": value} for key, value in self.values.items()]
+
+
+class Gauge(Counter):
+    def __init__(self, name: str, help: str = "") -> None:
+        """
+        Initialize a gauge, a value that goes up and down.
+
+        :param name: The metric name.
+        :param help: The description.
+        """
+        super().__init__(name, help)
+        self.functions: Dict[Labels, Callable[[], float]] = {}
+
+    def set(self, value: float, **labels: Any) -> None:
+        """
+        Set the gauge.
+
+        :param value: The value.
+        :param labels: The labels of the value to set.
+        """
+        key = _labels(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def set_function(self, function: Callable[[], float], **labels: Any) -> None:
+        """
+        Read the gauge from a function whenever the metrics are exported, e.g. a queue length.
+
+        :param function: Returns the current value.
+        :param labels: The labels of the value.
+        """
+        key = _labels(labels)
+        with self.lock:
+            self.functions[key] = function
+
+    def remove_function(self, **labels: Any) -> None:
+        """
+        Stop reading the gauge from the function set with these labels and drop its value.
+
+        Call it once the object the function reads from goes away, a
+        shared registry would keep it alive otherwise.
+
+        :param labels: The labels the function was set with.
+        """
+        key = _labels(labels)
+        with self.lock:
+            self.functions.pop(key, None)
+            self.values.pop(key, None)
+
+    def _read(self) -> None:
+        """Update the values that are read from functions."""
+        with self.lock:
+            functions = list(self.functions.items())
+        for key, function in functions:
+            try:
+                value = function()
+            except Exception:
+                continue
+            with self.lock:
+                self.values[key] = value
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        self._read()
+        return super().samples()
+
+    def to_dict(self) -> List[dict]:
+        self._read()
+        return super().to_dict()
+
+
+class Histogram():
+    def __init__(self, name: str, help: str = "",
+                 buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        """
+        Initialize a histogram, counts observations in buckets.
+
+        :param name: The metric name.
+        :param help: The description.
+        :param buckets: The upper bounds of the buckets, +Inf is added.
+        """
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        # labels: [counts per bucket (not cumulative) and +Inf, sum]
+        self.values: Dict[Labels, list] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, **labels: Any) -> None:
+        """
+        Record an observation.
+
+        :param value: The observed value, e.g. a duration in seconds.
+        :param labels: The labels of the observation.
+        """
+        key = _labels(labels)
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def _cumulative(self, counts: List[int]) -> List[int]:
+        """Turn bucket counts into the cumulative counts Prometheus expects."""
+        total, cumulative = 0, []
+        for count in counts:
+            total += count
+            cumulative.append(total)
+        return cumulative
+
+    def samples(self) -> List[Tuple[str, Labels, float]]:
+        """Get the (name, labels, value) samples of the metric."""
+        samples = []
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        for key, counts, total in values:
+            cumulative = self._cumulative(counts)
+            bounds = [_format_value(bound) for bound in self.buckets] + ["+Inf"]
+            for bound, count in zip(bounds, cumulative):
+                samples.append((f"{self.name}_bucket", key + (("le", bound), ), count))
+            samples.append((f"{self.name}_sum", key, total))
+            samples.append((f"{self.name}_count", key, cumulative[-1]))
+        return samples
+
+    def to_dict(self) -> List[dict]:
+        """Get the labelled cumulative bucket counts, sums and counts."""
+        with self.lock:
+            values = [(key, list(counts), total) for key, (counts, total) in self.values.items()]
+        result = []
+        for key, counts, total in values:
+            cumulative = self._cumulative(counts)
+            result.append({
+                "labels": dict(key),
+                "buckets": dict(zip(list(self.buckets) + ["+Inf"], cumulative)),
+                "sum": total,
+                "count": cumulative[-1]
+            })
+        return result
+
+
+def _format_value(value: float) -> str:
+    """Format a sample value or bucket bound like Prometheus does."""
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value)) if isinstance(value, int) else f"{value:.1f}"
+    return repr(float(value))
+
+
+def _escape(value: str) -> str:
+    """Escape a label value."""
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class Metrics():
+    enabled = True
+
+    def __init__(self) -> None:
+        """
+        Initialize a metrics registry.
+
+        Metrics are created on first use and shared by everything that uses
+        the registry, e.g. all bots of a Runner. Export them with
+        to_prometheus or to_dict.
+        """
+        self.metrics: Dict[str, Any] = {}
+        self.lock = threading.Lock()
+        self.created = time()
+
+    def _get(self, cls: type, name: str, *args: Any) -> Any:
+        """Get a metric, creating it if it doesn't exist yet."""
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args)
+            elif type(metric) is not cls:
+                raise ValueError(f"Metric {name} is a {type(metric).__name__}")
+            return metric
+
+    def counter(self, name: str, help: str = "") -> Counter:
+        """
+        Get or create a counter.
+
+        :param name: The metric name.
+        :param help: The description.
+        :return: The counter.
+        """
+        return self._get(Counter, name, help)
+
+    def gauge(self, name: str, help: str = "") -> Gauge:
+        """
+        Get or create a gauge.
+
+        :param name: The metric name.
+        :param help: The description.
+        :return: The gauge.
+        """
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name: str, help: str = "",
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        """
+        Get or create a histogram.
+
+        :param name: The metric name.
+        :param help: The description.
+        :param buckets: The upper bounds of the buckets.
+        :return: The histogram.
+        """
+        return self._get(Histogram, name, help, buckets)
+
+    def to_dict(self) -> Dict[str, dict]:
+        """
+        Export a snapshot of all metrics.
+
+        :return: {metric name: {"type": ..., "help": ..., "values": [...]}}
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return {
+            metric.name: {
+                "type": type(metric).__name__.lower(),
+                "help": metric.help,
+                "values": metric.to_dict()
+            }
+            for metric in metrics
+        }
+
+    def to_prometheus(self) -> str:
+        """
+        Export a snapshot of all metrics in the Prometheus text format.
+
+        :return: The text, serve it as text/plain; version=0.0.4.
+        """
+        with self.lock:
+            metrics = list(self.metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {type(metric).__name__.lower()}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    text = ",".join(f'{key}="{_escape(value)}"' for key, value in labels)
+                    name = f"{name}{{{text}}}"
+                lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+class _NullMetric():
+    """Metric of a disabled registry, every call does nothing."""
+
+    def inc(self, value: float = 1, **labels: Any) -> None:
+        pass
+
+    def set(self, value: float, **labels: Any) -> None:
+        pass
+
+    def set_function(self, function: Callable[[], float], **labels: Any) -> None:
+        pass
+
+    def remove_function(self, **labels: Any) -> None:
+        pass
+
+    def observe(self, value: float, **labels: Any) -> None:
+        pass
+
+
+class NullMetrics(Metrics):
+    """
+    Disabled metrics registry, the default. Its metrics ignore every
+    call, and callers check enabled before doing extra work for a metric.
+    """
+    enabled = False
+
+    def _get(self, cls: type, name: str, *args: Any) -> Any:
+        return _NULL_METRIC
+
+
+_NULL_METRIC = _NullMetric()
+NULL_METRICS = NullMetrics()
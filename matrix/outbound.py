@@ -0,0 +1,209 @@
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from collections import deque
+from typing import Callable, Deque, Dict, Tuple
+import threading
+import asyncio
+
+from .classes import Event
+from time import time
+
+
+class SendQueue():
+    def __init__(self, send: Callable[..., dict], max_in_flight: int = 10) -> None:
+        """
+        Initialize the outbound send queue.
+
+        Sends to different rooms run concurrently on a thread pool, sends
+        to the same room run one after another in the order they were queued.
+
+        :param send: Sends one event, called as send(room_id, event_type, content, txn_id).
+        :param max_in_flight: How many sends may run at the same time.
+        """
+        self.send = send
+        self.executor = ThreadPoolExecutor(max_in_flight)
+        self.queues: Dict[str, Deque[Tuple[str, dict, str, Future]]] = {}
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.closed = False
+        self.sent = 0
+        self.failed = 0
+
+    def enqueue(self, room_id: str, event_type: str, content: dict,
+                txn_id: str) -> Future:
+        """
+        Queue an event.
+
+        :param room_id: The room id.
+        :param event_type: The event type.
+        :param content: The event content.
+        :param txn_id: The transaction id, keeps retries idempotent.
+        :return: A future resolving to the sent Event, or raising the send error.
+        :raises RuntimeError: The queue was closed.
+        """
+        future = Future()
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("The send queue is closed")
+            self.pending.add(future)
+            queue = self.queues.get(room_id)
+            if queue is None:
+                queue = self.queues[room_id] = deque()
+                self.executor.submit(self._drain, room_id)
+            queue.append((event_type, content, txn_id, future))
+        return future
+
+    def _send(self, room_id: str, event_type: str, content: dict,
+              txn_id: str, future: Future) -> None:
+        """Send one event and resolve its future, unless it was cancelled."""
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            res = self.send(room_id, event_type, content, txn_id)
+            event = Event(res.get("event_id"), timestamp=time())
+        except Exception as e:
+            future.set_exception(e)
+            with self.lock:
+                self.failed += 1
+            return
+        future.set_result(event)
+        with self.lock:
+            self.sent += 1
+
+    def _drain(self, room_id: str) -> None:
+        """Send the next event of a room, then requeue the room if it has more."""
+        more = True
+        while more:
+            with self.lock:
+                event_type, content, txn_id, future = self.queues[room_id].popleft()
+            try:
+                self._send(room_id, event_type, content, txn_id, future)
+            finally:
+                with self.lock:
+                    self.pending.discard(future)
+                    more = bool(self.queues[room_id])
+                    if not more:
+                        del self.queues[room_id]
+                    elif not self.closed:
+                        # go to the back of the pool queue so busy rooms don't starve others
+                        self.executor.submit(self._drain, room_id)
+                        more = False
+            # once closed the pool takes no new work, the rest of the room is sent here
+
+    def flush(self, timeout: float = None) -> None:
+        """
+        Wait until every queued event was sent or failed.
+
+        :param timeout: How many seconds to wait at most.
+        """
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending, timeout=timeout)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the queue statistics.
+
+        :return: The number of queued, sent and failed events.
+        """
+        return {
+            "queued": len(self.pending),
+            "sent": self.sent,
+            "failed": self.failed
+        }
+
+    def close(self) -> None:
+        """Stop accepting sends, already queued ones still go out."""
+        with self.lock:
+            self.closed = True
+            self.executor.shutdown(wait=False)
+
+
+class AsyncSendQueue():
+    def __init__(self, send: Callable, max_in_flight: int = 10) -> None:
+        """
+        Initialize the asynchronous outbound send queue.
+
+        :param send: Coroutine function sending one event, called as send(room_id, event_type, content, txn_id).
+        :param max_in_flight: How many sends may run at the same time.
+        """
+        self.send = send
+        self.max_in_flight = max_in_flight
+        self.semaphore = None
+        self.queues: Dict[str, Deque[Tuple[str, dict, str, asyncio.Future]]] = {}
+        self.tasks = set()
+        self.sent = 0
+        self.failed = 0
+
+    def enqueue(self, room_id: str, event_type: str, content: dict,
+                txn_id: str) -> asyncio.Future:
+        """
+        Queue an event, must be called from the event loop.
+
+        :param room_id: The room id.
+        :param event_type: The event type.
+        :param content: The event content.
+        :param txn_id: The transaction id, keeps retries idempotent.
+        :return: A future resolving to the sent Event, or raising the send error.
+        """
+        future = asyncio.get_running_loop().create_future()
+        queue = self.queues.get(room_id)
+        idle = queue is None
+        if idle:
+            queue = self.queues[room_id] = deque()
+        queue.append((event_type, content, txn_id, future))
+        if idle:
+            task = asyncio.ensure_future(self._drain(room_id))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        return future
+
+    async def _drain(self, room_id: str) -> None:
+        """Send the events of a room one after another."""
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        queue = self.queues[room_id]
+        try:
+            while queue:
+                event_type, content, txn_id, future = queue[0]
+                if not future.done():
+                    async with self.semaphore:
+                        await self._send(room_id, event_type, content, txn_id, future)
+                queue.popleft()
+        finally:
+            del self.queues[room_id]
+            # the drain was cancelled, don't leave the rest of the room waiting forever
+            for *_, future in queue:
+                future.cancel()
+
+    async def _send(self, room_id: str, event_type: str, content: dict,
+                    txn_id: str, future: asyncio.Future) -> None:
+        """Send one event and resolve its future, unless it was cancelled meanwhile."""
+        try:
+            res = await self.send(room_id, event_type, content, txn_id)
+            event = Event(res.get("event_id"), timestamp=time())
+        except Exception as e:
+            self.failed += 1
+            if not future.done():
+                future.set_exception(e)
+            return
+        self.sent += 1
+        if not future.done():
+            future.set_result(event)
+
+    async def flush(self) -> None:
+        """Wait until every queued event was sent or failed."""
+        while self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Get the queue statistics.
+
+        :return: The number of queued, sent and failed events.
+        """
+        return {
+            "queued": sum(len(queue) for queue in self.queues.values()),
+            "sent": self.sent,
+            "failed": self.failed
+        }
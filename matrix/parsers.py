@@ -18,8 +18,8 @@ def parse_event(event: dict) -> Event:
 def parse_notification(notification: dict) -> Unread_Notification:
     """Parse unread notification data."""
     return Unread_Notification(
-        notification_count=notification["notification_count"],
-        highlight_count=notification["highlight_count"])
+        notification_count=notification.get("notification_count", 0),
+        highlight_count=notification.get("highlight_count", 0))
 
 
 def check_if_encrypted(room: Room) -> bool:
@@ -31,15 +31,28 @@ def check_if_encrypted(room: Room) -> bool:
     return False
 
 
-def parse_room(room: dict, room_id: str) -> Room:
-    """Parse room data."""
+def parse_room(room: dict, room_id: str, lazy: bool = False) -> Room:
+    """
+    Parse room data.
+
+    :param room: The raw room.
+    :param room_id: The room id.
+    :param lazy: Return a Lazy_Room, which parses its timeline and encryption on first access.
+    :return: The room.
+    """
+    if lazy:
+        return Lazy_Room(room, room_id)
     r = Room(
-        timeline=[parse_event(event) for event in room["timeline"]["events"]],
-        state=room["state"],
-        account_data=room["account_data"],
-        unread_notifications=parse_notification(room["unread_notifications"]),
-        summary=room["summary"],
-        unread_count=room["org.matrix.msc2654.unread_count"],
+        timeline=[
+            parse_event(event)
+            for event in room.get("timeline", {}).get("events", [])
+        ],
+        state=room.get("state", {}),
+        account_data=room.get("account_data", {}),
+        unread_notifications=parse_notification(
+            room.get("unread_notifications", {})),
+        summary=room.get("summary", {}),
+        unread_count=room.get("org.matrix.msc2654.unread_count"),
         id=room_id,
         encrypted=None)
 
@@ -55,13 +68,19 @@ def parse_account_data(data: dict) -> List[Event]:
     return events
 
 
-def parse_state(state: dict) -> State:
-    """Parse state data."""
+def parse_state(state: dict, lazy: bool = False) -> State:
+    """
+    Parse state data.
+
+    :param state: The raw sync response.
+    :param lazy: Build Lazy_Room objects instead of parsing the rooms.
+    :return: The state.
+    """
     return State(
-        next_batch=state.get("content"),
+        next_batch=state.get("next_batch"),
         account_data=state.get("account_data"),
         joined_rooms=[
-            parse_room(state["rooms"]["join"][room], room)
+            parse_room(state["rooms"]["join"][room], room, lazy=lazy)
             for room in state["rooms"]["join"]
         ] if state.get("rooms", {}).get("join") else [],
         invited_rooms=[
@@ -71,6 +90,54 @@ def parse_state(state: dict) -> State:
     )
 
 
+def dump_event(event: Event) -> dict:
+    """Convert event data back into its raw form."""
+    if isinstance(event, Lazy_Event):
+        return event.raw
+    data = {
+        "event_id": event.event_id,
+        "type": event.type,
+        "content": event.content,
+        "origin_server_ts": event.timestamp,
+        "sender": event.sender,
+    }
+    if event.state_key is not None: data["state_key"] = event.state_key
+    return data
+
+
+def dump_room(room: Room, events: bool = True) -> dict:
+    """
+    Convert room data back into its raw sync form.
+
+    :param room: The room.
+    :param events: Include the timeline and state events.
+    :return: The raw room.
+    """
+    return {
+        "timeline": {
+            "events": [dump_event(event) for event in room.timeline] if events else []
+        },
+        "state": room.state if events else {"events": []},
+        "account_data": room.account_data,
+        "unread_notifications": {
+            "notification_count":
+            room.unread_notifications.notification_count,
+            "highlight_count": room.unread_notifications.highlight_count,
+        },
+        "summary": room.summary,
+        "org.matrix.msc2654.unread_count": room.unread_count,
+    }
+
+
+def dump_invite(invite: Invite) -> dict:
+    """Convert invite data back into its raw sync form."""
+    return {
+        "invite_state": {
+            "events": [dump_event(event) for event in invite.invite_state.events]
+        }
+    }
+
+
 def parse_message(message: dict) -> Message:
     """Parse message data."""
     return Message(type=message.get("msgtype"),
@@ -116,16 +183,18 @@ def parse_device_key(data: dict) -> Device_Keys:
         user_id=data.get("user_id"),
         unsigned=data.get("unsigned"),
         signatures=data.get("signatures"),
+        raw=data,
     )
 
 
 def parse_device_keys_response(data: dict) -> Device_Keys_Response:
     """Parse device keys data."""
 
-    keys = {}  # Mapping[str, List[Device_Keys]]
-    for user in data["device_keys"]:
-        for key in data["device_keys"][user]:
-            keys[user].append(parse_device_key(key))
+    # device_keys maps user ids to device ids to the keys
+    keys = {
+        user: [parse_device_key(key) for key in devices.values()]
+        for user, devices in (data.get("device_keys") or {}).items()
+    }
 
     return Device_Keys_Response(
         user_signing_keys=data.get("user_signing_keys"),
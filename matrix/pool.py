@@ -0,0 +1,55 @@
+from requests.adapters import HTTPAdapter
+from urllib3 import PoolManager
+from typing import Dict, List
+
+
+class CountingPoolManager(PoolManager):
+    """PoolManager that remembers every connection pool it created."""
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.all_pools = []
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        pool = super()._new_pool(scheme,
+                                 host,
+                                 port,
+                                 request_context=request_context)
+        self.all_pools.append(pool)
+        return pool
+
+
+class PooledAdapter(HTTPAdapter):
+    """
+    HTTP adapter keeping connections to the homeserver alive and
+    counting how many connections were opened and how many reused.
+    """
+
+    def init_poolmanager(self,
+                         connections: int,
+                         maxsize: int,
+                         block: bool = False,
+                         **pool_kwargs) -> None:
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+
+        self.poolmanager = CountingPoolManager(num_pools=connections,
+                                               maxsize=maxsize,
+                                               block=block,
+                                               **pool_kwargs)
+
+    def connection_stats(self) -> Dict[str, int]:
+        """
+        Get connection statistics.
+
+        :return: The number of requests, opened and reused connections.
+        """
+        pools: List = self.poolmanager.all_pools
+        requests = sum(pool.num_requests for pool in pools)
+        opened = sum(pool.num_connections for pool in pools)
+        return {
+            "requests": requests,
+            "opened": opened,
+            "reused": max(requests - opened, 0),
+        }
@@ -0,0 +1,146 @@
+from collections import deque
+from typing import Dict, Mapping, Tuple
+from time import monotonic
+import threading
+
+# Endpoint classes that get their own token bucket
+ENDPOINT_CLASSES = ["send", "join", "invite", "media", "sync", "other"]
+
+
+def classify_endpoint(endpoint: str, API_path: str = "") -> str:
+    """
+    Get the endpoint class of a request, homeservers rate limit these separately.
+
+    :param endpoint: The endpoint, e.g. /rooms/!id/send/m.room.message/1
+    :param API_path: The API path, e.g. /_matrix/media/r0
+    :return: One of ENDPOINT_CLASSES.
+    """
+    if API_path.startswith("/_matrix/media"):
+        return "media"
+    if endpoint.startswith("/sync"):
+        return "sync"
+    if "/send/" in endpoint or "/state/" in endpoint or "/sendToDevice/" in endpoint:
+        return "send"
+    if endpoint.endswith("/join") or endpoint.startswith("/join/"):
+        return "join"
+    if endpoint.endswith("/invite"):
+        return "invite"
+    return "other"
+
+
+class TokenBucket():
+    def __init__(self,
+                 rate: float = None,
+                 burst: int = 10,
+                 min_rate: float = 0.1,
+                 window: float = 10) -> None:
+        """
+        Initialize a token bucket.
+
+        Without a rate the bucket lets everything through until the
+        homeserver rate limits, then it starts at half the throughput
+        observed in the last window (at most one second of bursts), increases the rate slowly while
+        requests succeed and halves it again on every rate limit. The rate
+        never grows past the configured rate, or past the throughput that
+        got rate limited first.
+
+        :param rate: Requests per second, None to start unlimited.
+        :param burst: How many requests may be sent at once.
+        :param min_rate: Never go below this many requests per second.
+        :param window: Seconds of history used to estimate the throughput.
+        """
+        self.rate = rate
+        self.max_rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.window = window
+        self.tokens = burst
+        self.updated = monotonic()
+        self.blocked_until = 0
+        self.history = deque()
+        self.limited_count = 0
+        self.lock = threading.Lock()
+
+    def reserve(self) -> float:
+        """
+        Take a token.
+
+        :return: How many seconds to wait before sending the request.
+        """
+        now = monotonic()
+        with self.lock:
+            self.history.append(now)
+            while self.history[0] < now - self.window:
+                self.history.popleft()
+
+            if self.rate is None:
+                return max(0.0, self.blocked_until - now)
+
+            if now > self.updated:
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+            self.tokens -= 1
+            return self.updated - now + max(0.0, -self.tokens / self.rate)
+
+    def limited(self, retry_after: float) -> None:
+        """
+        Adapt to a rate limit response.
+
+        :param retry_after: Seconds the homeserver asked to wait.
+        """
+        now = monotonic()
+        with self.lock:
+            self.limited_count += 1
+            # requests that were in flight together count as one rate limit
+            if now >= self.blocked_until:
+                if self.rate is None:
+                    span = max(now - self.history[0], 1.0) if self.history else self.window
+                    self.rate = len(self.history) / span
+                    self.max_rate = self.rate
+                self.rate = max(self.min_rate, self.rate / 2)
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            self.updated = max(self.updated, self.blocked_until)
+            self.tokens = min(self.tokens, 1)
+
+    def succeeded(self) -> None:
+        """Slowly raise the rate again after a successful request."""
+        with self.lock:
+            if self.rate is not None:
+                self.rate = min(self.rate * 1.02, self.max_rate)
+
+
+class RateLimiter():
+    def __init__(self, rates: Mapping[str, float] = None, burst: int = 10) -> None:
+        """
+        Initialize the rate limiter, one token bucket per endpoint class.
+
+        :param rates: Requests per second per endpoint class, missing classes start unlimited.
+        :param burst: How many requests of a class may be sent at once.
+        """
+        rates = rates or {}
+        self.buckets: Dict[str, TokenBucket] = {
+            name: TokenBucket(rates.get(name), burst)
+            for name in ENDPOINT_CLASSES
+        }
+
+    def bucket(self, endpoint: str, API_path: str = "") -> TokenBucket:
+        """
+        Get the bucket of a request.
+
+        :param endpoint: The endpoint.
+        :param API_path: The API path.
+        :return: The token bucket.
+        """
+        return self.buckets[classify_endpoint(endpoint, API_path)]
+
+    def stats(self) -> Dict[str, Tuple[float, int]]:
+        """
+        Get the current rate and the number of rate limits per endpoint class.
+
+        :return: {endpoint class: (rate or None, rate limit count)}
+        """
+        return {
+            name: (bucket.rate, bucket.limited_count)
+            for name, bucket in self.buckets.items()
+        }
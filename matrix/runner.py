@@ -0,0 +1,100 @@
+from .client import Client
+from .scheduler import Scheduler
+from .metrics import NULL_METRICS, Metrics
+from .async_api import create_session
+from .storage import Storage
+from . import codec
+from typing import Dict, List, Tuple
+import asyncio
+
+
+class Runner():
+    def __init__(self,
+                 scheduler: Scheduler = None,
+                 pool_connections: int = 10,
+                 pool_maxsize: int = 100,
+                 keep_alive: bool = True,
+                 json_codec: str = None,
+                 max_starting: int = 10,
+                 metrics: Metrics = None) -> None:
+        """
+        Initialize a runner hosting many accounts in one process.
+
+        All clients share one event loop, one HTTP connection pool, the JSON
+        codec and one handler scheduler. Each account syncs in its own task
+        instead of its own threads.
+
+        :param scheduler: runs the handlers of all clients, defaults to Scheduler()
+        :param pool_connections: how many hosts to keep connection pools for
+        :param pool_maxsize: how many connections to keep open per host, shared by all accounts of a homeserver
+        :param keep_alive: reuse connections between requests
+        :param json_codec: the JSON codec to use, see codec.set_codec
+        :param max_starting: how many accounts may log in and do their initial sync at the same time
+        :param metrics: record the metrics of all accounts in this registry, e.g. Metrics()
+        """
+        self.metrics = metrics or NULL_METRICS
+        self.scheduler = scheduler or Scheduler(metrics=self.metrics)
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.keep_alive = keep_alive
+        self.max_starting = max_starting
+        self.accounts: List[Tuple[Client, dict]] = []
+        self.session = None
+        self.stats = {"requests": 0, "opened": 0, "reused": 0}
+        if json_codec:
+            codec.set_codec(json_codec)
+
+    def add(self, client: Client, username: str, password: str, homeserver: str, device_id: str = "", storage: Storage = None, **options) -> Client:
+        """
+        Add an account, takes the same arguments as Client.run.
+
+        :param client: the client handling the events of the account, must not be shared between accounts
+        :param options: passed on to AsyncBot
+        :return: the client
+        """
+        client.scheduler = self.scheduler
+        client._own_scheduler = False
+        if self.metrics.enabled and not client.metrics.enabled:
+            client.metrics = self.metrics
+            client._init_metrics()
+        self.accounts.append((client, dict(username=username, password=password, homeserver=homeserver, device_id=device_id, storage=storage, **options)))
+        return client
+
+    async def _start(self, client: Client, semaphore: asyncio.Semaphore, options: dict) -> None:
+        """Run a client, limiting how many log in at once."""
+        try:
+            async with semaphore:
+                await client.connect(session=self.session, **options)
+            await client.serve()
+        except Exception as e:
+            # one broken account must not take down the others
+            print(f"[-] Account {options['username']} failed: {e!r}")
+
+    async def start(self) -> None:
+        """Run all accounts on the running event loop, until they are stopped."""
+        self.session = create_session(self.pool_connections, self.pool_maxsize, self.keep_alive, self.stats)
+        semaphore = asyncio.Semaphore(self.max_starting)
+        try:
+            await asyncio.gather(*[self._start(client, semaphore, options) for client, options in self.accounts])
+        finally:
+            await self.scheduler.join()
+            self.scheduler.close()
+            await self.session.close()
+
+    def run(self) -> None:
+        """Run all accounts, blocks until they are stopped."""
+        asyncio.run(self.start())
+
+    def stop(self) -> None:
+        """Stop all accounts."""
+        for client, _ in self.accounts:
+            if client.is_running:
+                client.stop()
+
+    def connection_stats(self) -> Dict[str, int]:
+        """
+        Get connection statistics of the shared pool.
+
+        :return: The number of requests, opened and reused connections.
+        """
+        return dict(self.stats)
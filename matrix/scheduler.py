@@ -0,0 +1,136 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from functools import partial
+from typing import Any, Callable, Deque, Dict, Hashable, Tuple
+from .utils import maybe_await
+from .metrics import NULL_METRICS, Metrics
+from time import perf_counter
+import traceback
+import asyncio
+
+
+class Scheduler():
+    def __init__(self,
+                 max_concurrency: int = 64,
+                 per_room_concurrency: int = 1,
+                 mode: str = "asyncio",
+                 max_workers: int = None,
+                 metrics: Metrics = None) -> None:
+        """
+        Initialize the handler scheduler.
+
+        Handlers are queued per key (usually the room id, or (user id,
+        room id) when several accounts share the scheduler). Each key gets at
+        most per_room_concurrency running handlers, so with the default of 1
+        the handlers of a room run strictly in the order they were submitted,
+        while different rooms run concurrently.
+
+        :param max_concurrency: How many handlers may run at the same time overall.
+        :param per_room_concurrency: How many handlers of the same room may run at the same time.
+        :param mode: "asyncio" to run plain functions on the event loop, "thread" to run them in a thread pool.
+        :param max_workers: Size of the thread pool in thread mode.
+        :param metrics: Record handler durations, errors and the queue depth in this registry.
+        """
+        if mode not in ["asyncio", "thread"]:
+            raise ValueError(f"Invalid scheduler mode: {mode}")
+
+        self.max_concurrency = max_concurrency
+        self.per_room_concurrency = per_room_concurrency
+        self.mode = mode
+        self.executor = ThreadPoolExecutor(
+            max_workers) if mode == "thread" else None
+        self.queues: Dict[Hashable, Deque[Tuple[Callable, tuple]]] = {}
+        self.active: Dict[Hashable, int] = {}
+        # worker task: its key
+        self.tasks: Dict[asyncio.Task, Hashable] = {}
+        self.semaphore = None
+        self.metrics = metrics or NULL_METRICS
+        self._handler_seconds = self.metrics.histogram(
+            "matrix_handler_duration_seconds", "Time a handler call took.")
+        self._handler_errors = self.metrics.counter(
+            "matrix_handler_errors_total", "Handler calls that raised.")
+        self._queue_depth = self.metrics.gauge("matrix_handler_queue_depth",
+                                               "Handler calls waiting to run.")
+        self._queue_depth.set_function(self.queue_depth)
+
+    def submit(self, key: Hashable, handler: Callable, *args: Any) -> None:
+        """
+        Queue a handler call, must be called from the event loop.
+
+        :param key: The ordering key, usually the room id.
+        :param handler: A coroutine function or a plain function.
+        :param args: The arguments to call the handler with.
+        """
+        self.queues.setdefault(key, deque()).append((handler, args))
+        if self.active.get(key, 0) < self.per_room_concurrency:
+            self.active[key] = self.active.get(key, 0) + 1
+            task = asyncio.ensure_future(self._worker(key))
+            # keep a reference, the loop only keeps weak ones
+            self.tasks[task] = key
+            task.add_done_callback(lambda task: self.tasks.pop(task, None))
+
+    def queue_depth(self, key: Hashable = None) -> int:
+        """
+        Get the number of waiting handler calls.
+
+        :param key: Only count the calls of this key.
+        :return: The number of waiting calls.
+        """
+        if key is not None:
+            return len(self.queues.get(key, ()))
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def _worker(self, key: Hashable) -> None:
+        """Run the queued handlers of a key until its queue is empty."""
+        if self.semaphore is None:
+            self.semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        queue = self.queues[key]
+        try:
+            while queue:
+                handler, args = queue.popleft()
+                async with self.semaphore:
+                    await self._call(handler, args)
+        finally:
+            self.active[key] -= 1
+            if not self.active[key]:
+                del self.active[key]
+                if not queue:
+                    del self.queues[key]
+
+    async def _call(self, handler: Callable, args: tuple) -> None:
+        """Run a handler and print its errors instead of losing them."""
+        start = perf_counter()
+        name = getattr(handler, "__name__", "handler")
+        try:
+            if self.executor and not asyncio.iscoroutinefunction(handler):
+                loop = asyncio.get_running_loop()
+                res = await loop.run_in_executor(self.executor,
+                                                 partial(handler, *args))
+            else:
+                res = handler(*args)
+            await maybe_await(res)
+        except Exception:
+            self._handler_errors.inc(handler=name)
+            traceback.print_exc()
+        finally:
+            self._handler_seconds.observe(perf_counter() - start, handler=name)
+
+    async def join(self, owner: Hashable = None) -> None:
+        """
+        Wait until all queued handlers are done.
+
+        :param owner: Only wait for the handlers of the keys (owner, ...), e.g. the user id of one account.
+        """
+        while True:
+            tasks = [task for task, key in self.tasks.items()
+                     if owner is None or (isinstance(key, tuple) and key[:1] == (owner, ))]
+            if not tasks:
+                return
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def close(self) -> None:
+        """Shut down the thread pool."""
+        self._queue_depth.remove_function()
+        if self.executor:
+            self.executor.shutdown(wait=False)
@@ -0,0 +1,304 @@
+from typing import Any, Dict, List
+from abc import ABC, abstractmethod
+import sqlite3
+import threading
+from . import codec
+
+
+class Storage(ABC):
+    """
+    Base class for sync storage backends.
+
+    A storage keeps the sync token, the rooms and invites of the room
+    store, the ids of already handled events and arbitrary values like
+    the transaction id, so a restarted bot can resume where it stopped.
+    """
+
+    @abstractmethod
+    def get_value(self, key: str, default: Any = None) -> Any:
+        """
+        Get a stored value.
+
+        :param key: The key.
+        :param default: Returned if the key is not stored.
+        :return: The value.
+        """
+
+    @abstractmethod
+    def set_value(self, key: str, value: Any) -> None:
+        """
+        Store a value.
+
+        :param key: The key.
+        :param value: The value, must be JSON serializable.
+        """
+
+    @abstractmethod
+    def get_rooms(self) -> Dict[str, Dict[str, dict]]:
+        """
+        Get the stored rooms.
+
+        :return: The rooms in raw sync form, e.g. {"join": {room_id: room}, "invite": {room_id: invite}}.
+        """
+
+    @abstractmethod
+    def save_rooms(self, kind: str, rooms: Dict[str, dict]) -> None:
+        """
+        Store rooms, replacing earlier versions.
+
+        :param kind: "join" for joined rooms, "invite" for invites.
+        :param rooms: The rooms in raw sync form, keyed by room id.
+        """
+
+    @abstractmethod
+    def save_room_delta(self, room_id: str, room: dict, state: List[dict],
+                        events: List[dict], limit: int = None) -> None:
+        """
+        Merge the changes of a sync into a stored joined room, instead of rewriting all of it.
+
+        :param room_id: The room id.
+        :param room: The room in raw sync form without timeline and state events, replaces the stored one.
+        :param state: Changed state events, they replace stored ones by type and state key.
+        :param events: New timeline events, they replace stored ones with the same event id and are appended otherwise.
+        :param limit: Drop the oldest timeline events beyond this many, keep all if not given.
+        """
+
+    @abstractmethod
+    def delete_rooms(self, room_ids: List[str]) -> None:
+        """
+        Delete rooms and invites.
+
+        :param room_ids: The room ids.
+        """
+
+    @abstractmethod
+    def clear_rooms(self) -> None:
+        """Delete all rooms and invites."""
+
+    @abstractmethod
+    def get_seen(self, limit: int = None) -> List[str]:
+        """
+        Get the ids of already handled events.
+
+        :param limit: Only return the most recent ids.
+        :return: The ids, oldest first.
+        """
+
+    @abstractmethod
+    def add_seen(self, ids: List[str], limit: int = None) -> None:
+        """
+        Mark event ids as handled.
+
+        :param ids: The ids.
+        :param limit: Forget the oldest ids beyond this many, keep all if not given.
+        """
+
+    def commit(self) -> None:
+        """Persist all changes."""
+
+    def close(self) -> None:
+        """Persist all changes and release the storage."""
+        self.commit()
+
+
+class MemoryStorage(Storage):
+    def __init__(self) -> None:
+        """Initialize an in-memory storage, mostly useful for testing."""
+        self.values = {}
+        self.rooms = {"join": {}, "invite": {}}
+        self.seen = {}
+
+    def get_value(self, key: str, default: Any = None) -> Any:
+        return self.values.get(key, default)
+
+    def set_value(self, key: str, value: Any) -> None:
+        self.values[key] = value
+
+    def get_rooms(self) -> Dict[str, Dict[str, dict]]:
+        rooms = {kind: dict(rooms) for kind, rooms in self.rooms.items()}
+        for room_id, room in rooms["join"].items():
+            # the caller may change the rooms, keep the stored lists apart
+            rooms["join"][room_id] = {
+                **room,
+                "timeline": {**room.get("timeline", {}),
+                             "events": list(room.get("timeline", {}).get("events", []))},
+                "state": {**room.get("state", {}),
+                          "events": list(room.get("state", {}).get("events", []))}
+            }
+        return rooms
+
+    def save_rooms(self, kind: str, rooms: Dict[str, dict]) -> None:
+        self.delete_rooms(list(rooms))
+        self.rooms[kind].update(rooms)
+
+    def save_room_delta(self, room_id: str, room: dict, state: List[dict],
+                        events: List[dict], limit: int = None) -> None:
+        stored = self.rooms["join"].get(room_id, {})
+        merged_state = {(event.get("type"), event.get("state_key")): event
+                        for event in stored.get("state", {}).get("events", [])}
+        merged_state.update(((event.get("type"), event.get("state_key")), event)
+                            for event in state)
+        timeline = {event.get("event_id") or id(event): event
+                    for event in stored.get("timeline", {}).get("events", [])}
+        timeline.update((event.get("event_id") or id(event), event) for event in events)
+        timeline = list(timeline.values())
+        if limit:
+            timeline = timeline[-limit:]
+
+        self.rooms["invite"].pop(room_id, None)
+        self.rooms["join"][room_id] = {
+            **room,
+            "timeline": {"events": timeline},
+            "state": {"events": list(merged_state.values())}
+        }
+
+    def delete_rooms(self, room_ids: List[str]) -> None:
+        for room_id in room_ids:
+            for rooms in self.rooms.values():
+                rooms.pop(room_id, None)
+
+    def clear_rooms(self) -> None:
+        self.rooms = {"join": {}, "invite": {}}
+
+    def get_seen(self, limit: int = None) -> List[str]:
+        seen = list(self.seen)
+        return seen[-limit:] if limit else seen
+
+    def add_seen(self, ids: List[str], limit: int = None) -> None:
+        for i in ids:
+            self.seen[i] = True
+        if limit:
+            for i in list(self.seen)[:-limit]:
+                del self.seen[i]
+
+
+class SQLiteStorage(Storage):
+    def __init__(self, path: str) -> None:
+        """
+        Initialize a SQLite backed storage.
+
+        Changes are written in one transaction per commit. The timeline
+        and state events of joined rooms are kept in tables of their own,
+        so a sync only writes what it changed, see save_room_delta.
+
+        :param path: The database file, created if it doesn't exist.
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT)")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS rooms (room_id TEXT PRIMARY KEY, kind TEXT, data TEXT)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS room_state (room_id TEXT, type TEXT, state_key TEXT, data TEXT, PRIMARY KEY (room_id, type, state_key))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS room_events (room_id TEXT, event_id TEXT, data TEXT, UNIQUE (room_id, event_id))"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS seen (event_id TEXT PRIMARY KEY)")
+        self.db.commit()
+
+    def get_value(self, key: str, default: Any = None) -> Any:
+        with self.lock:
+            row = self.db.execute("SELECT value FROM kv WHERE key = ?",
+                                  (key, )).fetchone()
+        return codec.loads(row[0]) if row else default
+
+    def set_value(self, key: str, value: Any) -> None:
+        with self.lock:
+            self.db.execute("REPLACE INTO kv (key, value) VALUES (?, ?)",
+                            (key, codec.dumps(value)))
+
+    def get_rooms(self) -> Dict[str, Dict[str, dict]]:
+        rooms = {"join": {}, "invite": {}}
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT room_id, kind, data FROM rooms").fetchall()
+            state = self.db.execute(
+                "SELECT room_id, data FROM room_state").fetchall()
+            events = self.db.execute(
+                "SELECT room_id, data FROM room_events ORDER BY rowid").fetchall()
+        for room_id, kind, data in rows:
+            rooms.setdefault(kind, {})[room_id] = codec.loads(data)
+        for key, table in (("state", state), ("timeline", events)):
+            for room_id, data in table:
+                room = rooms["join"].get(room_id)
+                if room is not None:
+                    room.setdefault(key, {}).setdefault("events", []).append(codec.loads(data))
+        return rooms
+
+    def save_rooms(self, kind: str, rooms: Dict[str, dict]) -> None:
+        with self.lock:
+            # the rooms come with their timeline and state events
+            for table in ("room_state", "room_events"):
+                self.db.executemany(f"DELETE FROM {table} WHERE room_id = ?",
+                                    [(room_id, ) for room_id in rooms])
+            self.db.executemany(
+                "REPLACE INTO rooms (room_id, kind, data) VALUES (?, ?, ?)",
+                [(room_id, kind, codec.dumps(room))
+                 for room_id, room in rooms.items()])
+
+    def save_room_delta(self, room_id: str, room: dict, state: List[dict],
+                        events: List[dict], limit: int = None) -> None:
+        with self.lock:
+            self.db.execute(
+                "REPLACE INTO rooms (room_id, kind, data) VALUES (?, 'join', ?)",
+                (room_id, codec.dumps(room)))
+            self.db.executemany(
+                "REPLACE INTO room_state (room_id, type, state_key, data) VALUES (?, ?, ?, ?)",
+                [(room_id, event.get("type"), event.get("state_key"), codec.dumps(event))
+                 for event in state])
+            # an event that comes again (e.g. decrypted) keeps its place
+            self.db.executemany(
+                "INSERT INTO room_events (room_id, event_id, data) VALUES (?, ?, ?) "
+                "ON CONFLICT (room_id, event_id) DO UPDATE SET data = excluded.data",
+                [(room_id, event.get("event_id"), codec.dumps(event))
+                 for event in events])
+            if limit and events:
+                self.db.execute(
+                    "DELETE FROM room_events WHERE room_id = ? AND rowid <= (SELECT rowid FROM room_events WHERE room_id = ? ORDER BY rowid DESC LIMIT 1 OFFSET ?)",
+                    (room_id, room_id, limit))
+
+    def delete_rooms(self, room_ids: List[str]) -> None:
+        with self.lock:
+            for table in ("rooms", "room_state", "room_events"):
+                self.db.executemany(f"DELETE FROM {table} WHERE room_id = ?",
+                                    [(room_id, ) for room_id in room_ids])
+
+    def clear_rooms(self) -> None:
+        with self.lock:
+            for table in ("rooms", "room_state", "room_events"):
+                self.db.execute(f"DELETE FROM {table}")
+
+    def get_seen(self, limit: int = None) -> List[str]:
+        with self.lock:
+            if limit:
+                rows = self.db.execute(
+                    "SELECT event_id FROM seen ORDER BY rowid DESC LIMIT ?",
+                    (limit, )).fetchall()[::-1]
+            else:
+                rows = self.db.execute(
+                    "SELECT event_id FROM seen ORDER BY rowid").fetchall()
+        return [row[0] for row in rows]
+
+    def add_seen(self, ids: List[str], limit: int = None) -> None:
+        with self.lock:
+            self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?)",
+                                [(i, ) for i in ids])
+            if limit:
+                self.db.execute(
+                    "DELETE FROM seen WHERE rowid <= (SELECT rowid FROM seen ORDER BY rowid DESC LIMIT 1 OFFSET ?)",
+                    (limit, ))
+
+    def commit(self) -> None:
+        with self.lock:
+            self.db.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.commit()
+            self.db.close()
@@ -0,0 +1,256 @@
+from .classes import Event, Invite, Lazy_Event, Room, Sync_Delta, User
+from .parsers import parse_event, parse_invite, parse_notification, parse_room
+from typing import Dict, List, Optional, Tuple
+
+
+def _is_encryption_event(event: dict) -> bool:
+    """Check if a raw event enables megolm encryption."""
+    return event.get("type") == "m.room.encryption" and event.get(
+        "content", {}).get("algorithm") == "m.megolm.v1.aes-sha2"
+
+
+class RoomStore():
+    def __init__(self, timeline_limit: int = 50, lazy: bool = False) -> None:
+        """
+        Initialize the room store.
+
+        Keeps the rooms and invites of an account keyed by room id and
+        merges the deltas of incremental syncs into them in place.
+
+        :param timeline_limit: How many timeline events to keep per room.
+        :param lazy: Keep timeline events as Lazy_Event objects, which only read the raw event when a field is accessed.
+        """
+        self.timeline_limit = timeline_limit
+        self.lazy = lazy
+        self.next_batch = ""
+        self.account_data = {}
+        self.rooms: Dict[str, Room] = {}
+        self.invites: Dict[str, Invite] = {}
+        self._state_index: Dict[str, Dict[Tuple[str, str], int]] = {}
+        self.members: Dict[str, Dict[str, User]] = {}
+
+    @property
+    def joined_rooms(self) -> List[Room]:
+        """All joined rooms."""
+        return list(self.rooms.values())
+
+    @property
+    def invited_rooms(self) -> List[Invite]:
+        """All pending invites."""
+        return list(self.invites.values())
+
+    def get_room(self, room_id: str) -> Room:
+        """
+        Get a joined room.
+
+        :param room_id: The room id.
+        :return: The room, or None if the room is not joined.
+        """
+        return self.rooms.get(room_id)
+
+    def get_invite(self, room_id: str) -> Invite:
+        """
+        Get a pending invite.
+
+        :param room_id: The room id.
+        :return: The invite, or None if there is no pending invite.
+        """
+        return self.invites.get(room_id)
+
+    def get_members(self, room_id: str) -> Optional[List[User]]:
+        """
+        Get the cached joined members of a room.
+
+        :param room_id: The room id.
+        :return: The members, or None if they aren't cached (see set_members).
+        """
+        members = self.members.get(room_id)
+        return list(members.values()) if members is not None else None
+
+    def is_member(self, room_id: str, user_id: str) -> Optional[bool]:
+        """
+        Check if a user is a joined member of a room.
+
+        :param room_id: The room id.
+        :param user_id: The user id.
+        :return: Whether the user is joined, or None if the members aren't cached.
+        """
+        members = self.members.get(room_id)
+        return user_id in members if members is not None else None
+
+    def set_members(self, room_id: str, members: List[User]) -> None:
+        """
+        Cache the full member list of a joined room, m.room.member events keep it current from then on.
+
+        Sync only sends the member events of active users (lazy loading),
+        so the list has to come from /joined_members.
+
+        :param room_id: The room id.
+        :param members: The joined members.
+        """
+        if room_id in self.rooms:
+            self.members[room_id] = {user.user_id: user for user in members}
+
+    def _update_members(self, room_id: str, events: List[dict]) -> None:
+        """Apply m.room.member events to the cached members of a room."""
+        members = self.members.get(room_id)
+        if members is None:
+            return
+        for event in events:
+            if event.get("type") != "m.room.member" or "state_key" not in event:
+                continue
+            content = event.get("content") or {}
+            if content.get("membership") == "join":
+                members[event["state_key"]] = User(
+                    event["state_key"],
+                    displayname=content.get("displayname"),
+                    avatar_url=content.get("avatar_url"))
+            else:
+                members.pop(event["state_key"], None)
+
+    def replace_events(self, timeline: Dict[str, List[Event]]) -> None:
+        """
+        Replace stored timeline events by event id, e.g. by their decrypted versions.
+
+        Events that aren't in the stored timeline (any more) are skipped.
+
+        :param timeline: The new events by room id.
+        """
+        for room_id, events in timeline.items():
+            room = self.rooms.get(room_id)
+            if room is None or not events:
+                continue
+            replacements = {event.event_id: event for event in events if event.event_id}
+            stored = room.timeline
+            for i, event in enumerate(stored):
+                new = replacements.get(event.event_id)
+                if new is not None and new is not event:
+                    stored[i] = new
+
+    def clear(self) -> None:
+        """Forget all rooms, invites and the sync token."""
+        self.next_batch = ""
+        self.account_data = {}
+        self.rooms = {}
+        self.invites = {}
+        self._state_index = {}
+        self.members = {}
+
+    def apply(self, response: dict, initial: bool = False) -> Sync_Delta:
+        """
+        Merge a sync response into the store.
+
+        :param response: The raw /sync response.
+        :param initial: Whether the response is a full (initial) sync.
+        :return: The changes introduced by the response.
+        """
+        delta = Sync_Delta(next_batch=response.get("next_batch"),
+                           initial=initial,
+                           device_lists=response.get("device_lists") or {},
+                           to_device=(response.get("to_device") or {}).get("events", []),
+                           one_time_keys_count=response.get("device_one_time_keys_count"))
+        self.next_batch = delta.next_batch
+        if response.get("account_data"):
+            self.account_data = response["account_data"]
+
+        rooms = response.get("rooms", {})
+
+        for room_id, data in rooms.get("join", {}).items():
+            self.invites.pop(room_id, None)
+            if data.get("state", {}).get("events"):
+                delta.state[room_id] = data["state"]["events"]
+            room = self.rooms.get(room_id)
+            if room is None:
+                room = parse_room(data, room_id, lazy=self.lazy)
+                self.rooms[room_id] = room
+                self._index_state(room, data)
+                delta.timeline[room_id] = list(room.timeline)
+                self._trim(room)
+            else:
+                delta.timeline[room_id] = self._merge_room(room, data)
+                if data.get("timeline", {}).get("limited"):
+                    # member changes in the gap may be missing with lazy loading
+                    self.members.pop(room_id, None)
+                else:
+                    self._update_members(
+                        room_id,
+                        data.get("state", {}).get("events", []) +
+                        data.get("timeline", {}).get("events", []))
+
+        for room_id, data in rooms.get("invite", {}).items():
+            invite = parse_invite(data, room_id)
+            self.invites[room_id] = invite
+            delta.invites.append(invite)
+
+        for room_id in rooms.get("leave", {}):
+            self.invites.pop(room_id, None)
+            if self.rooms.pop(room_id, None) is not None:
+                self._state_index.pop(room_id, None)
+                self.members.pop(room_id, None)
+                delta.left_rooms.append(room_id)
+
+        return delta
+
+    def _index_state(self, room: Room, data: dict) -> None:
+        """Build the state lookup table of a newly seen room."""
+        state = room.state.get("events", [])
+        timeline = data.get("timeline", {}).get("events", [])
+
+        room.state["events"] = []
+        self._state_index[room.id] = {}
+        self._merge_state_events(
+            room, state + [event for event in timeline if "state_key" in event])
+
+        if not room.encrypted:
+            room.encrypted = any(_is_encryption_event(event) for event in state)
+
+    def _merge_state_events(self, room: Room, events: List[dict]) -> None:
+        """Replace state events of a room by (type, state_key)."""
+        current = room.state.setdefault("events", [])
+        index = self._state_index[room.id]
+        for event in events:
+            key = (event.get("type"), event.get("state_key"))
+            if key in index:
+                current[index[key]] = event
+            else:
+                index[key] = len(current)
+                current.append(event)
+
+    def _trim(self, room: Room) -> None:
+        """Drop the oldest timeline events of a room beyond timeline_limit."""
+        if len(room.timeline) > self.timeline_limit:
+            del room.timeline[:-self.timeline_limit]
+
+    def _merge_room(self, room: Room, data: dict) -> list:
+        """Merge a room delta into a known room and return the new events."""
+        timeline = data.get("timeline", {}).get("events", [])
+        state = data.get("state", {}).get("events", [])
+
+        self._merge_state_events(room, state)
+        self._merge_state_events(
+            room, [event for event in timeline if "state_key" in event])
+
+        parse = Lazy_Event if self.lazy else parse_event
+        events = [parse(event) for event in timeline]
+        room.timeline.extend(events)
+        self._trim(room)
+
+        if "unread_notifications" in data:
+            room.unread_notifications = parse_notification(
+                data["unread_notifications"])
+        if "org.matrix.msc2654.unread_count" in data:
+            room.unread_count = data["org.matrix.msc2654.unread_count"]
+        if data.get("summary"):
+            room.summary.update(data["summary"])
+        if data.get("account_data", {}).get("events"):
+            types = {e.get("type") for e in data["account_data"]["events"]}
+            room.account_data["events"] = [
+                e for e in room.account_data.get("events", [])
+                if e.get("type") not in types
+            ] + data["account_data"]["events"]
+
+        if not room.encrypted:
+            room.encrypted = any(
+                _is_encryption_event(event) for event in state + timeline)
+
+        return events
@@ -0,0 +1,125 @@
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterable
+from time import monotonic
+import asyncio
+import functools
+import inspect
+
+
+async def maybe_await(value: Any) -> Any:
+    """
+    Await a value if it is awaitable.
+
+    Lets the same code call methods of both Bot and AsyncBot.
+
+    :param value: The return value of a Bot or AsyncBot method.
+    :return: The result.
+    """
+    if inspect.isawaitable(value):
+        return await value
+    return value
+
+
+async def call_bot(method: Callable, *args, **kwargs) -> Any:
+    """
+    Call a method of a Bot or AsyncBot without blocking the event loop.
+
+    AsyncBot methods are awaited, blocking Bot methods run in the default
+    executor of the running loop.
+
+    :param method: The bound method, e.g. bot.send_message.
+    :param args: The positional arguments of the method.
+    :param kwargs: The keyword arguments of the method.
+    :return: The result.
+    """
+    if inspect.iscoroutinefunction(method):
+        return await method(*args, **kwargs)
+    loop = asyncio.get_running_loop()
+    return await maybe_await(await loop.run_in_executor(None, functools.partial(method, *args, **kwargs)))
+
+
+class SeenSet():
+    def __init__(self, capacity: int = 10000, ttl: float = None) -> None:
+        """
+        Initialize a bounded set of already seen ids.
+
+        Membership checks and inserts are O(1). Once the set is full the
+        oldest ids are evicted, ids older than ttl are dropped as well.
+
+        :param capacity: How many ids to remember.
+        :param ttl: How many seconds to remember an id, None to keep it until it is evicted.
+        """
+        self.capacity = capacity
+        self.ttl = ttl
+        self.ids = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, id: str) -> bool:
+        self._expire()
+        if id in self.ids:
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    def add(self, id: str) -> bool:
+        """
+        Remember an id.
+
+        :param id: The id.
+        :return: False if the id was already seen, True otherwise.
+        """
+        if id in self:
+            return False
+
+        self.ids[id] = monotonic()
+        while len(self.ids) > self.capacity:
+            self.ids.popitem(last=False)
+            self.evictions += 1
+        return True
+
+    def update(self, ids: Iterable[str]) -> None:
+        """
+        Remember many ids, e.g. when restoring from a storage.
+
+        :param ids: The ids, oldest first.
+        """
+        for id in ids:
+            self.ids[id] = monotonic()
+        while len(self.ids) > self.capacity:
+            self.ids.popitem(last=False)
+            self.evictions += 1
+
+    def _expire(self) -> None:
+        """Drop ids that are older than the ttl."""
+        if self.ttl is None:
+            return
+        deadline = monotonic() - self.ttl
+        while self.ids:
+            id, seen = next(iter(self.ids.items()))
+            if seen > deadline:
+                break
+            del self.ids[id]
+            self.expirations += 1
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Get the statistics of the set.
+
+        :return: The size, hits, misses, hit rate, evictions and expirations.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self.ids),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
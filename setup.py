@@ -36,17 +36,19 @@ readme = ''
 with open('README.md') as f:
     readme = f.read()
 
-# extras_require = {
-#     'voice': ['PyNaCl>=1.3.0,<1.5'],
+extras_require = {
+    'async': [
+        'aiohttp>=3.7',
+    ],
 #     'docs': [
 #         'sphinx==4.0.2',
 #         'sphinxcontrib_trio==1.1.2',
 #         'sphinxcontrib-websupport',
 #     ],
-#     'speed': [
-#         'orjson>=3.5.4',
-#     ]
-# }
+    'speed': [
+        'orjson>=3.5.4',
+    ]
+}
 
 version = '0.0.1.2'
 
@@ -71,7 +73,7 @@ setup(name='matrix-chat',
       long_description_content_type='text/markdown',
       include_package_data=True,
       install_requires=requirements,
-    #   extras_require=extras_require,
+      extras_require=extras_require,
       python_requires='>=3.8.0',
       classifiers=[
         'Development Status :: 3 - Alpha',
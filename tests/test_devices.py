@@ -0,0 +1,166 @@
+import asyncio
+import threading
+from matrix.classes import Device_Keys, Device_Keys_Response
+from matrix.devices import AsyncDeviceStore, DeviceStore
+
+
+def device(user_id, device_id, key=None):
+    return Device_Keys(["m.megolm.v1.aes-sha2"], device_id,
+                       {f"ed25519:{device_id}": key or f"key-{device_id}"},
+                       user_id, {}, {})
+
+
+def response(devices, failures=None):
+    device_keys = {}
+    for d in devices:
+        device_keys.setdefault(d.user_id, []).append(d)
+    return Device_Keys_Response(device_keys, failures or {}, {}, {}, {})
+
+
+class Homeserver():
+    def __init__(self, *devices):
+        self.devices = list(devices)
+        self.failures = {}
+        self.queries = []
+
+    def query(self, user_ids):
+        self.queries.append(list(user_ids))
+        return response([d for d in self.devices if d.user_id in user_ids],
+                        {server: {} for server in self.failures})
+
+
+def test_devices_are_cached_until_changed():
+    server = Homeserver(device("@a:x", "A1"), device("@b:y", "B1"))
+    store = DeviceStore(server.query)
+    assert set(store.get(["@a:x", "@b:y"])["@a:x"]) == {"A1"}
+    store.get(["@a:x"])
+    assert server.queries == [["@a:x", "@b:y"]]
+
+    server.devices.append(device("@a:x", "A2"))
+    store.update(changed=["@a:x", "@untracked:x"])
+    assert set(store.get(["@a:x", "@b:y"])["@a:x"]) == {"A1", "A2"}
+    assert server.queries[-1] == ["@a:x"]
+    assert "@untracked:x" not in store.tracked
+
+
+def test_left_users_are_dropped():
+    store = DeviceStore(Homeserver(device("@a:x", "A1")).query)
+    store.get(["@a:x"])
+    store.update(left=["@a:x"])
+    assert store.cached(["@a:x"]) == {}
+    assert store.stats() == {"tracked": 0, "outdated": 0, "cached": 0, "queries": 1}
+
+
+def test_forget_marks_everyone_outdated():
+    server = Homeserver(device("@a:x", "A1"))
+    store = DeviceStore(server.query)
+    store.get(["@a:x", "@b:x"])
+    store.forget()
+    assert store.outdated == {"@a:x", "@b:x"}
+    store.get(["@a:x"])
+    assert server.queries[-1] == ["@a:x"]
+    assert store.outdated == {"@b:x"}
+
+
+def test_users_are_queried_in_batches():
+    server = Homeserver()
+    store = DeviceStore(server.query, batch_size=2)
+    store.get(["@a:x", "@b:x", "@c:x", "@a:x"])
+    assert server.queries == [["@a:x", "@b:x"], ["@c:x"]]
+    assert store.cached(["@a:x"]) == {"@a:x": {}}
+
+
+def test_unreachable_homeserver_keeps_users_outdated():
+    server = Homeserver(device("@a:x", "A1"))
+    server.failures = {"y": {}}
+    store = DeviceStore(server.query)
+    assert set(store.get(["@a:x", "@b:y"])) == {"@a:x"}
+    assert store.outdated == {"@b:y"}
+
+
+def test_failed_query_keeps_users_outdated():
+    def query(user_ids):
+        raise ConnectionError
+
+    store = DeviceStore(query)
+    try:
+        store.get(["@a:x"])
+    except ConnectionError:
+        pass
+    assert store.outdated == {"@a:x"}
+    assert store.pending == {}
+
+
+def test_changed_identity_key_keeps_the_old_device():
+    server = Homeserver(device("@a:x", "A1", "old"))
+    store = DeviceStore(server.query)
+    store.get(["@a:x"])
+    server.devices = [device("@a:x", "A1", "new"), device("@a:x", "A2")]
+    store.update(changed=["@a:x"])
+    devices = store.get(["@a:x"])["@a:x"]
+    assert devices["A1"].keys == {"ed25519:A1": "old"}
+    assert "A2" in devices
+
+
+def test_devices_of_other_users_are_ignored():
+    def query(user_ids):
+        return Device_Keys_Response({"@a:x": [device("@evil:x", "E1"), device("@a:x", "A1")]},
+                                    {}, {}, {}, {})
+
+    store = DeviceStore(query)
+    assert set(store.get(["@a:x"])["@a:x"]) == {"A1"}
+
+
+def test_rejected_devices_are_dropped():
+    class Verifier():
+        def __call__(self, device):
+            raise AssertionError("verify_many is preferred")
+
+        def verify_many(self, devices):
+            return [d.device_id != "BAD" for d in devices]
+
+    server = Homeserver(device("@a:x", "A1"), device("@a:x", "BAD"))
+    store = DeviceStore(server.query, verify=Verifier())
+    assert set(store.get(["@a:x"])["@a:x"]) == {"A1"}
+
+    store = DeviceStore(server.query, verify=lambda d: d.device_id != "A1")
+    assert set(store.get(["@a:x"])["@a:x"]) == {"BAD"}
+
+
+def test_concurrent_gets_share_a_query():
+    release = threading.Event()
+    server = Homeserver(device("@a:x", "A1"))
+
+    def query(user_ids):
+        release.wait(5)
+        return server.query(user_ids)
+
+    store = DeviceStore(query)
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(store.get(["@a:x"])))
+               for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert server.queries == [["@a:x"]]
+    assert [set(r["@a:x"]) for r in results] == [{"A1"}] * 3
+
+
+def test_async_store():
+    server = Homeserver(device("@a:x", "A1"), device("@b:x", "B1"))
+
+    async def query(user_ids):
+        await asyncio.sleep(0)
+        return server.query(user_ids)
+
+    async def main():
+        store = AsyncDeviceStore(query, batch_size=1)
+        first, second = await asyncio.gather(store.get(["@a:x", "@b:x"]), store.get(["@a:x"]))
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert set(first) == {"@a:x", "@b:x"}
+    assert set(second["@a:x"]) == {"A1"}
+    assert sorted(server.queries) == [["@a:x"], ["@b:x"]]
@@ -0,0 +1,98 @@
+import asyncio
+from matrix.classes import Event, Room_Events_Page
+from matrix.history import iter_history
+
+
+def event(i, event_type="m.room.message", ts=None):
+    return Event(event_id=f"${i}", type=event_type, timestamp=ts if ts is not None else 1000 - i)
+
+
+class FakeBot():
+    def __init__(self, pages):
+        # token: page
+        self.pages = pages
+        self.calls = []
+
+    async def get_room_events_page(self, room_id, token, direction, limit, filter):
+        self.calls.append((token, filter))
+        return self.pages[token]
+
+
+class BlockingBot(FakeBot):
+    def get_room_events_page(self, room_id, token, direction, limit, filter):
+        self.calls.append((token, filter))
+        return self.pages[token]
+
+
+def collect(bot, **kwargs):
+    async def main():
+        return [e.event_id async for e in iter_history(bot, "!r", **kwargs)]
+    return asyncio.run(main())
+
+
+def pages(*chunks, end=None):
+    """Chain pages of events, the last one ends with the given end token."""
+    result = {}
+    for i, events in enumerate(chunks):
+        last = i == len(chunks) - 1
+        result[f"t{i}" if i else ""] = Room_Events_Page(
+            events, f"t{i}", end if last else f"t{i + 1}")
+    return result
+
+
+def test_stops_without_end_token():
+    bot = FakeBot(pages([event(1), event(2)], [event(3)]))
+    assert collect(bot) == ["$1", "$2", "$3"]
+    assert [token for token, _ in bot.calls] == ["", "t1"]
+
+
+def test_stops_when_end_token_does_not_move():
+    bot = FakeBot(pages([event(1)], [event(2)], end="t1"))
+    assert collect(bot) == ["$1", "$2"]
+    assert len(bot.calls) == 2
+
+
+def test_empty_pages_do_not_end_the_history():
+    bot = FakeBot(pages([event(1)], [], [event(3)]))
+    assert collect(bot) == ["$1", "$3"]
+
+
+def test_blocking_bot():
+    bot = BlockingBot(pages([event(1)], [event(2)]))
+    assert collect(bot) == ["$1", "$2"]
+
+
+def test_limit():
+    bot = FakeBot(pages([event(1), event(2)], [event(3), event(4)], [event(5)]))
+    assert collect(bot, limit=3) == ["$1", "$2", "$3"]
+
+
+def test_until_event_and_until_ts():
+    bot = FakeBot(pages([event(1), event(2)], [event(3), event(4)]))
+    assert collect(bot, until_event="$3") == ["$1", "$2"]
+    bot = FakeBot(pages([event(1), event(2)], [event(3), event(4)]))
+    assert collect(bot, until_ts=998) == ["$1", "$2"]
+
+
+def test_types_request_encrypted_events_and_filter_them():
+    bot = FakeBot(pages([event(1), event(2, "m.room.encrypted"), event(3, "m.reaction")]))
+    assert collect(bot, types=["m.room.message"]) == ["$1"]
+    assert bot.calls[0][1] == {"types": ["m.room.message", "m.room.encrypted"]}
+
+
+def test_explicit_filter_is_passed_as_is():
+    bot = FakeBot(pages([event(1), event(2, "m.reaction")]))
+    assert collect(bot, filter={"types": ["m.reaction"]}, types=["m.room.message"]) == ["$1", "$2"]
+    assert bot.calls[0][1] == {"types": ["m.reaction"]}
+
+
+def test_prefetched_page_is_cancelled_when_stopping_early():
+    async def main():
+        bot = FakeBot(pages([event(1), event(2)], [event(3)]))
+        assert [e.event_id async for e in iter_history(bot, "!r", limit=1)] == ["$1"]
+        await asyncio.sleep(0)
+        # the fetch of the second page didn't outlive the iteration
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+        assert [token for token, _ in bot.calls] == [""]
+
+    asyncio.run(main())
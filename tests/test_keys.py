@@ -0,0 +1,136 @@
+import asyncio
+from matrix.keys import ALGORITHM, AsyncOneTimeKeyMaintainer, OneTimeKeyMaintainer
+
+
+class FakeAccount():
+    max_one_time_keys = 100
+
+
+class FakeOlm():
+    def __init__(self):
+        self.active = True
+        self.account = FakeAccount()
+        self.published = 0
+
+    def device_keys(self):
+        return {"device_id": "DEV"}
+
+    def signed_one_time_keys(self, count):
+        return {f"{ALGORITHM}:{i}": {"key": str(i)} for i in range(count)}
+
+    def mark_keys_as_published(self):
+        self.published += 1
+
+
+def counts(count):
+    return {ALGORITHM: count}
+
+
+def test_uploads_missing_keys_and_device_keys():
+    uploads = []
+
+    def upload(device_keys, one_time_keys):
+        uploads.append((device_keys, len(one_time_keys)))
+        return {"one_time_key_counts": counts(50)}
+
+    olm = FakeOlm()
+    maintainer = OneTimeKeyMaintainer(upload, olm)
+    maintainer.update(counts(10))
+    maintainer.pending.result()
+    assert uploads == [({"device_id": "DEV"}, 40)]
+    assert olm.published == 1
+    assert maintainer.stats() == {"count": 50, "uploads": 1, "uploaded": 40, "failed": 0}
+    maintainer.close()
+
+
+def test_counts_of_the_sync_after_an_upload_are_ignored():
+    uploads = []
+
+    def upload(device_keys, one_time_keys):
+        uploads.append(len(one_time_keys))
+        return {"one_time_key_counts": counts(50)}
+
+    maintainer = OneTimeKeyMaintainer(upload, FakeOlm())
+    maintainer.update(counts(0))
+    maintainer.pending.result()
+    assert maintainer.stale_syncs == 1
+
+    # this sync may have been counted before the upload arrived
+    maintainer.update(counts(0))
+    assert maintainer.stale_syncs == 0
+    assert maintainer.count == 50
+    assert uploads == [50]
+
+    # the next one is trusted again
+    maintainer.update(counts(45))
+    maintainer.pending.result()
+    assert maintainer.count == 50
+    assert uploads == [50, 5]
+    maintainer.close()
+
+
+def test_counts_are_ignored_while_uploading():
+    calls = []
+
+    async def main():
+        release = asyncio.Event()
+
+        async def upload(device_keys, one_time_keys):
+            calls.append(len(one_time_keys))
+            await release.wait()
+            return {"one_time_key_counts": counts(50)}
+
+        maintainer = AsyncOneTimeKeyMaintainer(upload, FakeOlm())
+        maintainer.update(counts(0))
+        pending = maintainer.pending
+        await asyncio.sleep(0)
+        maintainer.update(counts(0))
+        assert maintainer.pending is pending
+        release.set()
+        await pending
+        return maintainer
+
+    maintainer = asyncio.run(main())
+    assert calls == [50]
+    assert maintainer.stale_syncs == 1
+
+
+def test_nothing_is_uploaded_when_enough_keys_are_left():
+    maintainer = OneTimeKeyMaintainer(lambda *args: {}, FakeOlm(), target=10)
+    maintainer.device_keys_uploaded = True
+    maintainer.update(counts(10))
+    assert maintainer.pending is None
+    assert maintainer.count == 10
+    maintainer.close()
+
+
+def test_failed_upload_is_counted_and_retried():
+    attempts = []
+
+    def upload(device_keys, one_time_keys):
+        attempts.append(len(one_time_keys))
+        if len(attempts) == 1:
+            raise ConnectionError
+        return {"one_time_key_counts": counts(50)}
+
+    olm = FakeOlm()
+    maintainer = OneTimeKeyMaintainer(upload, olm)
+    maintainer.update(counts(0))
+    assert isinstance(maintainer.pending.exception(), ConnectionError)
+    assert maintainer.failed == 1 and olm.published == 0
+    assert maintainer.stale_syncs == 0
+    maintainer.update(counts(0))
+    maintainer.pending.result()
+    assert attempts == [50, 50]
+    assert olm.published == 1
+    maintainer.close()
+
+
+def test_inactive_olm_is_skipped():
+    olm = FakeOlm()
+    olm.active = False
+    maintainer = OneTimeKeyMaintainer(lambda *args: {}, olm)
+    maintainer.update(counts(0))
+    maintainer.update(None)
+    assert maintainer.pending is None and maintainer.count is None
+    maintainer.close()
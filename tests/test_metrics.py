@@ -0,0 +1,88 @@
+import pytest
+from matrix.metrics import NULL_METRICS, Metrics, endpoint_template
+
+
+def test_endpoint_template():
+    assert endpoint_template("/rooms/!id:x/send/m.room.message/abc") == "/rooms/{}/send/m.room.message/{}"
+    assert endpoint_template("/download/example.org/media?x=1") == "/download/{}/{}"
+    assert endpoint_template("/profile/@a:x/displayname") == "/profile/{}/displayname"
+
+
+def test_counter_and_gauge():
+    metrics = Metrics()
+    requests = metrics.counter("requests_total", "Requests.")
+    requests.inc(endpoint="/sync")
+    requests.inc(2, endpoint="/sync")
+    depth = metrics.gauge("depth", "Depth.")
+    depth.set(4)
+    depth.set(1)
+    snapshot = metrics.to_dict()
+    assert snapshot["requests_total"]["type"] == "counter"
+    assert snapshot["requests_total"]["values"] == [{"labels": {"endpoint": "/sync"}, "value": 3}]
+    assert snapshot["depth"]["values"] == [{"labels": {}, "value": 1}]
+
+
+def test_same_name_returns_same_metric():
+    metrics = Metrics()
+    assert metrics.counter("a_total") is metrics.counter("a_total")
+    with pytest.raises(ValueError):
+        metrics.gauge("a_total")
+
+
+def test_gauge_functions_are_read_on_export():
+    metrics = Metrics()
+    depth = metrics.gauge("depth")
+    queue = [1, 2]
+    depth.set_function(lambda: len(queue), bot="@a:x")
+    depth.set_function(lambda: 1 / 0, bot="@b:x")
+    queue.append(3)
+    assert metrics.to_dict()["depth"]["values"] == [{"labels": {"bot": "@a:x"}, "value": 3}]
+
+
+def test_gauge_remove_function():
+    metrics = Metrics()
+    depth = metrics.gauge("depth")
+    depth.set_function(lambda: 1, bot="@a:x")
+    depth.set_function(lambda: 2, bot="@b:x")
+    metrics.to_dict()
+    depth.remove_function(bot="@a:x")
+    depth.remove_function(bot="@unknown:x")
+    assert depth.functions.keys() == {(("bot", "@b:x"), )}
+    assert metrics.to_dict()["depth"]["values"] == [{"labels": {"bot": "@b:x"}, "value": 2}]
+
+
+def test_histogram():
+    metrics = Metrics()
+    seconds = metrics.histogram("seconds", "Seconds.", buckets=(1, 0.1))
+    for value in (0.05, 0.1, 0.5, 3):
+        seconds.observe(value)
+    [values] = metrics.to_dict()["seconds"]["values"]
+    assert values["buckets"] == {0.1: 2, 1: 3, "+Inf": 4}
+    assert values["count"] == 4
+    assert values["sum"] == pytest.approx(3.65)
+
+
+def test_prometheus_text():
+    metrics = Metrics()
+    metrics.counter("requests_total", "Requests.").inc(endpoint='/a"b')
+    metrics.histogram("seconds", "Seconds.", buckets=(1, )).observe(0.5)
+    assert metrics.to_prometheus() == (
+        "# HELP requests_total Requests.\n"
+        "# TYPE requests_total counter\n"
+        'requests_total{endpoint="/a\\"b"} 1\n'
+        "# HELP seconds Seconds.\n"
+        "# TYPE seconds histogram\n"
+        'seconds_bucket{le="1"} 1\n'
+        'seconds_bucket{le="+Inf"} 1\n'
+        "seconds_sum 0.5\n"
+        "seconds_count 1\n")
+
+
+def test_null_metrics_ignore_everything():
+    gauge = NULL_METRICS.gauge("depth")
+    gauge.set_function(lambda: 1)
+    gauge.remove_function()
+    NULL_METRICS.counter("a_total").inc()
+    NULL_METRICS.histogram("seconds").observe(1)
+    assert not NULL_METRICS.enabled
+    assert NULL_METRICS.to_dict() == {}
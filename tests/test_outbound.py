@@ -0,0 +1,148 @@
+import asyncio
+import threading
+import pytest
+from matrix.outbound import AsyncSendQueue, SendQueue
+
+
+def test_send_queue_keeps_room_order():
+    sent = []
+    lock = threading.Lock()
+
+    def send(room_id, event_type, content, txn_id):
+        with lock:
+            sent.append((room_id, txn_id))
+        return {"event_id": f"${txn_id}"}
+
+    queue = SendQueue(send, max_in_flight=4)
+    futures = [queue.enqueue(room_id, "m.room.message", {}, f"{room_id}{i}")
+               for i in range(10) for room_id in ("!a", "!b")]
+    queue.flush(timeout=5)
+    assert [future.result().event_id for future in futures[:2]] == ["$!a0", "$!b0"]
+    for room_id in ("!a", "!b"):
+        assert [txn for room, txn in sent if room == room_id] == [f"{room_id}{i}" for i in range(10)]
+    assert queue.stats() == {"queued": 0, "sent": 20, "failed": 0}
+    queue.close()
+
+
+def test_send_queue_errors_fail_their_future_only():
+    def send(room_id, event_type, content, txn_id):
+        if txn_id == "bad":
+            raise ConnectionError
+        return {"event_id": "$ok"}
+
+    queue = SendQueue(send)
+    bad = queue.enqueue("!a", "m.room.message", {}, "bad")
+    good = queue.enqueue("!a", "m.room.message", {}, "good")
+    assert isinstance(bad.exception(timeout=5), ConnectionError)
+    assert good.result(timeout=5).event_id == "$ok"
+    assert queue.stats()["failed"] == 1
+    queue.close()
+
+
+def test_send_queue_skips_cancelled_sends():
+    release = threading.Event()
+    sent = []
+
+    def send(room_id, event_type, content, txn_id):
+        release.wait(5)
+        sent.append(txn_id)
+        return {"event_id": "$1"}
+
+    queue = SendQueue(send)
+    first = queue.enqueue("!a", "m.room.message", {}, "1")
+    second = queue.enqueue("!a", "m.room.message", {}, "2")
+    third = queue.enqueue("!a", "m.room.message", {}, "3")
+    assert second.cancel()
+    release.set()
+    queue.flush(timeout=5)
+    assert sent == ["1", "3"]
+    assert first.done() and third.done()
+    assert queue.stats() == {"queued": 0, "sent": 2, "failed": 0}
+    queue.close()
+
+
+def test_closed_send_queue_still_sends_queued_events():
+    release = threading.Event()
+    sent = []
+
+    def send(room_id, event_type, content, txn_id):
+        release.wait(5)
+        sent.append(txn_id)
+        return {"event_id": f"${txn_id}"}
+
+    queue = SendQueue(send, max_in_flight=1)
+    futures = [queue.enqueue(room_id, "m.room.message", {}, f"{room_id}{i}")
+               for room_id in ("!a", "!b") for i in range(3)]
+    queue.close()
+    with pytest.raises(RuntimeError):
+        queue.enqueue("!a", "m.room.message", {}, "late")
+    release.set()
+    for future in futures:
+        future.result(timeout=5)
+    assert sorted(sent) == ["!a0", "!a1", "!a2", "!b0", "!b1", "!b2"]
+    assert queue.stats()["queued"] == 0
+
+
+def test_async_send_queue_keeps_room_order():
+    sent = []
+
+    async def send(room_id, event_type, content, txn_id):
+        await asyncio.sleep(0)
+        sent.append((room_id, txn_id))
+        return {"event_id": f"${txn_id}"}
+
+    async def main():
+        queue = AsyncSendQueue(send, max_in_flight=2)
+        futures = [queue.enqueue(room_id, "m.room.message", {}, f"{room_id}{i}")
+                   for i in range(5) for room_id in ("!a", "!b", "!c")]
+        await queue.flush()
+        return queue, [future.result().event_id for future in futures]
+
+    queue, event_ids = asyncio.run(main())
+    assert event_ids[:3] == ["$!a0", "$!b0", "$!c0"]
+    for room_id in ("!a", "!b", "!c"):
+        assert [txn for room, txn in sent if room == room_id] == [f"{room_id}{i}" for i in range(5)]
+    assert queue.stats() == {"queued": 0, "sent": 15, "failed": 0}
+
+
+def test_async_send_queue_skips_cancelled_sends():
+    sent = []
+
+    async def send(room_id, event_type, content, txn_id):
+        sent.append(txn_id)
+        return {"event_id": "$1"}
+
+    async def main():
+        queue = AsyncSendQueue(send)
+        futures = [queue.enqueue("!a", "m.room.message", {}, str(i)) for i in range(3)]
+        futures[1].cancel()
+        await queue.flush()
+        return futures
+
+    futures = asyncio.run(main())
+    assert sent == ["0", "2"]
+    assert futures[0].done() and futures[2].done()
+
+
+def test_async_send_queue_cancels_the_rest_of_a_cancelled_drain():
+    started = []
+
+    async def send(room_id, event_type, content, txn_id):
+        started.append(txn_id)
+        await asyncio.sleep(10)
+        return {"event_id": "$1"}
+
+    async def main():
+        queue = AsyncSendQueue(send)
+        futures = [queue.enqueue("!a", "m.room.message", {}, str(i)) for i in range(3)]
+        await asyncio.sleep(0)
+        for task in list(queue.tasks):
+            task.cancel()
+        await queue.flush()
+        # the room can be used again afterwards
+        assert not queue.queues
+        return futures
+
+    futures = asyncio.run(main())
+    assert started == ["0"]
+    assert all(future.cancelled() for future in futures[1:])
@@ -0,0 +1,75 @@
+from matrix.ratelimit import RateLimiter, TokenBucket, classify_endpoint
+
+
+def test_classify_endpoint():
+    assert classify_endpoint("/rooms/!r:x/send/m.room.message/1") == "send"
+    assert classify_endpoint("/rooms/!r:x/state/m.room.name/") == "send"
+    assert classify_endpoint("/sendToDevice/m.room.encrypted/1") == "send"
+    assert classify_endpoint("/join/!r:x") == "join"
+    assert classify_endpoint("/rooms/!r:x/join") == "join"
+    assert classify_endpoint("/rooms/!r:x/invite") == "invite"
+    assert classify_endpoint("/sync") == "sync"
+    assert classify_endpoint("/upload", "/_matrix/media/r0") == "media"
+    assert classify_endpoint("/account/whoami") == "other"
+
+
+def test_unlimited_bucket_never_waits():
+    bucket = TokenBucket()
+    assert all(bucket.reserve() == 0 for _ in range(100))
+
+
+def test_bucket_waits_once_the_burst_is_used():
+    bucket = TokenBucket(rate=10, burst=2)
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert 0.05 < bucket.reserve() <= 0.1
+
+
+def test_rate_limit_halves_the_rate_and_blocks():
+    bucket = TokenBucket(rate=10, burst=5)
+    bucket.limited(0.5)
+    assert bucket.rate == 5
+    assert bucket.limited_count == 1
+    assert bucket.reserve() >= 0.4
+
+
+def test_rate_limits_in_flight_together_count_once():
+    bucket = TokenBucket(rate=10)
+    bucket.limited(1)
+    bucket.limited(1)
+    assert bucket.rate == 5
+    assert bucket.limited_count == 2
+
+
+def test_unlimited_bucket_learns_the_rate_from_a_rate_limit():
+    bucket = TokenBucket(window=10)
+    for _ in range(20):
+        bucket.reserve()
+    bucket.limited(0)
+    # 20 requests within a second, halved
+    assert bucket.rate == 10
+    assert bucket.max_rate == 20
+
+
+def test_rate_recovers_but_not_past_the_maximum():
+    bucket = TokenBucket(rate=10)
+    bucket.limited(0)
+    for _ in range(100):
+        bucket.succeeded()
+    assert bucket.rate == 10
+
+
+def test_rate_never_drops_below_the_minimum():
+    bucket = TokenBucket(rate=1, min_rate=0.5)
+    for _ in range(10):
+        bucket.blocked_until = 0
+        bucket.limited(0)
+    assert bucket.rate == 0.5
+
+
+def test_rate_limiter_has_a_bucket_per_class():
+    limiter = RateLimiter({"send": 5})
+    assert limiter.bucket("/rooms/!r:x/send/m.room.message/1").rate == 5
+    assert limiter.bucket("/sync").rate is None
+    limiter.bucket("/join/!r:x").limited(0)
+    assert limiter.stats()["join"][1] == 1
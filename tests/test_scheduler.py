@@ -0,0 +1,124 @@
+import asyncio
+import threading
+
+import pytest
+
+from matrix.metrics import Metrics
+from matrix.scheduler import Scheduler
+
+
+def test_handlers_of_a_room_run_in_order():
+    order = []
+
+    async def handler(room, i):
+        # later handlers finish faster, they must still wait their turn
+        await asyncio.sleep(0.01 * (3 - i))
+        order.append((room, i))
+
+    async def main():
+        scheduler = Scheduler()
+        for i in range(3):
+            scheduler.submit("!a", handler, "!a", i)
+            scheduler.submit("!b", handler, "!b", i)
+        await scheduler.join()
+        scheduler.close()
+
+    asyncio.run(main())
+    assert [i for room, i in order if room == "!a"] == [0, 1, 2]
+    assert [i for room, i in order if room == "!b"] == [0, 1, 2]
+
+
+def test_rooms_run_concurrently():
+    running = []
+    peak = []
+
+    async def handler():
+        running.append(1)
+        peak.append(len(running))
+        await asyncio.sleep(0.01)
+        running.pop()
+
+    async def main():
+        scheduler = Scheduler(max_concurrency=2)
+        for room in ["!a", "!b", "!c"]:
+            scheduler.submit(room, handler)
+        await scheduler.join()
+
+    asyncio.run(main())
+    assert max(peak) == 2
+
+
+def test_thread_mode_runs_plain_functions_off_the_loop():
+    threads = []
+
+    def handler():
+        threads.append(threading.current_thread())
+
+    async def main():
+        scheduler = Scheduler(mode="thread", max_workers=2)
+        scheduler.submit("!a", handler)
+        await scheduler.join()
+        scheduler.close()
+
+    asyncio.run(main())
+    assert threads[0] is not threading.main_thread()
+
+
+def test_errors_are_counted_and_later_handlers_still_run(capsys):
+    done = []
+
+    def broken():
+        raise ValueError("boom")
+
+    async def main():
+        metrics = Metrics()
+        scheduler = Scheduler(metrics=metrics)
+        scheduler.submit("!a", broken)
+        scheduler.submit("!a", done.append, 1)
+        await scheduler.join()
+        return metrics
+
+    metrics = asyncio.run(main())
+    assert done == [1]
+    assert metrics.counter("matrix_handler_errors_total").values == {(("handler", "broken"), ): 1}
+    assert "ValueError: boom" in capsys.readouterr().err
+
+
+def test_join_only_waits_for_the_owner():
+    release = None
+    done = []
+
+    async def slow():
+        await release.wait()
+
+    async def main():
+        nonlocal release
+        release = asyncio.Event()
+        scheduler = Scheduler()
+        scheduler.submit(("@a:x", "!r"), slow)
+        scheduler.submit(("@b:x", "!r"), done.append, "b")
+        await asyncio.wait_for(scheduler.join("@b:x"), 1)
+        assert scheduler.queue_depth() == 0
+        release.set()
+        await scheduler.join()
+
+    asyncio.run(main())
+    assert done == ["b"]
+
+
+def test_queue_depth():
+    async def main():
+        scheduler = Scheduler()
+        for _ in range(3):
+            scheduler.submit("!a", asyncio.sleep, 0)
+        # the worker only starts once the loop runs it
+        depth = scheduler.queue_depth("!a"), scheduler.queue_depth()
+        await scheduler.join()
+        return depth
+
+    assert asyncio.run(main()) == (3, 3)
+
+
+def test_invalid_mode():
+    with pytest.raises(ValueError):
+        Scheduler(mode="process")
@@ -0,0 +1,113 @@
+import pytest
+from matrix.storage import MemoryStorage, SQLiteStorage
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def storage(request, tmp_path):
+    if request.param == "memory":
+        yield MemoryStorage()
+    else:
+        storage = SQLiteStorage(str(tmp_path / "bot.db"))
+        yield storage
+        storage.close()
+
+
+def message(event_id, body="hi"):
+    return {"event_id": event_id, "type": "m.room.message", "content": {"body": body}}
+
+
+def state_event(event_type, state_key, content):
+    return {"type": event_type, "state_key": state_key, "content": content}
+
+
+def test_values(storage):
+    assert storage.get_value("token", "none") == "none"
+    storage.set_value("token", {"next_batch": "b1"})
+    storage.set_value("token", {"next_batch": "b2"})
+    assert storage.get_value("token") == {"next_batch": "b2"}
+
+
+def test_save_rooms_and_delete(storage):
+    storage.save_rooms("join", {"!a": {"timeline": {"events": [message("$1")]}}})
+    storage.save_rooms("invite", {"!b": {"invite_state": {"events": []}}})
+    rooms = storage.get_rooms()
+    assert rooms["join"]["!a"]["timeline"]["events"] == [message("$1")]
+    assert "!b" in rooms["invite"]
+    storage.delete_rooms(["!a"])
+    assert storage.get_rooms()["join"] == {}
+    storage.clear_rooms()
+    assert storage.get_rooms() == {"join": {}, "invite": {}}
+
+
+def test_save_room_delta_merges(storage):
+    storage.save_room_delta("!r", {"summary": {}},
+                            [state_event("m.room.name", "", {"name": "a"}),
+                             state_event("m.room.topic", "", {"topic": "t"})],
+                            [message("$1"), message("$2")])
+    storage.save_room_delta("!r", {"summary": {"m.joined_member_count": 2}},
+                            [state_event("m.room.name", "", {"name": "b"})],
+                            [message("$3")])
+    room = storage.get_rooms()["join"]["!r"]
+    assert room["summary"] == {"m.joined_member_count": 2}
+    assert [e["event_id"] for e in room["timeline"]["events"]] == ["$1", "$2", "$3"]
+    names = {e["type"]: e["content"] for e in room["state"]["events"]}
+    assert names == {"m.room.name": {"name": "b"}, "m.room.topic": {"topic": "t"}}
+
+
+def test_save_room_delta_replaces_events_in_place(storage):
+    storage.save_room_delta("!r", {}, [], [message("$1"), message("$2"), message("$3")])
+    storage.save_room_delta("!r", {}, [], [message("$2", "decrypted")])
+    events = storage.get_rooms()["join"]["!r"]["timeline"]["events"]
+    assert [e["event_id"] for e in events] == ["$1", "$2", "$3"]
+    assert events[1]["content"] == {"body": "decrypted"}
+
+
+def test_save_room_delta_trims(storage):
+    storage.save_room_delta("!r", {}, [], [message(f"${i}") for i in range(5)], limit=3)
+    storage.save_room_delta("!r", {}, [], [message("$5")], limit=3)
+    events = storage.get_rooms()["join"]["!r"]["timeline"]["events"]
+    assert [e["event_id"] for e in events] == ["$3", "$4", "$5"]
+
+
+def test_save_room_delta_accepts_invites(storage):
+    storage.save_rooms("invite", {"!r": {"invite_state": {"events": []}}})
+    storage.save_room_delta("!r", {}, [], [message("$1")])
+    rooms = storage.get_rooms()
+    assert "!r" not in rooms["invite"] and "!r" in rooms["join"]
+
+
+def test_save_rooms_replaces_deltas(storage):
+    storage.save_room_delta("!r", {}, [state_event("m.room.name", "", {"name": "a"})],
+                            [message("$1")])
+    storage.save_rooms("join", {"!r": {"timeline": {"events": [message("$9")]}}})
+    room = storage.get_rooms()["join"]["!r"]
+    assert [e["event_id"] for e in room["timeline"]["events"]] == ["$9"]
+    assert room.get("state", {}).get("events", []) == []
+
+
+def test_get_rooms_returns_copies(storage):
+    storage.save_room_delta("!r", {}, [], [message("$1")])
+    storage.get_rooms()["join"]["!r"]["timeline"]["events"].append(message("$x"))
+    assert len(storage.get_rooms()["join"]["!r"]["timeline"]["events"]) == 1
+
+
+def test_seen_is_pruned(storage):
+    storage.add_seen(["$1", "$2", "$3"])
+    storage.add_seen(["$2", "$4", "$5"], limit=4)
+    assert storage.get_seen() == ["$2", "$3", "$4", "$5"]
+    assert storage.get_seen(limit=2) == ["$4", "$5"]
+
+
+def test_sqlite_persists_after_commit(tmp_path):
+    path = str(tmp_path / "bot.db")
+    storage = SQLiteStorage(path)
+    storage.set_value("next_batch", "b1")
+    storage.save_room_delta("!r", {}, [], [message("$1")])
+    storage.add_seen(["$1"])
+    storage.close()
+
+    storage = SQLiteStorage(path)
+    assert storage.get_value("next_batch") == "b1"
+    assert [e["event_id"] for e in storage.get_rooms()["join"]["!r"]["timeline"]["events"]] == ["$1"]
+    assert storage.get_seen() == ["$1"]
+    storage.close()
@@ -0,0 +1,139 @@
+from matrix.classes import Event, Lazy_Room
+from matrix.store import RoomStore
+
+
+def message(event_id, body="hi"):
+    return {"event_id": event_id, "type": "m.room.message", "sender": "@a:x",
+            "origin_server_ts": 1, "content": {"msgtype": "m.text", "body": body}}
+
+
+def state_event(event_type, state_key, content, event_id=None):
+    event = {"type": event_type, "state_key": state_key, "content": content}
+    if event_id: event["event_id"] = event_id
+    return event
+
+
+def sync(next_batch, join=None, invite=None, leave=None):
+    return {"next_batch": next_batch,
+            "rooms": {"join": join or {}, "invite": invite or {}, "leave": leave or {}}}
+
+
+def room(events=(), state=(), limited=False, **extra):
+    return {"timeline": {"events": list(events), "limited": limited},
+            "state": {"events": list(state)}, **extra}
+
+
+def test_initial_sync_adds_rooms():
+    store = RoomStore()
+    delta = store.apply(sync("b1", {"!r": room([message("$1")])}), initial=True)
+    assert store.next_batch == "b1"
+    assert [e.event_id for e in store.get_room("!r").timeline] == ["$1"]
+    assert [e.event_id for e in delta.timeline["!r"]] == ["$1"]
+    assert delta.initial
+
+
+def test_deltas_are_merged_into_known_rooms():
+    store = RoomStore()
+    store.apply(sync("b1", {"!r": room([message("$1")])}), initial=True)
+    delta = store.apply(sync("b2", {"!r": room([message("$2"), message("$3")])}))
+    assert [e.event_id for e in store.get_room("!r").timeline] == ["$1", "$2", "$3"]
+    assert [e.event_id for e in delta.timeline["!r"]] == ["$2", "$3"]
+    assert "!r" not in delta.state
+
+
+def test_timeline_is_trimmed():
+    store = RoomStore(timeline_limit=3)
+    store.apply(sync("b1", {"!r": room([message(f"${i}") for i in range(5)])}), initial=True)
+    assert [e.event_id for e in store.get_room("!r").timeline] == ["$2", "$3", "$4"]
+    delta = store.apply(sync("b2", {"!r": room([message("$5"), message("$6")])}))
+    assert [e.event_id for e in store.get_room("!r").timeline] == ["$4", "$5", "$6"]
+    assert len(delta.timeline["!r"]) == 2
+
+
+def test_state_events_replace_by_type_and_state_key():
+    store = RoomStore()
+    store.apply(sync("b1", {"!r": room(state=[state_event("m.room.name", "", {"name": "a"}),
+                                              state_event("m.room.topic", "", {"topic": "t"})])}),
+                initial=True)
+    delta = store.apply(sync("b2", {"!r": room(
+        [state_event("m.room.name", "", {"name": "c"}, "$n")],
+        [state_event("m.room.name", "", {"name": "b"})])}))
+    state = store.get_room("!r").state["events"]
+    assert [e["content"] for e in state] == [{"name": "c"}, {"topic": "t"}]
+    assert delta.state["!r"] == [state_event("m.room.name", "", {"name": "b"})]
+
+
+def test_encryption_is_detected_in_deltas():
+    store = RoomStore()
+    store.apply(sync("b1", {"!r": room([message("$1")])}), initial=True)
+    assert not store.get_room("!r").encrypted
+    store.apply(sync("b2", {"!r": room([state_event(
+        "m.room.encryption", "", {"algorithm": "m.megolm.v1.aes-sha2"}, "$e")])}))
+    assert store.get_room("!r").encrypted
+
+
+def test_unread_counts_and_account_data_are_merged():
+    store = RoomStore()
+    store.apply(sync("b1", {"!r": room(account_data={"events": [{"type": "a", "content": {"v": 1}},
+                                                                 {"type": "b", "content": {}}]})}),
+                initial=True)
+    store.apply(sync("b2", {"!r": room(unread_notifications={"notification_count": 3},
+                                       account_data={"events": [{"type": "a", "content": {"v": 2}}]})}))
+    r = store.get_room("!r")
+    assert r.unread_notifications.notification_count == 3
+    assert [e["type"] for e in r.account_data["events"]] == ["b", "a"]
+    assert r.account_data["events"][1]["content"] == {"v": 2}
+
+
+def test_invites_and_leaves():
+    store = RoomStore()
+    invite = {"invite_state": {"events": [state_event("m.room.member", "@me:x", {"membership": "invite"})]}}
+    delta = store.apply(sync("b1", invite={"!i": invite}), initial=True)
+    assert [i.room_id for i in delta.invites] == ["!i"]
+    store.apply(sync("b2", {"!i": room()}))
+    assert store.get_invite("!i") is None and store.get_room("!i") is not None
+    delta = store.apply(sync("b3", leave={"!i": {}}))
+    assert delta.left_rooms == ["!i"]
+    assert store.get_room("!i") is None
+
+
+def test_members_are_kept_current():
+    store = RoomStore()
+    store.apply(sync("b1", {"!r": room()}), initial=True)
+    assert store.is_member("!r", "@a:x") is None
+    from matrix.classes import User
+    store.set_members("!r", [User("@a:x")])
+    store.apply(sync("b2", {"!r": room([state_event("m.room.member", "@b:x", {"membership": "join"}, "$j")])}))
+    assert store.is_member("!r", "@b:x")
+    store.apply(sync("b3", {"!r": room([state_event("m.room.member", "@a:x", {"membership": "leave"}, "$l")])}))
+    assert not store.is_member("!r", "@a:x")
+    # a gap may hide member changes
+    store.apply(sync("b4", {"!r": room(limited=True)}))
+    assert store.get_members("!r") is None
+
+
+def test_replace_events_swaps_by_event_id():
+    store = RoomStore()
+    store.apply(sync("b1", {"!r": room([message("$1"), message("$2")])}), initial=True)
+    decrypted = Event(event_id="$2", type="m.room.message", content={"body": "plain"})
+    store.replace_events({"!r": [decrypted, Event(event_id="$gone")], "!unknown": [decrypted]})
+    assert store.get_room("!r").timeline[1] is decrypted
+    assert [e.event_id for e in store.get_room("!r").timeline] == ["$1", "$2"]
+
+
+def test_lazy_store_keeps_raw_rooms():
+    store = RoomStore(lazy=True)
+    store.apply(sync("b1", {"!r": room([message("$1"), state_event(
+        "m.room.encryption", "", {"algorithm": "m.megolm.v1.aes-sha2"}, "$e")])}), initial=True)
+    store.apply(sync("b2", {"!r": room([message("$2", "second")])}))
+    r = store.get_room("!r")
+    assert isinstance(r, Lazy_Room)
+    assert r.encrypted
+    assert r.timeline[-1].parsed_message.body == "second"
+
+
+def test_clear():
+    store = RoomStore()
+    store.apply(sync("b1", {"!r": room([message("$1")])}), initial=True)
+    store.clear()
+    assert store.next_batch == "" and store.joined_rooms == []
@@ -0,0 +1,78 @@
+import asyncio
+import threading
+from matrix import utils
+from matrix.utils import SeenSet, call_bot, maybe_await
+
+
+def test_seen_set_add():
+    seen = SeenSet()
+    assert seen.add("$1")
+    assert not seen.add("$1")
+    assert "$1" in seen and "$2" not in seen
+    stats = seen.stats()
+    assert stats["size"] == 1
+    assert stats["hits"] == 2 and stats["misses"] == 2
+    assert stats["hit_rate"] == 0.5
+
+
+def test_seen_set_evicts_oldest():
+    seen = SeenSet(capacity=3)
+    for i in range(5):
+        seen.add(f"${i}")
+    assert len(seen) == 3
+    assert "$0" not in seen and "$1" not in seen and "$4" in seen
+    assert seen.stats()["evictions"] == 2
+
+
+def test_seen_set_update():
+    seen = SeenSet(capacity=2)
+    seen.update(["$1", "$2", "$3"])
+    assert list(seen.ids) == ["$2", "$3"]
+    assert seen.evictions == 1
+
+
+def test_seen_set_expires(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(utils, "monotonic", lambda: now[0])
+    seen = SeenSet(ttl=10)
+    seen.add("$1")
+    now[0] = 105.0
+    seen.add("$2")
+    now[0] = 111.0
+    assert "$1" not in seen
+    assert "$2" in seen
+    assert seen.expirations == 1
+
+
+def test_maybe_await():
+    async def coroutine():
+        return 1
+
+    async def main():
+        return await maybe_await(coroutine()), await maybe_await(2)
+
+    assert asyncio.run(main()) == (1, 2)
+
+
+def test_call_bot_awaits_coroutine_functions():
+    async def send(room_id, text=""):
+        return threading.current_thread(), room_id, text
+
+    async def main():
+        return await call_bot(send, "!r", text="hi")
+
+    thread, room_id, text = asyncio.run(main())
+    assert thread is threading.main_thread()
+    assert (room_id, text) == ("!r", "hi")
+
+
+def test_call_bot_runs_blocking_functions_in_executor():
+    def send(room_id, text=""):
+        return threading.current_thread(), room_id, text
+
+    async def main():
+        return await call_bot(send, "!r", text="hi")
+
+    thread, room_id, text = asyncio.run(main())
+    assert thread is not threading.main_thread()
+    assert (room_id, text) == ("!r", "hi")